@@ -0,0 +1,121 @@
+import io
+import mimetypes
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+THUMBNAIL_SIZE = (320, 320)
+PREVIEW_SIZE = (1280, 1280)
+VARIANT_QUALITY = 80
+ORIGINAL_QUALITY = 95
+# GIFs are kept byte-for-byte: they carry no EXIF and re-encoding would
+# flatten animations.
+REENCODED_FORMATS = {'JPEG', 'PNG'}
+
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+# Declared types some clients send for the formats we accept.
+CONTENT_TYPE_ALIASES = {'image/jpg': 'image/jpeg', 'image/pjpeg': 'image/jpeg'}
+# Declared by clients that do not know the type; the extension decides then.
+UNKNOWN_CONTENT_TYPE = 'application/octet-stream'
+
+
+class AttachmentProcessingError(Exception):
+    pass
+
+
+def sniff_content_type(chunk: bytes):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if chunk.startswith(signature):
+            return content_type
+    if b'\x00' in chunk:
+        return None
+    try:
+        # The chunk may end in the middle of a multi-byte character.
+        chunk.decode('utf-8')
+    except UnicodeDecodeError as exc:
+        if exc.start < len(chunk) - 3:
+            return None
+    return 'text/plain'
+
+
+def accepted_content_type(sniffed, declared, name):
+    """``sniffed`` when the declared type and the file extension agree with it, else None.
+
+    Stored files keep the client's name and are served by extension, so any
+    UTF-8 upload named ``.html`` or ``.svg`` would otherwise go out as markup.
+    """
+    if sniffed is None:
+        return None
+    declared = (declared or '').split(';')[0].strip().lower()
+    declared = CONTENT_TYPE_ALIASES.get(declared, declared)
+    if declared and declared != UNKNOWN_CONTENT_TYPE and declared != sniffed:
+        return None
+    if mimetypes.guess_type(name or '')[0] != sniffed:
+        return None
+    return sniffed
+
+
+def variant_format():
+    if features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+
+def _encode(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+def _variant(image, max_size, fmt):
+    variant = image.copy()
+    variant.thumbnail(max_size, Image.LANCZOS)
+    if fmt == 'JPEG' and variant.mode not in ('RGB', 'L'):
+        variant = variant.convert('RGB')
+    elif variant.mode not in ('RGB', 'RGBA', 'L'):
+        variant = variant.convert('RGBA')
+    return _encode(variant, fmt, quality=VARIANT_QUALITY), variant.size
+
+
+def process_image(file):
+    """Validate an uploaded image and build its stripped original and display variants.
+
+    Returns a dict with ``original`` (re-encoded bytes without metadata, or
+    None when the upload is kept as-is), ``width``/``height`` and the encoded
+    ``thumbnail``/``preview`` variants with their sizes.
+    """
+    try:
+        file.seek(0)
+        with Image.open(file) as probe:
+            probe.verify()
+        file.seek(0)
+        image = Image.open(file)
+        image.load()
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError, Image.DecompressionBombError) as exc:
+        raise AttachmentProcessingError(str(exc)) from exc
+
+    source_format = image.format
+    original = None
+    if source_format in REENCODED_FORMATS:
+        image = ImageOps.exif_transpose(image)
+        params = {'quality': ORIGINAL_QUALITY} if source_format == 'JPEG' else {}
+        original = _encode(image, source_format, **params)
+
+    fmt, extension = variant_format()
+    thumbnail, thumbnail_size = _variant(image, THUMBNAIL_SIZE, fmt)
+    preview, preview_size = _variant(image, PREVIEW_SIZE, fmt)
+    return {
+        'original': original,
+        'width': image.size[0],
+        'height': image.size[1],
+        'extension': extension,
+        'thumbnail': thumbnail,
+        'thumbnail_size': thumbnail_size,
+        'preview': preview,
+        'preview_size': preview_size,
+    }
@@ -0,0 +1,109 @@
+"""Coalescing queue for ``comment_batch`` WebSocket events.
+
+Writes record the comment id in a Redis hash instead of queueing a Celery
+task each. The first write in a window schedules one flush; everything else
+that lands before it runs is folded into the same batch, so a burst of votes
+on one comment becomes a single score delta.
+
+Every published event is stamped with a global sequence number and kept in a
+bounded replay log, so a reconnecting socket can ask for what it missed
+instead of refetching the whole list.
+"""
+import json
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+PENDING_KEY = 'comments:broadcast:pending'
+SCHEDULED_KEY = 'comments:broadcast:scheduled'
+
+KIND_SCORE = 'score'
+KIND_FULL = 'full'
+
+SEQUENCE_KEY = 'comments:stream:seq'
+LOG_KEY = 'comments:stream:log'
+
+FEED_GROUP = 'comments.feed'
+
+# Values are ``<kind>:<thread id>``; a full update supersedes a score-only
+# one for the same comment.
+_QUEUE_SCRIPT = """
+local value = ARGV[2] .. ':' .. ARGV[4]
+if ARGV[2] == 'full' then
+    redis.call('HSET', KEYS[1], ARGV[1], value)
+else
+    redis.call('HSETNX', KEYS[1], ARGV[1], value)
+end
+return redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[3])
+"""
+
+# The sequence number is taken and the entry appended in one step, so the
+# log never holds a gap that a later, lower seq fills in after a client read
+# past it. Members are ``<seq>:<json>``, unique per event.
+_RECORD_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[2], seq, seq .. ':' .. ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -(tonumber(ARGV[2]) + 1))
+return seq
+"""
+
+
+def thread_group(thread_id: int) -> str:
+    return f'comments.thread.{thread_id}'
+
+
+def window_ms():
+    return getattr(settings, 'COMMENTS_BROADCAST_WINDOW_MS', 200)
+
+
+def log_size():
+    return getattr(settings, 'COMMENTS_REPLAY_LOG_SIZE', 1000)
+
+
+def queue(comment_id: int, thread_id: int, kind: str = KIND_FULL) -> bool:
+    """Record a pending event; return True when the caller must schedule a flush."""
+    client = get_redis()
+    scheduled = client.eval(
+        _QUEUE_SCRIPT, 2, PENDING_KEY, SCHEDULED_KEY, comment_id, kind, window_ms(), thread_id
+    )
+    return bool(scheduled)
+
+
+def drain():
+    """Atomically take every pending event as ``{comment_id: (kind, thread_id)}``."""
+    pipe = get_redis().pipeline(transaction=True)
+    pipe.hgetall(PENDING_KEY)
+    pipe.delete(PENDING_KEY)
+    pending, _ = pipe.execute()
+    result = {}
+    for comment_id, value in pending.items():
+        kind, thread_id = value.decode().split(':', 1)
+        result[int(comment_id)] = (kind, int(thread_id))
+    return result
+
+
+def record(group: str, message: dict) -> dict:
+    """Stamp ``message`` with the next sequence number and append it to the replay log."""
+    entry = json.dumps({'group': group, 'payload': message})
+    seq = get_redis().eval(_RECORD_SCRIPT, 2, SEQUENCE_KEY, LOG_KEY, entry, log_size())
+    return {**message, 'seq': int(seq)}
+
+
+def replay(last_seq: int, groups):
+    """Events after ``last_seq`` published to ``groups``, or None when the log no longer covers the gap."""
+    client = get_redis()
+    current = int(client.get(SEQUENCE_KEY) or 0)
+    if last_seq == current:
+        return []
+    if last_seq > current:
+        return None
+    oldest = client.zrange(LOG_KEY, 0, 0, withscores=True)
+    if not oldest or oldest[0][1] > last_seq + 1:
+        return None
+    events = []
+    for raw, seq in client.zrangebyscore(LOG_KEY, f'({last_seq}', '+inf', withscores=True):
+        entry = json.loads(raw.split(b':', 1)[1])
+        if entry['group'] in groups:
+            events.append({**entry['payload'], 'seq': int(seq)})
+    return events
@@ -0,0 +1,92 @@
+"""Delta sync over the ``CommentChange`` log.
+
+A client that holds a copy of some comments remembers the log position it is
+current to and asks for everything after it: ``collect`` folds the entries
+per comment and returns the current payload of every comment created or
+updated since, plus the ids of the deleted ones.
+
+Positions are log ids, which a concurrent transaction may commit out of
+order; entries after a gap younger than ``GAP_GRACE`` are held back until the
+gap is either filled or old enough to be a rolled back insert.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import BooleanField, IntegerField, Value
+from django.utils import timezone
+
+from . import vote_buffer
+from .models import Comment, CommentChange
+from .serializers import COMMENT_ROW_FIELDS, serialize_comment_rows
+
+GAP_GRACE = timedelta(seconds=5)
+
+
+def page_size():
+    return getattr(settings, 'COMMENTS_CHANGES_PAGE_SIZE', 500)
+
+
+def current_position() -> int:
+    return CommentChange.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def collect(since, queryset=None, request=None, user=None, threads=None, feed=False):
+    """Changes after position ``since``, or None when the log no longer covers it.
+
+    Returns ``{'position', 'more', 'created', 'updated', 'deleted'}``; with
+    ``more`` the client asks again from ``position``. ``threads``/``feed``
+    limit the result to those threads and to root comments, as for a socket
+    subscription. ``since=None`` just reports the current position.
+    """
+    result = {'position': since, 'more': False, 'created': [], 'updated': [], 'deleted': []}
+    if since is None:
+        result['position'] = current_position()
+        return result
+    bounds = CommentChange.objects.order_by('pk').values_list('pk', flat=True)
+    oldest, latest = bounds.first(), bounds.last()
+    if latest is None or since > latest:
+        return None if since else result
+    if oldest > since + 1:
+        return None
+
+    limit = page_size()
+    entries = list(
+        CommentChange.objects.filter(pk__gt=since).order_by('pk')
+        .values('pk', 'comment_id', 'thread_id', 'kind', 'created_at')[:limit + 1]
+    )
+    result['more'] = len(entries) > limit
+    entries = entries[:limit]
+    recent = timezone.now() - GAP_GRACE
+    for index, entry in enumerate(entries):
+        expected = entries[index - 1]['pk'] + 1 if index else since + 1
+        if entry['pk'] != expected and entry['created_at'] > recent:
+            entries, result['more'] = entries[:index], True
+            break
+    if entries:
+        result['position'] = entries[-1]['pk']
+
+    if threads is not None:
+        entries = [
+            entry for entry in entries
+            if entry['thread_id'] in threads or (feed and entry['comment_id'] == entry['thread_id'])
+        ]
+    created, last_kind = set(), {}
+    for entry in entries:
+        last_kind[entry['comment_id']] = entry['kind']
+        if entry['kind'] == CommentChange.CREATED:
+            created.add(entry['comment_id'])
+
+    alive = [comment_id for comment_id, kind in last_kind.items() if kind != CommentChange.DELETED]
+    if queryset is None:
+        queryset = Comment.objects.annotate(
+            user_vote=Value(0, output_field=IntegerField()),
+            is_bookmarked=Value(False, output_field=BooleanField()),
+        )
+    # Path order, so every created reply comes after its parent.
+    rows = queryset.filter(pk__in=alive).order_by('path').values(*COMMENT_ROW_FIELDS)
+    items = vote_buffer.merge(serialize_comment_rows(rows, request), user)
+    for item in items:
+        result['created' if item['id'] in created else 'updated'].append(item)
+    present = {item['id'] for item in items}
+    result['deleted'] = [comment_id for comment_id in last_kind if comment_id not in present]
+    return result
@@ -1,16 +1,108 @@
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+from . import broadcast, change_log
+from .broadcast import FEED_GROUP, thread_group
+
 
 class CommentConsumer(AsyncJsonWebsocketConsumer):
-    group_name = 'comments'
+    """Streams comment events for the threads a client subscribed to.
+
+    Every connection starts on the feed of new top-level comments. Clients add
+    or drop threads with ``{"action": "subscribe" | "unsubscribe", "threads": [ids]}``
+    and toggle the feed with ``{"action": ..., "feed": true}``. After a reconnect,
+    ``{"action": "resume", "last_seq": n, "threads": [...]}`` subscribes and
+    replays the events missed since ``n``. When the replay log no longer
+    covers ``n``, a ``"since"`` change-log position (see
+    ``comments.change_log``) is answered with one ``changes`` event for the
+    subscribed threads; without it, or if the change log is trimmed too, the
+    answer is ``resync_required``.
+    """
+
+    max_threads = 200
 
     async def connect(self):
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.subscriptions = set()
+        self.threads = set()
         await self.accept()
+        await self._join(FEED_GROUP)
 
     async def disconnect(self, close_code):  # pragma: no cover - best effort cleanup
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        for group in list(getattr(self, 'subscriptions', ())):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action') if isinstance(content, dict) else None
+        if action not in ('subscribe', 'unsubscribe', 'resume'):
+            await self.send_json({'type': 'error', 'detail': 'Unknown action'})
+            return
+
+        if content.get('feed'):
+            if action == 'unsubscribe':
+                await self._leave(FEED_GROUP)
+            else:
+                await self._join(FEED_GROUP)
+
+        threads = content.get('threads')
+        for thread_id in threads if isinstance(threads, list) else []:
+            try:
+                thread_id = int(thread_id)
+            except (TypeError, ValueError):
+                continue
+            if action == 'unsubscribe':
+                self.threads.discard(thread_id)
+                await self._leave(thread_group(thread_id))
+            elif thread_id not in self.threads:
+                if len(self.threads) >= self.max_threads:
+                    await self.send_json({'type': 'error', 'detail': 'Too many subscriptions'})
+                    break
+                self.threads.add(thread_id)
+                await self._join(thread_group(thread_id))
+
+        await self.send_json({
+            'type': 'subscriptions',
+            'feed': FEED_GROUP in self.subscriptions,
+            'threads': sorted(self.threads),
+        })
+        if action == 'resume':
+            await self._replay(content.get('last_seq'), content.get('since'))
+
+    async def _replay(self, last_seq, since=None):
+        try:
+            events = await sync_to_async(broadcast.replay)(int(last_seq), set(self.subscriptions))
+        except Exception:
+            # Bad input or no Redis: either way the client has to catch up another way.
+            events = None
+        if events is None:
+            await self._send_changes(since)
+            return
+        for payload in events:
+            await self.send_json(payload)
+
+    async def _send_changes(self, since):
+        try:
+            changes = await sync_to_async(change_log.collect)(
+                int(since), threads=set(self.threads), feed=FEED_GROUP in self.subscriptions
+            )
+        except (TypeError, ValueError):
+            changes = None
+        if changes is None:
+            await self.send_json({'type': 'resync_required'})
+            return
+        await self.send_json({'type': 'changes', **changes})
+
+    async def _join(self, group):
+        if group in self.subscriptions:
+            return
+        self.subscriptions.add(group)
+        await self.channel_layer.group_add(group, self.channel_name)
+
+    async def _leave(self, group):
+        if group not in self.subscriptions:
+            return
+        self.subscriptions.discard(group)
+        await self.channel_layer.group_discard(group, self.channel_name)
 
     async def comment_event(self, event):
         payload = event.get('payload', {})
-        await self.send_json(payload)
\ No newline at end of file
+        await self.send_json(payload)
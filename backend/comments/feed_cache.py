@@ -0,0 +1,329 @@
+"""Versioned cache for the public comment feed.
+
+Entries are keyed by a generation number instead of being deleted: a write
+bumps the generation of the thread it touched (or of the feed when the set of
+root threads changes, or of the ranking when a root's votes move the pages
+ordered by score) and readers simply stop asking for the old keys, which then
+expire on their own. Rebuilds of a missing entry are single-flighted with
+a short lock so a burst of readers does not all hit the database at once.
+
+The cached payload is the anonymous one; signed-in users get it too, with
+their own votes and bookmarks merged in from a small per-user overlay.
+
+Every write also bumps a global change generation, which together with the
+user's overlay generation versions whatever a reader can see (``version``);
+the API turns it into ETag/Last-Modified for conditional GETs.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+
+FEED_GENERATION_KEY = 'comments:gen:feed'
+RANKING_GENERATION_KEY = 'comments:gen:ranking'
+CHANGE_GENERATION_KEY = 'comments:gen:all'
+CHANGED_AT_SUFFIX = ':at'
+THREAD_GENERATION_KEY = 'comments:gen:thread:{thread_id}'
+PAGE_KEY = 'comments:page:{generation}:{signature}'
+THREAD_KEY = 'comments:thread:{thread_id}:{generation}'
+USER_GENERATION_KEY = 'comments:gen:user:{user_id}'
+OVERLAY_KEY = 'comments:overlay:{user_id}:{generation}'
+LOCK_SUFFIX = ':lock'
+STATS_KEY = 'comments:stats:{name}'
+STATS = ('hit', 'miss', 'rebuild')
+
+PAGE_TIMEOUT = 60
+THREAD_TIMEOUT = 300
+OVERLAY_TIMEOUT = 600
+LOCK_TIMEOUT = 5
+LOCK_WAIT = 0.5
+LOCK_POLL_INTERVAL = 0.05
+
+
+def _initial_generation():
+    # Time based so a generation key that got evicted never restarts at a
+    # value whose entries might still be cached.
+    return int(time.time() * 1000)
+
+
+def _get_generation(key):
+    try:
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, _initial_generation(), timeout=None)
+            generation = cache.get(key)
+        return generation
+    except Exception:
+        return None
+
+
+def _bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        try:
+            cache.add(key, _initial_generation(), timeout=None)
+        except Exception:
+            pass
+    except Exception:
+        pass
+
+
+def _stamp(key):
+    # Written before the generation moves, so a reader never pairs a new
+    # generation with the previous change time.
+    try:
+        cache.set(key + CHANGED_AT_SUFFIX, time.time(), timeout=None)
+    except Exception:
+        pass
+
+
+def _changed_at(key, values):
+    stamp = values.get(key + CHANGED_AT_SUFFIX)
+    if stamp is None:
+        # Evicted: claim "changed now", which only costs clients a full response.
+        stamp = time.time()
+        try:
+            cache.add(key + CHANGED_AT_SUFFIX, stamp, timeout=None)
+        except Exception:
+            pass
+    return stamp
+
+
+def _record(name, amount=1):
+    if not amount:
+        return
+    key = STATS_KEY.format(name=name)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        try:
+            if not cache.add(key, amount, timeout=None):
+                cache.incr(key, amount)
+        except Exception:
+            pass
+    except Exception:
+        pass
+
+
+def stats():
+    try:
+        values = cache.get_many([STATS_KEY.format(name=name) for name in STATS])
+    except Exception:
+        values = {}
+    return {name: int(values.get(STATS_KEY.format(name=name)) or 0) for name in STATS}
+
+
+def mark_changed():
+    """Record a change visible to every reader without dropping any cached entry."""
+    _stamp(CHANGE_GENERATION_KEY)
+    _bump_generation(CHANGE_GENERATION_KEY)
+
+
+def invalidate_feed():
+    mark_changed()
+    _bump_generation(FEED_GENERATION_KEY)
+
+
+def invalidate_ranking():
+    """Drop the pages of vote-ordered listings: the counters of a root changed."""
+    mark_changed()
+    _bump_generation(RANKING_GENERATION_KEY)
+
+
+def invalidate_thread(thread_id):
+    if thread_id is not None:
+        mark_changed()
+        _bump_generation(THREAD_GENERATION_KEY.format(thread_id=thread_id))
+
+
+def invalidate_user(user_id):
+    key = USER_GENERATION_KEY.format(user_id=user_id)
+    _stamp(key)
+    _bump_generation(key)
+
+
+def version(user_id=None):
+    """``(tag, changed_at)`` for the comments as seen by ``user_id`` (None for anonymous).
+
+    ``tag`` changes with every write and ``changed_at`` is the time of the
+    latest one. Returns None when the cache is unavailable.
+    """
+    keys = [CHANGE_GENERATION_KEY]
+    if user_id is not None:
+        keys.append(USER_GENERATION_KEY.format(user_id=user_id))
+    try:
+        values = cache.get_many(keys + [key + CHANGED_AT_SUFFIX for key in keys])
+    except Exception:
+        return None
+
+    generations = []
+    for key in keys:
+        generation = values.get(key)
+        if generation is None:
+            generation = _get_generation(key)
+            if generation is None:
+                return None
+        generations.append(str(generation))
+    tag = generations[0] if user_id is None else f'{generations[0]}-{user_id}.{generations[1]}'
+    return tag, max(_changed_at(key, values) for key in keys)
+
+
+def page_signature(query_params):
+    encoded = '&'.join(f'{key}={value}' for key, value in sorted(query_params.items()))
+    return hashlib.md5(encoded.encode('utf-8')).hexdigest()
+
+
+def _acquire(key):
+    try:
+        return cache.add(key + LOCK_SUFFIX, 1, timeout=LOCK_TIMEOUT)
+    except Exception:
+        return True
+
+
+def _release(key):
+    try:
+        cache.delete(key + LOCK_SUFFIX)
+    except Exception:
+        pass
+
+
+def _wait_for(keys):
+    """Poll for entries another worker is rebuilding; return whatever showed up."""
+    found = {}
+    deadline = time.monotonic() + LOCK_WAIT
+    pending = list(keys)
+    while pending and time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            found.update(cache.get_many(pending))
+        except Exception:
+            break
+        pending = [key for key in pending if key not in found]
+    return found
+
+
+def get_page(signature, builder, ranked=False):
+    """Return the cached page entry for ``signature``, building it once on a miss.
+
+    ``ranked`` pages are ordered by vote counters and also follow the ranking
+    generation, which votes bump.
+    """
+    generation = _get_generation(FEED_GENERATION_KEY)
+    if ranked and generation is not None:
+        ranking = _get_generation(RANKING_GENERATION_KEY)
+        generation = None if ranking is None else f'{generation}.{ranking}'
+    if generation is None:
+        return builder()
+
+    key = PAGE_KEY.format(generation=generation, signature=signature)
+    try:
+        value = cache.get(key)
+    except Exception:
+        return builder()
+    if value is not None:
+        _record('hit')
+        return value
+
+    _record('miss')
+    locked = _acquire(key)
+    if not locked:
+        value = _wait_for([key]).get(key)
+        if value is not None:
+            return value
+
+    try:
+        value = builder()
+        _record('rebuild')
+        try:
+            cache.set(key, value, timeout=PAGE_TIMEOUT)
+        except Exception:
+            pass
+    finally:
+        if locked:
+            _release(key)
+    return value
+
+
+def get_threads(thread_ids, builder):
+    """Return ``{thread_id: payload}`` for ``thread_ids``.
+
+    ``builder`` receives the ids that were not cached and must return a dict
+    for them; it is called at most twice (threads we hold the lock for, then
+    whatever another worker failed to publish in time).
+    """
+    if not thread_ids:
+        return {}
+
+    generation_keys = {THREAD_GENERATION_KEY.format(thread_id=thread_id): thread_id for thread_id in thread_ids}
+    try:
+        generations = cache.get_many(list(generation_keys))
+    except Exception:
+        return builder(list(thread_ids))
+
+    keys = {}
+    for generation_key, thread_id in generation_keys.items():
+        generation = generations.get(generation_key)
+        if generation is None:
+            generation = _get_generation(generation_key)
+        keys[thread_id] = THREAD_KEY.format(thread_id=thread_id, generation=generation)
+
+    try:
+        cached = cache.get_many(list(keys.values()))
+    except Exception:
+        cached = {}
+
+    result = {thread_id: cached[key] for thread_id, key in keys.items() if key in cached}
+    missing = [thread_id for thread_id in thread_ids if thread_id not in result]
+    _record('hit', len(result))
+    _record('miss', len(missing))
+    if not missing:
+        return result
+
+    locked = [thread_id for thread_id in missing if _acquire(keys[thread_id])]
+    contended = [thread_id for thread_id in missing if thread_id not in locked]
+
+    try:
+        built = builder(locked) if locked else {}
+        if contended:
+            waited = _wait_for([keys[thread_id] for thread_id in contended])
+            for thread_id in contended:
+                if keys[thread_id] in waited:
+                    result[thread_id] = waited[keys[thread_id]]
+            late = [thread_id for thread_id in contended if thread_id not in result]
+            if late:
+                built.update(builder(late))
+
+        _record('rebuild', len(built))
+        try:
+            cache.set_many({keys[thread_id]: payload for thread_id, payload in built.items()}, timeout=THREAD_TIMEOUT)
+        except Exception:
+            pass
+    finally:
+        for thread_id in locked:
+            _release(keys[thread_id])
+
+    result.update(built)
+    return result
+
+
+def get_overlay(user_id, builder):
+    """Return the user's ``{'votes': {comment_id: value}, 'bookmarks': set}`` overlay."""
+    generation = _get_generation(USER_GENERATION_KEY.format(user_id=user_id))
+    if generation is None:
+        return builder()
+
+    key = OVERLAY_KEY.format(user_id=user_id, generation=generation)
+    try:
+        value = cache.get(key)
+    except Exception:
+        return builder()
+    if value is not None:
+        return value
+
+    value = builder()
+    try:
+        cache.set(key, value, timeout=OVERLAY_TIMEOUT)
+    except Exception:
+        pass
+    return value
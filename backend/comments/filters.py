@@ -0,0 +1,72 @@
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+TRUE_VALUES = {'1', 'true', 'yes'}
+FALSE_VALUES = {'0', 'false', 'no'}
+
+
+def filter_comments(queryset, params):
+    """Apply the listing filters from ``params``: ``user``, ``has_attachment``,
+    ``created_after`` and ``created_before`` (both inclusive).
+    """
+    errors = {}
+
+    user = params.get('user')
+    if user:
+        try:
+            queryset = queryset.filter(user_id=int(user))
+        except ValueError:
+            errors['user'] = ['Некорректный пользователь']
+
+    has_attachment = (params.get('has_attachment') or '').lower()
+    if has_attachment:
+        without_attachment = Q(attachment='') | Q(attachment__isnull=True)
+        if has_attachment in TRUE_VALUES:
+            queryset = queryset.exclude(without_attachment)
+        elif has_attachment in FALSE_VALUES:
+            queryset = queryset.filter(without_attachment)
+        else:
+            errors['has_attachment'] = ['Ожидается true или false']
+
+    # Lookups for a datetime bound and for a plain date one.
+    for param, moment_lookup, day_lookup, day_offset in (
+        ('created_after', 'created_at__gte', 'created_at__gte', 0),
+        ('created_before', 'created_at__lte', 'created_at__lt', 1),
+    ):
+        value = params.get(param)
+        if not value:
+            continue
+        bound = _parse_bound(value, day_offset)
+        if bound is None:
+            errors[param] = ['Некорректная дата']
+        else:
+            moment, is_day = bound
+            queryset = queryset.filter(**{day_lookup if is_day else moment_lookup: moment})
+
+    if errors:
+        raise ValidationError(errors)
+    return queryset
+
+
+def _parse_bound(value, day_offset):
+    """``(moment, is_day)`` for ``value``, or None when it is not a date or datetime.
+
+    A plain date covers the whole day, so ``created_before`` moves to the
+    start of the next one, compared exclusively. Compared as a range to keep
+    the index usable.
+    """
+    try:
+        # Checked first: parse_datetime also reads a bare date, as midnight.
+        day = parse_date(value)
+        if day is not None:
+            return timezone.make_aware(datetime.combine(day + timedelta(days=day_offset), time.min)), True
+        moment = parse_datetime(value)
+    except ValueError:
+        return None
+    if moment is None:
+        return None
+    return (moment if timezone.is_aware(moment) else timezone.make_aware(moment)), False
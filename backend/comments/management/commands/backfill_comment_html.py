@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from comments.models import Comment
+
+
+class Command(BaseCommand):
+    help = 'Fill text_html/text_excerpt/text_plain on comments saved before they were rendered at write time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Re-render every comment, e.g. after the sanitizer allowlist changed.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Comment.objects.all() if options['all'] else Comment.objects.filter(text_html='')
+        rendered = 0
+        last_pk = 0
+
+        while True:
+            batch = list(
+                queryset.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .only('pk', 'text', 'text_html', 'text_excerpt', 'text_plain')[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            for comment in batch:
+                comment.render_text()
+            with transaction.atomic():
+                Comment.objects.bulk_update(batch, ['text_html', 'text_excerpt', 'text_plain'])
+            rendered += len(batch)
+            self.stdout.write(f'Rendered {rendered} comments (up to id {last_pk})')
+
+        self.stdout.write(self.style.SUCCESS(f'Rendered {rendered} comments'))
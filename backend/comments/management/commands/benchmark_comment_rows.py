@@ -0,0 +1,67 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import BooleanField, IntegerField, Value
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from comments.models import Comment
+from comments.renderers import FastJSONRenderer
+from comments.serializers import COMMENT_ROW_FIELDS, CommentSerializer, serialize_comment_rows
+
+
+class Command(BaseCommand):
+    help = 'Compare CommentSerializer against serialize_comment_rows on generated comments (rolled back afterwards).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        # URLs are built against a real host so build_absolute_uri passes ALLOWED_HOSTS.
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        request = Request(APIRequestFactory().get('/api/comments/', HTTP_HOST=host))
+
+        with transaction.atomic():
+            Comment.objects.bulk_create(
+                Comment(
+                    user_name=f'user{i}',
+                    email=f'user{i}@example.com',
+                    text=f'<strong>comment</strong> {i}',
+                    text_html=f'<strong>comment</strong> {i}',
+                    text_excerpt=f'comment {i}',
+                    attachment=f'attachments/file{i}.png' if i % 4 == 0 else None,
+                )
+                for i in range(rows)
+            )
+            queryset = Comment.objects.annotate(
+                user_vote=Value(0, output_field=IntegerField()),
+                is_bookmarked=Value(False, output_field=BooleanField()),
+            ).order_by('pk')
+
+            def serializer_path():
+                data = CommentSerializer(list(queryset), many=True, context={'request': request}).data
+                return JSONRenderer().render(data)
+
+            def rows_path():
+                data = serialize_comment_rows(queryset.values(*COMMENT_ROW_FIELDS), request)
+                return FastJSONRenderer().render(data)
+
+            if json.loads(serializer_path()) != json.loads(rows_path()):
+                self.stderr.write(self.style.ERROR('Outputs differ'))
+
+            for name, func in (('CommentSerializer', serializer_path), ('serialize_comment_rows', rows_path)):
+                best = min(self._time(func) for _ in range(repeat))
+                self.stdout.write(f'{name:<24} {rows} rows  {best * 1000:8.1f} ms')
+
+            transaction.set_rollback(True)
+
+    def _time(self, func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
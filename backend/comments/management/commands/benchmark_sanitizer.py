@@ -0,0 +1,32 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from comments.sanitizer import cleaner, sanitize
+
+PAYLOADS = {
+    'short plain': 'Спасибо, отличная статья! 5 > 4.',
+    'long plain': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 1500,
+    'allowed markup': (
+        '<strong>Важно:</strong> см. <a href="https://example.com/docs?page=2" title="docs">документацию</a>, '
+        'особенно <code>validate_text</code> и <i>примеры</i>. ' * 40
+    ),
+    'ambiguous markup': '<i>a<strong>b</i>c</strong> &nbsp; &copy; ' * 40,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare sanitize() against a plain bleach clean on representative comment payloads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200, help='Calls per payload and implementation.')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        for name, payload in PAYLOADS.items():
+            bleach_time = min(timeit.repeat(lambda: cleaner.clean(payload), number=number, repeat=3)) / number
+            fast_time = min(timeit.repeat(lambda: sanitize(payload), number=number, repeat=3)) / number
+            self.stdout.write(
+                f'{name:<18} {len(payload):>7} chars  bleach {bleach_time * 1e6:>9.1f} us  '
+                f'sanitize {fast_time * 1e6:>9.1f} us  x{bleach_time / fast_time:.1f}'
+            )
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+from comments import feed_cache
+from comments.models import Comment, CommentChange, CommentVote
+
+
+class Command(BaseCommand):
+    help = 'Recompute score/upvotes/downvotes on comments from CommentVote rows and fix any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report drifted comments, do not write anything.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        check_only = options['check']
+        scanned = drifted = 0
+        last_pk = 0
+
+        while True:
+            batch = list(
+                Comment.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .only('pk', 'thread_id', 'score', 'upvotes', 'downvotes')
+                .annotate(
+                    actual_score=Coalesce(Sum('votes__value'), Value(0), output_field=IntegerField()),
+                    actual_upvotes=Count('votes', filter=Q(votes__value=CommentVote.UPVOTE)),
+                    actual_downvotes=Count('votes', filter=Q(votes__value=CommentVote.DOWNVOTE)),
+                )[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            scanned += len(batch)
+
+            stale = []
+            for comment in batch:
+                actual = (comment.actual_score, comment.actual_upvotes, comment.actual_downvotes)
+                if (comment.score, comment.upvotes, comment.downvotes) == actual:
+                    continue
+                self.stdout.write(
+                    f'Comment {comment.pk}: stored {comment.score}/+{comment.upvotes}/-{comment.downvotes}, '
+                    f'actual {actual[0]}/+{actual[1]}/-{actual[2]}'
+                )
+                stale.append(comment)
+
+            drifted += len(stale)
+            if stale and not check_only:
+                # Recount in the UPDATE itself rather than writing the values
+                # read above, so votes cast in between are not lost.
+                with transaction.atomic():
+                    Comment.objects.recount_votes([comment.pk for comment in stale])
+                    CommentChange.objects.record(
+                        CommentChange.UPDATED, [(comment.pk, comment.thread_id) for comment in stale]
+                    )
+                for thread_id in {comment.thread_id for comment in stale}:
+                    feed_cache.invalidate_thread(thread_id)
+                feed_cache.invalidate_feed()
+
+        verb = 'found' if check_only else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'Scanned {scanned} comments, {verb} {drifted} with drifted counters'))
@@ -0,0 +1,65 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+SEGMENT_WIDTH = 10
+BATCH_SIZE = 500
+
+
+def build_thread_index(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+
+    level = []
+    for comment in Comment.objects.filter(parent__isnull=True).only('pk').iterator():
+        comment.path = f'{comment.pk:0{SEGMENT_WIDTH}d}'
+        comment.depth = 0
+        comment.thread_id = comment.pk
+        level.append(comment)
+
+    while level:
+        Comment.objects.bulk_update(level, ['path', 'depth', 'thread'], batch_size=BATCH_SIZE)
+        parents = {comment.pk: comment for comment in level}
+        parent_ids = list(parents)
+        level = []
+        for start in range(0, len(parent_ids), BATCH_SIZE):
+            chunk = parent_ids[start:start + BATCH_SIZE]
+            for comment in Comment.objects.filter(parent_id__in=chunk).only('pk', 'parent_id'):
+                parent = parents[comment.parent_id]
+                comment.path = f'{parent.path}{comment.pk:0{SEGMENT_WIDTH}d}'
+                comment.depth = parent.depth + 1
+                comment.thread_id = parent.thread_id
+                level.append(comment)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_commentvote_commentbookmark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, editable=False, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='thread',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_comments', to='comments.comment'),
+        ),
+        migrations.RunPython(build_thread_index, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['thread', 'path'], name='comment_thread_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['path'], name='comment_path_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_vote_counters(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    voted = (
+        Comment.objects.filter(votes__isnull=False)
+        .annotate(
+            total=Coalesce(Sum('votes__value'), Value(0), output_field=IntegerField()),
+            up=Count('votes', filter=Q(votes__value=1)),
+            down=Count('votes', filter=Q(votes__value=-1)),
+        )
+    )
+    batch = []
+    for comment in voted.iterator():
+        comment.score, comment.upvotes, comment.downvotes = comment.total, comment.up, comment.down
+        batch.append(comment)
+        if len(batch) >= 500:
+            Comment.objects.bulk_update(batch, ['score', 'upvotes', 'downvotes'])
+            batch = []
+    if batch:
+        Comment.objects.bulk_update(batch, ['score', 'upvotes', 'downvotes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0005_comment_thread_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvotes',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvotes',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_vote_counters, migrations.RunPython.noop),
+    ]
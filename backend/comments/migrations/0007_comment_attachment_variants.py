@@ -0,0 +1,52 @@
+from django.db import migrations, models
+
+
+def mark_existing_ready(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    Comment.objects.exclude(attachment_type='').update(attachment_status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0006_comment_vote_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_preview',
+            field=models.FileField(blank=True, null=True, upload_to='attachments/variants/'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_preview_height',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_preview_width',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_status',
+            field=models.CharField(blank=True, choices=[('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=20),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_thumbnail',
+            field=models.FileField(blank=True, null=True, upload_to='attachments/variants/'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_thumbnail_height',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_thumbnail_width',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_existing_ready, migrations.RunPython.noop),
+    ]
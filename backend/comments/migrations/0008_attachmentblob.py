@@ -0,0 +1,84 @@
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_blobs(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    AttachmentBlob = apps.get_model('comments', 'AttachmentBlob')
+
+    comments = Comment.objects.exclude(attachment='').exclude(attachment__isnull=True).order_by('pk')
+    for comment in comments.iterator():
+        hasher = hashlib.sha256()
+        try:
+            with comment.attachment.open('rb') as file:
+                for chunk in file.chunks():
+                    hasher.update(chunk)
+        except OSError:
+            # Missing on disk: leave the comment without a blob.
+            continue
+
+        blob, created = AttachmentBlob.objects.get_or_create(
+            sha256=hasher.hexdigest(),
+            defaults={
+                'file': comment.attachment.name,
+                'type': comment.attachment_type,
+                'size': comment.attachment_size,
+                'width': comment.attachment_width,
+                'height': comment.attachment_height,
+                'text_preview': comment.attachment_text_preview,
+                'status': comment.attachment_status,
+                'thumbnail': comment.attachment_thumbnail.name or None,
+                'thumbnail_width': comment.attachment_thumbnail_width,
+                'thumbnail_height': comment.attachment_thumbnail_height,
+                'preview': comment.attachment_preview.name or None,
+                'preview_width': comment.attachment_preview_width,
+                'preview_height': comment.attachment_preview_height,
+            },
+        )
+        AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=models.F('ref_count') + 1)
+        Comment.objects.filter(pk=comment.pk).update(
+            attachment_blob=blob,
+            attachment=blob.file.name,
+            attachment_thumbnail=blob.thumbnail.name or None,
+            attachment_preview=blob.preview.name or None,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0007_comment_attachment_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to='attachments/')),
+                ('type', models.CharField(blank=True, max_length=20)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('width', models.PositiveIntegerField(default=0)),
+                ('height', models.PositiveIntegerField(default=0)),
+                ('text_preview', models.TextField(blank=True)),
+                ('status', models.CharField(blank=True, max_length=20)),
+                ('thumbnail', models.FileField(blank=True, null=True, upload_to='attachments/variants/')),
+                ('thumbnail_width', models.PositiveIntegerField(default=0)),
+                ('thumbnail_height', models.PositiveIntegerField(default=0)),
+                ('preview', models.FileField(blank=True, null=True, upload_to='attachments/variants/')),
+                ('preview_width', models.PositiveIntegerField(default=0)),
+                ('preview_height', models.PositiveIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='attachment_blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='comments', to='comments.attachmentblob'),
+        ),
+        migrations.RunPython(backfill_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# PostgreSQL only: the SQLite FTS5 index is (re)installed after every migrate
+# by comments.search.ensure_sqlite_index, because SQLite table rebuilds in
+# later migrations drop its triggers.
+
+POSTGRESQL_FORWARD = [
+    "ALTER TABLE comments_comment ADD COLUMN search_vector tsvector",
+    """
+    CREATE FUNCTION comments_comment_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.user_name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.text, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(NEW.attachment_text_preview, '')), 'C');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER comments_comment_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF user_name, text, attachment_text_preview ON comments_comment
+    FOR EACH ROW EXECUTE FUNCTION comments_comment_search_vector()
+    """,
+    """
+    UPDATE comments_comment SET search_vector =
+        setweight(to_tsvector('simple', coalesce(user_name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(text, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(attachment_text_preview, '')), 'C')
+    """,
+    "CREATE INDEX comment_search_vector_idx ON comments_comment USING GIN (search_vector)",
+]
+
+POSTGRESQL_REVERSE = [
+    "DROP TRIGGER IF EXISTS comments_comment_search_vector_trigger ON comments_comment",
+    "DROP FUNCTION IF EXISTS comments_comment_search_vector()",
+    "DROP INDEX IF EXISTS comment_search_vector_idx",
+    "ALTER TABLE comments_comment DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def add_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRESQL_FORWARD:
+            schema_editor.execute(statement)
+
+
+def remove_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRESQL_REVERSE:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0009_comment_root_ordering_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_vector, remove_search_vector),
+    ]
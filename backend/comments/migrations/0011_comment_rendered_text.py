@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+from comments.sanitizer import excerpt, render_html
+
+BATCH_SIZE = 1000
+
+
+def render_text(apps, schema_editor):
+    # Existing comments get the same rendering as new ones; the
+    # backfill_comment_html command redoes it after allowlist changes.
+    Comment = apps.get_model('comments', 'Comment')
+    last_pk = 0
+    while True:
+        batch = list(Comment.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'text')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for comment in batch:
+            comment.text_html = render_html(comment.text)
+            comment.text_excerpt = excerpt(comment.text)
+        Comment.objects.bulk_update(batch, ['text_html', 'text_excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0010_comment_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='text_excerpt',
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(render_text, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+import math
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+
+# comments.models.hot_rank as of this migration.
+HOT_RANK_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+HOT_RANK_PERIOD = 45000
+
+
+def hot_rank(score, created_at):
+    order = math.log10(max(abs(score), 1))
+    sign = (score > 0) - (score < 0)
+    return round(sign * order + (created_at - HOT_RANK_EPOCH).total_seconds() / HOT_RANK_PERIOD, 7)
+
+
+def backfill_hot_rank(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    batch = []
+    for pk, score, created_at in Comment.objects.values_list('pk', 'score', 'created_at').iterator(chunk_size=1000):
+        batch.append(Comment(pk=pk, hot_rank=hot_rank(score, created_at)))
+        if len(batch) >= 1000:
+            Comment.objects.bulk_update(batch, ['hot_rank'])
+            batch = []
+    if batch:
+        Comment.objects.bulk_update(batch, ['hot_rank'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0011_comment_rendered_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='hot_rank',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_hot_rank, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent', 'hot_rank', 'id'], name='comment_root_hot_idx'),
+        ),
+    ]
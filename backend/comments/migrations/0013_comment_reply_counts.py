@@ -0,0 +1,42 @@
+from collections import Counter
+
+from django.db import migrations, models
+
+PATH_SEGMENT_WIDTH = 10
+
+
+def backfill_reply_counts(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    replies, descendants = Counter(), Counter()
+    for parent_id, path in Comment.objects.values_list('parent_id', 'path').iterator(chunk_size=2000):
+        if parent_id is not None:
+            replies[parent_id] += 1
+        for i in range(0, len(path) - PATH_SEGMENT_WIDTH, PATH_SEGMENT_WIDTH):
+            descendants[int(path[i:i + PATH_SEGMENT_WIDTH])] += 1
+
+    batch = [
+        Comment(pk=pk, reply_count=replies[pk], descendant_count=descendants[pk])
+        for pk in set(replies) | set(descendants)
+    ]
+    Comment.objects.bulk_update(batch, ['reply_count', 'descendant_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0012_comment_hot_rank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_reply_counts, migrations.RunPython.noop),
+    ]
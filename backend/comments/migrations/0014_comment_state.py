@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0013_comment_reply_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='state',
+            field=models.CharField(
+                choices=[('active', 'Active'), ('deleting', 'Deleting')],
+                default='active',
+                editable=False,
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0014_comment_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='state',
+            field=models.CharField(
+                choices=[('active', 'Active'), ('deleting', 'Deleting'), ('deleted', 'Deleted')],
+                default='active',
+                editable=False,
+                max_length=20,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['state', 'reply_count'], name='comment_state_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0015_comment_state_deleted'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('comment_id', models.BigIntegerField()),
+                ('thread_id', models.BigIntegerField(null=True)),
+                ('kind', models.CharField(
+                    choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')],
+                    max_length=10,
+                )),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
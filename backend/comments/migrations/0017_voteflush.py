@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0016_commentchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteFlush',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
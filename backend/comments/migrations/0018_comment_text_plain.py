@@ -0,0 +1,97 @@
+from django.db import migrations, models
+
+from comments.sanitizer import plain_text
+
+# The search index moves from the raw ``text`` markup to ``text_plain``, so tag
+# names and attribute values no longer match. On SQLite the FTS5 table and its
+# triggers are dropped first (adding the column rebuilds the table) and are
+# reinstalled with the new column, then rebuilt, by
+# comments.search.ensure_sqlite_index after migrate.
+
+BATCH_SIZE = 1000
+
+
+def search_vector_function(column):
+    return f"""
+    CREATE OR REPLACE FUNCTION comments_comment_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.user_name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.{column}, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(NEW.attachment_text_preview, '')), 'C');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """
+
+
+def search_vector_trigger(column):
+    return [
+        "DROP TRIGGER IF EXISTS comments_comment_search_vector_trigger ON comments_comment",
+        f"""
+        CREATE TRIGGER comments_comment_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF user_name, {column}, attachment_text_preview ON comments_comment
+        FOR EACH ROW EXECUTE FUNCTION comments_comment_search_vector()
+        """,
+        f"""
+        UPDATE comments_comment SET search_vector =
+            setweight(to_tsvector('simple', coalesce(user_name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce({column}, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(attachment_text_preview, '')), 'C')
+        """,
+    ]
+
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS comments_comment_fts_insert",
+    "DROP TRIGGER IF EXISTS comments_comment_fts_delete",
+    "DROP TRIGGER IF EXISTS comments_comment_fts_update",
+    "DROP TABLE IF EXISTS comments_comment_fts",
+]
+
+
+def fill_text_plain(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    last_pk = 0
+    while True:
+        batch = list(Comment.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'text')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for comment in batch:
+            comment.text_plain = plain_text(comment.text)
+        Comment.objects.bulk_update(batch, ['text_plain'])
+
+
+def drop_sqlite_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SQLITE_DROP:
+            schema_editor.execute(statement)
+
+
+def index_column(column):
+    def reindex(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for statement in [search_vector_function(column), *search_vector_trigger(column)]:
+                schema_editor.execute(statement)
+        else:
+            drop_sqlite_index(apps, schema_editor)
+    return reindex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0017_voteflush'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_sqlite_index, drop_sqlite_index),
+        migrations.AddField(
+            model_name='comment',
+            name='text_plain',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_text_plain, migrations.RunPython.noop),
+        migrations.RunPython(index_column('text_plain'), index_column('text')),
+    ]
@@ -1,8 +1,325 @@
-from django.db import models
+import math
+from datetime import datetime, timezone
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Concat, Lower, Substr
 from django.contrib.auth.models import User
 
+from .sanitizer import excerpt, plain_text, render_html
+
+
+PATH_SEGMENT_WIDTH = 10
+# ``path`` holds one segment per level, so replies nest at most MAX_DEPTH
+# levels below the root and the column is sized for that.
+MAX_DEPTH = 99
+PATH_MAX_LENGTH = (MAX_DEPTH + 1) * PATH_SEGMENT_WIDTH
+
+# ``hot_rank``: ten times the score is worth HOT_RANK_PERIOD more seconds of
+# recency. Newer comments rank higher by construction, so the stored rank only
+# changes with the score and needs no rescoring as time passes.
+HOT_RANK_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+HOT_RANK_PERIOD = 45000
+
+
+def path_segment(pk: int) -> str:
+    return f'{pk:0{PATH_SEGMENT_WIDTH}d}'
+
+
+def path_ancestor_ids(path: str):
+    """Ids of the comments above ``path``, from the thread root down to the parent."""
+    return [
+        int(path[i:i + PATH_SEGMENT_WIDTH])
+        for i in range(0, len(path) - PATH_SEGMENT_WIDTH, PATH_SEGMENT_WIDTH)
+    ]
+
+
+def hot_rank(score: int, created_at) -> float:
+    order = math.log10(max(abs(score), 1))
+    sign = (score > 0) - (score < 0)
+    return round(sign * order + (created_at - HOT_RANK_EPOCH).total_seconds() / HOT_RANK_PERIOD, 7)
+
+
+def subtree_upper_bound(path: str) -> str:
+    """Smallest path that sorts after every descendant of ``path``."""
+    head, last = path[:-PATH_SEGMENT_WIDTH], path[-PATH_SEGMENT_WIDTH:]
+    return head + path_segment(int(last) + 1)
+
+
+class CommentQuerySet(models.QuerySet):
+    def subtree(self, path: str, include_self: bool = True):
+        lookup = 'path__gte' if include_self else 'path__gt'
+        return self.filter(**{lookup: path, 'path__lt': subtree_upper_bound(path)}).order_by('path')
+
+    def subtree_depth(self, path: str) -> int:
+        """Depth of the deepest comment in the subtree at ``path``."""
+        return self.subtree(path).aggregate(depth=Max('depth'))['depth']
+
+    def threads(self, thread_ids):
+        return self.filter(thread_id__in=thread_ids).order_by('path')
+
+    def visible(self):
+        """Without soft-deleted leaves: they hold no replies and wait for compaction.
+
+        Hidden comments are not part of their ancestors' ``reply_count`` and
+        ``descendant_count`` either; see ``release_tombstone``.
+        """
+        return self.exclude(state=Comment.STATE_DELETED, reply_count=0)
+
+    def shift_ancestor_counts(self, path: str, size: int):
+        """Account for a subtree of ``size`` comments rooted at ``path`` being
+        attached under its parent (``size`` > 0) or detached from it (< 0).
+        """
+        ancestors = path_ancestor_ids(path)
+        if not ancestors or not size:
+            return 0
+        updated = self._shift_counts(ancestors, size)
+        if size < 0:
+            # The parent may be a tombstone that just lost its last reply.
+            self.release_tombstone(ancestors[-1])
+        return updated
+
+    def release_tombstone(self, comment_id: int):
+        """Take ``comment_id`` off its ancestors' counts if it is a soft-deleted
+        comment without replies, which hides it, and repeat for the parent it
+        leaves in the same state. Returns the released ids, deepest first.
+        """
+        released = []
+        while comment_id is not None:
+            path = self.filter(
+                pk=comment_id, state=Comment.STATE_DELETED, reply_count=0
+            ).values_list('path', flat=True).first()
+            if path is None:
+                break
+            released.append(comment_id)
+            ancestors = path_ancestor_ids(path)
+            if not ancestors:
+                break
+            self._shift_counts(ancestors, -1)
+            comment_id = ancestors[-1]
+        return released
+
+    def _shift_counts(self, ancestors, size):
+        return self.filter(pk__in=ancestors).update(
+            descendant_count=F('descendant_count') + size,
+            reply_count=F('reply_count') + Case(
+                When(pk=ancestors[-1], then=Value(1 if size > 0 else -1)),
+                default=Value(0),
+            ),
+        )
+
+    def apply_vote_change(self, comment_id: int, previous: int, current: int):
+        """Shift the denormalized vote counters from ``previous`` to ``current`` (0 = no vote)."""
+        return self.apply_vote_changes({comment_id: (previous, current)})
+
+    def apply_vote_changes(self, changes):
+        """``apply_vote_change`` for many comments: ``{comment_id: (previous, current)}``.
+
+        Comments whose counters move by the same amounts share one UPDATE, so
+        this issues at most a handful of queries however many comments change.
+        """
+        by_delta = {}
+        for comment_id, (previous, current) in changes.items():
+            if previous == current:
+                continue
+            delta = (
+                current - previous,
+                int(current == CommentVote.UPVOTE) - int(previous == CommentVote.UPVOTE),
+                int(current == CommentVote.DOWNVOTE) - int(previous == CommentVote.DOWNVOTE),
+            )
+            by_delta.setdefault(delta, []).append(comment_id)
+
+        updated = 0
+        for (score, upvotes, downvotes), comment_ids in by_delta.items():
+            updated += self.filter(pk__in=comment_ids).update(
+                score=F('score') + score,
+                upvotes=F('upvotes') + upvotes,
+                downvotes=F('downvotes') + downvotes,
+            )
+        if by_delta:
+            self.filter(pk__in=[pk for comment_ids in by_delta.values() for pk in comment_ids]).refresh_hot_ranks()
+        return updated
+
+    def recount_votes(self, comment_ids):
+        """Set the vote counters of ``comment_ids`` from their ``CommentVote`` rows.
+
+        Unlike ``apply_vote_changes`` this is idempotent, which is what the
+        vote buffer needs when it replays a batch.
+        """
+        votes = CommentVote.objects.filter(comment=OuterRef('pk')).order_by().values('comment')
+
+        def total(aggregate):
+            return Coalesce(Subquery(votes.annotate(total=aggregate).values('total')), 0)
+
+        updated = self.filter(pk__in=comment_ids).update(
+            score=total(Sum('value')),
+            upvotes=total(Count('pk', filter=Q(value=CommentVote.UPVOTE))),
+            downvotes=total(Count('pk', filter=Q(value=CommentVote.DOWNVOTE))),
+        )
+        self.filter(pk__in=comment_ids).refresh_hot_ranks()
+        return updated
+
+    def refresh_hot_ranks(self, batch_size: int = 1000):
+        """Recompute ``hot_rank`` from the stored score, writing only the rows that changed."""
+        rows = self.order_by().values_list('pk', 'score', 'created_at', 'hot_rank')
+        changed = []
+        for pk, score, created_at, current in rows.iterator(chunk_size=batch_size):
+            rank = hot_rank(score, created_at)
+            if rank != current:
+                changed.append(Comment(pk=pk, hot_rank=rank))
+        Comment.objects.bulk_update(changed, ['hot_rank'], batch_size=batch_size)
+        return len(changed)
+
+
+class AttachmentBlobQuerySet(models.QuerySet):
+    def acquire(self, sha256: str, build):
+        """Take a reference on the blob stored for ``sha256``.
+
+        An existing blob is reused as is; otherwise one is created from the
+        field values returned by ``build()``. A blob whose processing failed
+        is refilled from ``build()`` instead, so the upload is processed again.
+        """
+        while True:
+            blob = self.filter(sha256=sha256).first()
+            if blob is not None and blob.status == Comment.ATTACHMENT_FAILED:
+                blob = self._retry(blob.pk, build)
+                if blob is not None:
+                    return blob
+                continue
+            if blob is not None:
+                # Conditional on the row still existing: the collector may
+                # have removed it since the lookup.
+                if self.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1):
+                    blob.ref_count += 1
+                    return blob
+                continue
+
+            blob = self.model(sha256=sha256, ref_count=1, **build())
+            try:
+                with transaction.atomic():
+                    blob.save()
+            except IntegrityError:
+                # Lost the race to a concurrent upload of the same content.
+                blob.file.delete(save=False)
+                continue
+            return blob
+
+    def _retry(self, blob_id: int, build):
+        # Locked so concurrent uploads of the same content refill it once;
+        # the later ones find it processing and just take a reference.
+        with transaction.atomic():
+            blob = self.select_for_update().filter(pk=blob_id).first()
+            if blob is None:
+                return None
+            if blob.status == Comment.ATTACHMENT_FAILED:
+                for name, value in build().items():
+                    setattr(blob, name, value)
+            blob.ref_count += 1
+            blob.save()
+        return blob
+
+    def release(self, blob_id: int):
+        return self.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+
+    def orphaned(self):
+        return self.filter(ref_count__lte=0).exclude(
+            models.Exists(Comment.objects.filter(attachment_blob=models.OuterRef('pk')))
+        )
+
+
+class AttachmentBlob(models.Model):
+    """An attachment stored once per distinct content and shared by every comment that uploads it."""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='attachments/')
+    type = models.CharField(max_length=20, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+    text_preview = models.TextField(blank=True)
+    status = models.CharField(max_length=20, blank=True)
+    thumbnail = models.FileField(upload_to='attachments/variants/', null=True, blank=True)
+    thumbnail_width = models.PositiveIntegerField(default=0)
+    thumbnail_height = models.PositiveIntegerField(default=0)
+    preview = models.FileField(upload_to='attachments/variants/', null=True, blank=True)
+    preview_width = models.PositiveIntegerField(default=0)
+    preview_height = models.PositiveIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = AttachmentBlobQuerySet.as_manager()
+
+    def __str__(self):
+        return f"Blob({self.sha256[:12]}, refs={self.ref_count})"
+
+    def comment_fields(self):
+        """The blob's metadata as the denormalized ``Comment.attachment_*`` values."""
+        return {
+            'attachment': self.file.name or None,
+            'attachment_type': self.type,
+            'attachment_size': self.size,
+            'attachment_width': self.width,
+            'attachment_height': self.height,
+            'attachment_text_preview': self.text_preview,
+            'attachment_status': self.status,
+            'attachment_thumbnail': self.thumbnail.name or None,
+            'attachment_thumbnail_width': self.thumbnail_width,
+            'attachment_thumbnail_height': self.thumbnail_height,
+            'attachment_preview': self.preview.name or None,
+            'attachment_preview_width': self.preview_width,
+            'attachment_preview_height': self.preview_height,
+        }
+
+    def delete_files(self):
+        for field in (self.file, self.thumbnail, self.preview):
+            if field:
+                field.delete(save=False)
+
 
 class Comment(models.Model):
+    ATTACHMENT_PROCESSING = 'processing'
+    ATTACHMENT_READY = 'ready'
+    ATTACHMENT_FAILED = 'failed'
+    ATTACHMENT_STATUS_CHOICES = (
+        (ATTACHMENT_PROCESSING, 'Processing'),
+        (ATTACHMENT_READY, 'Ready'),
+        (ATTACHMENT_FAILED, 'Failed'),
+    )
+    STATE_ACTIVE = 'active'
+    STATE_DELETING = 'deleting'
+    STATE_DELETED = 'deleted'
+    STATE_CHOICES = (
+        (STATE_ACTIVE, 'Active'),
+        (STATE_DELETING, 'Deleting'),
+        (STATE_DELETED, 'Deleted'),
+    )
+    # What is left of a comment that is gone but still holds a place in the
+    # tree: no author, text or attachment.
+    TOMBSTONE_FIELDS = {
+        'user': None,
+        'user_name': '',
+        'email': '',
+        'home_page': None,
+        'text': '',
+        'text_html': '',
+        'text_excerpt': '',
+        'text_plain': '',
+        'attachment': None,
+        'attachment_name': '',
+        'attachment_type': '',
+        'attachment_size': 0,
+        'attachment_width': 0,
+        'attachment_height': 0,
+        'attachment_text_preview': '',
+        'attachment_status': '',
+        'attachment_thumbnail': None,
+        'attachment_thumbnail_width': 0,
+        'attachment_thumbnail_height': 0,
+        'attachment_preview': None,
+        'attachment_preview_width': 0,
+        'attachment_preview_height': 0,
+    }
+
     user = models.ForeignKey(
         User,
         on_delete=models.SET_NULL,
@@ -14,6 +331,11 @@ class Comment(models.Model):
     email = models.EmailField()
     home_page = models.URLField(blank=True, null=True)
     text = models.TextField()
+    # Rendered from ``text`` on every save: safe to serve as is.
+    text_html = models.TextField(blank=True, editable=False)
+    text_excerpt = models.CharField(max_length=200, blank=True, editable=False)
+    # What the full-text index sees: ``text`` without its markup.
+    text_plain = models.TextField(blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     parent = models.ForeignKey(
         'self',
@@ -23,16 +345,146 @@ class Comment(models.Model):
         on_delete=models.CASCADE
     )
     attachment = models.FileField(upload_to='attachments/', null=True, blank=True)
+    # The attachment_* fields below mirror this blob so reads never need the join.
+    attachment_blob = models.ForeignKey(
+        AttachmentBlob,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='comments',
+        on_delete=models.PROTECT
+    )
     attachment_name = models.CharField(max_length=255, blank=True)
     attachment_type = models.CharField(max_length=20, blank=True)
     attachment_size = models.PositiveIntegerField(default=0)
     attachment_width = models.PositiveIntegerField(default=0)
     attachment_height = models.PositiveIntegerField(default=0)
     attachment_text_preview = models.TextField(blank=True)
+    attachment_status = models.CharField(max_length=20, blank=True, choices=ATTACHMENT_STATUS_CHOICES)
+    attachment_thumbnail = models.FileField(upload_to='attachments/variants/', null=True, blank=True)
+    attachment_thumbnail_width = models.PositiveIntegerField(default=0)
+    attachment_thumbnail_height = models.PositiveIntegerField(default=0)
+    attachment_preview = models.FileField(upload_to='attachments/variants/', null=True, blank=True)
+    attachment_preview_width = models.PositiveIntegerField(default=0)
+    attachment_preview_height = models.PositiveIntegerField(default=0)
+    # Thread index: ``path`` is the chain of zero-padded ancestor ids ending with
+    # this comment's own id, so ordering by it yields display order and every
+    # subtree is one contiguous range.
+    thread = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='thread_comments',
+        on_delete=models.CASCADE
+    )
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    path = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, editable=False)
+    score = models.IntegerField(default=0, editable=False)
+    upvotes = models.PositiveIntegerField(default=0, editable=False)
+    downvotes = models.PositiveIntegerField(default=0, editable=False)
+    # See hot_rank(); kept current by the vote counter updates.
+    hot_rank = models.FloatField(default=0, editable=False)
+    # Direct replies and the whole subtree below; see shift_ancestor_counts().
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    descendant_count = models.PositiveIntegerField(default=0, editable=False)
+    # ``deleting``: a tombstone whose subtree is being removed in the background.
+    # ``deleted``: a soft-deleted tombstone kept for its replies (COMMENTS_SOFT_DELETE).
+    state = models.CharField(max_length=20, default=STATE_ACTIVE, choices=STATE_CHOICES, editable=False)
+
+    objects = CommentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread', 'path'], name='comment_thread_path_idx'),
+            models.Index(fields=['path'], name='comment_path_idx'),
+            # Root listing orders, see RootThreadCursorPagination.ordering_fields.
+            models.Index(fields=['parent', 'created_at', 'id'], name='comment_root_created_idx'),
+            models.Index(F('parent'), Lower('user_name'), F('id'), name='comment_root_user_name_idx'),
+            models.Index(F('parent'), Lower('email'), F('id'), name='comment_root_email_idx'),
+            models.Index(fields=['parent', 'score', 'id'], name='comment_root_score_idx'),
+            models.Index(fields=['parent', 'hot_rank', 'id'], name='comment_root_hot_idx'),
+            models.Index(fields=['state', 'reply_count'], name='comment_state_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user_name}: {self.text[:30]}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'parent_id' in instance.__dict__:
+            instance._loaded_parent_id = instance.parent_id
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'text' in update_fields:
+            self.render_text()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'text_html', 'text_excerpt', 'text_plain'}
+        creating = self._state.adding
+        reparented = not creating and self.parent_id != getattr(self, '_loaded_parent_id', self.parent_id)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if creating:
+                self._index_new()
+            elif reparented:
+                self._reindex_subtree()
+        self._loaded_parent_id = self.parent_id
+
+    def render_text(self):
+        self.text_html = render_html(self.text)
+        self.text_excerpt = excerpt(self.text)
+        self.text_plain = plain_text(self.text)
+
+    def _parent_index(self):
+        if self.parent_id is None:
+            return None
+        return Comment.objects.filter(pk=self.parent_id).values('path', 'depth', 'thread_id').get()
+
+    def _index_new(self):
+        parent = self._parent_index()
+        if parent is None:
+            self.path, self.depth, self.thread_id = path_segment(self.pk), 0, self.pk
+        else:
+            if parent['depth'] >= MAX_DEPTH:
+                raise ValueError(f'Comments nest at most {MAX_DEPTH} levels deep')
+            self.path = parent['path'] + path_segment(self.pk)
+            self.depth = parent['depth'] + 1
+            self.thread_id = parent['thread_id']
+        self.hot_rank = hot_rank(self.score, self.created_at)
+        Comment.objects.filter(pk=self.pk).update(
+            path=self.path, depth=self.depth, thread_id=self.thread_id, hot_rank=self.hot_rank
+        )
+        Comment.objects.shift_ancestor_counts(self.path, 1)
+
+    def _reindex_subtree(self):
+        old_path, old_depth, descendants = (
+            Comment.objects.filter(pk=self.pk).values_list('path', 'depth', 'descendant_count').get()
+        )
+        parent = self._parent_index()
+        if parent is not None and parent['path'].startswith(old_path):
+            raise ValueError('A comment cannot be moved into its own subtree')
+
+        if parent is None:
+            new_path, new_depth, new_thread = path_segment(self.pk), 0, self.pk
+        else:
+            new_path = parent['path'] + path_segment(self.pk)
+            new_depth = parent['depth'] + 1
+            new_thread = parent['thread_id']
+            if Comment.objects.subtree_depth(old_path) - old_depth + new_depth > MAX_DEPTH:
+                raise ValueError(f'Comments nest at most {MAX_DEPTH} levels deep')
+
+        Comment.objects.subtree(old_path).update(
+            path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=models.CharField()),
+            depth=F('depth') + (new_depth - old_depth),
+            thread_id=new_thread,
+        )
+        Comment.objects.shift_ancestor_counts(old_path, -(descendants + 1))
+        Comment.objects.shift_ancestor_counts(new_path, descendants + 1)
+        self.path, self.depth, self.thread_id = new_path, new_depth, new_thread
+
 
 class CommentVote(models.Model):
     UPVOTE = 1
@@ -82,3 +534,70 @@ class CommentBookmark(models.Model):
     def __str__(self):
         return f"Bookmark({self.user_id} -> {self.comment_id})"
 
+
+class VoteFlush(models.Model):
+    """The id of the last vote buffer batch committed to the database; a single row.
+
+    Written in the flush transaction, so readers can tell whether the held
+    deltas in Redis are already part of the stored counters (see
+    ``comments.vote_buffer``).
+    """
+
+    SINGLETON_ID = 1
+
+    batch = models.BigIntegerField(default=0)
+
+    @classmethod
+    def committed_batch(cls) -> int:
+        return cls.objects.filter(pk=cls.SINGLETON_ID).values_list('batch', flat=True).first() or 0
+
+    @classmethod
+    def commit(cls, batch: int):
+        cls.objects.update_or_create(pk=cls.SINGLETON_ID, defaults={'batch': batch})
+
+
+class CommentChangeQuerySet(models.QuerySet):
+    def record(self, kind: str, comments):
+        """Append one ``kind`` entry per ``(comment_id, thread_id)`` in ``comments``."""
+        self.bulk_create([
+            self.model(comment_id=comment_id, thread_id=thread_id, kind=kind)
+            for comment_id, thread_id in comments
+        ])
+
+    def trim(self, before):
+        """Delete entries older than ``before``, always keeping the newest one so the
+        current position survives an idle period.
+        """
+        latest = self.order_by('-pk').values_list('pk', flat=True).first()
+        if latest is None:
+            return 0
+        deleted, _ = self.filter(created_at__lt=before, pk__lt=latest).delete()
+        return deleted
+
+
+class CommentChange(models.Model):
+    """Append-only log of comment writes; the id is the position clients sync from.
+
+    Entries only name the comment; readers serialize its current state.
+    """
+
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    KIND_CHOICES = (
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    # Plain ids: the entry outlives the comment it describes.
+    comment_id = models.BigIntegerField()
+    thread_id = models.BigIntegerField(null=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = CommentChangeQuerySet.as_manager()
+
+    def __str__(self):
+        return f"Change({self.id}: {self.kind} {self.comment_id})"
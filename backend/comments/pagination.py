@@ -0,0 +1,233 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class RootThreadCursorPagination(BasePagination):
+    """Keyset pagination over top-level comments ordered by ``(<ordering field>, id)``.
+
+    Every page carries its root comments plus a preview of each thread: the
+    first ``reply_preview_count`` replies of every shown comment, in path
+    order, so each returned reply always has its parent in the payload. The
+    rest is fetched per comment with ``paginate_children``.
+    """
+
+    page_size = 25
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    max_thread_replies = 100
+    reply_preview_count = 3
+    children_ordering = 'replies'
+    ordering_query_param = 'ordering'
+    # Each key is backed by a ``(parent, <key>, id)`` index on Comment.
+    ordering_fields = {
+        'created_at': F('created_at'),
+        'user_name': Lower('user_name'),
+        'email': Lower('email'),
+        'score': F('score'),
+        'hot_rank': F('hot_rank'),
+    }
+    # Named rankings, always descending; ``top`` is limited to the roots
+    # created within ``?window=``.
+    ranked_orderings = {'hot': '-hot_rank', 'top': '-score'}
+    # Fields that move with the vote counters.
+    vote_ordering_fields = {'score', 'hot_rank'}
+    window_query_param = 'window'
+    top_windows = {'day': timedelta(days=1), 'week': timedelta(weeks=1), 'all': None}
+    default_window = 'all'
+    default_ordering = '-created_at'
+    invalid_cursor_message = 'Некорректный курсор'
+    invalid_ordering_message = 'Некорректная сортировка'
+    invalid_window_message = 'Некорректный период'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        roots = self.paginate_roots(queryset, request)
+        return roots + self.get_replies(queryset, [root.pk for root in roots])
+
+    def paginate_roots(self, queryset, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        roots = list(self.root_queryset(queryset, request)[:self.page_size + 1])
+
+        has_next = len(roots) > self.page_size
+        roots = roots[:self.page_size]
+        self.next_cursor = self.encode_cursor((roots[-1].sort_key, roots[-1].pk)) if has_next else None
+        return roots
+
+    def root_queryset(self, queryset, request):
+        """Top-level comments in the requested order, starting after the cursor position."""
+        self.ordering = self.get_ordering(request)
+        ordering, window = self.resolve_ordering(self.ordering)
+        field = ordering.lstrip('-')
+        descending = ordering.startswith('-')
+        position = self.decode_cursor(request)
+
+        roots = queryset.filter(parent__isnull=True)
+        if window is not None:
+            roots = roots.filter(created_at__gte=timezone.now() - window)
+        roots = roots.annotate(sort_key=self.ordering_fields[field])
+        if position is not None:
+            value, pk = position
+            after = 'lt' if descending else 'gt'
+            roots = roots.filter(
+                Q(**{f'sort_key__{after}': value}) | Q(sort_key=value, **{f'pk__{after}': pk})
+            )
+        prefix = '-' if descending else ''
+        return roots.order_by(f'{prefix}sort_key', f'{prefix}pk')
+
+    def get_ordering(self, request):
+        """The requested ordering; ``top`` comes back with its window, e.g. ``top:week``."""
+        ordering = request.query_params.get(self.ordering_query_param) or self.default_ordering
+        if ordering == 'top':
+            window = request.query_params.get(self.window_query_param) or self.default_window
+            if window not in self.top_windows:
+                raise ValidationError({self.window_query_param: [self.invalid_window_message]})
+            return f'{ordering}:{window}'
+        if ordering not in self.ranked_orderings and ordering.lstrip('-') not in self.ordering_fields:
+            raise ValidationError({self.ordering_query_param: [self.invalid_ordering_message]})
+        return ordering
+
+    def is_vote_ordered(self, request):
+        ordering, _ = self.resolve_ordering(self.get_ordering(request))
+        return ordering.lstrip('-') in self.vote_ordering_fields
+
+    def resolve_ordering(self, ordering):
+        """``(ordering field, created_at window or None)`` for a ``get_ordering`` value."""
+        name, _, window = ordering.partition(':')
+        if name in self.ranked_orderings:
+            return self.ranked_orderings[name], self.top_windows.get(window)
+        return ordering, None
+
+    def get_replies(self, queryset, thread_ids):
+        """The reply preview of ``thread_ids`` in path order.
+
+        A reply is shown when it is among the first ``reply_preview_count``
+        replies to its parent and its parent is shown, up to
+        ``max_thread_replies`` per thread; both limits apply in the database.
+        """
+        if not thread_ids:
+            return []
+        base = queryset.threads(thread_ids).filter(depth__gt=0).order_by()
+        base = base.values('id', 'thread_id', 'parent_id', 'path')
+        sql, params = base.query.sql_with_params()
+        shown = RawSQL(_reply_preview_sql(sql), (self.reply_preview_count, *params, self.max_thread_replies))
+        return list(queryset.filter(pk__in=shown).order_by('path'))
+
+    def paginate_children(self, queryset, parent_id, request):
+        """Direct replies of ``parent_id`` in path order, starting after the cursor."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.children_ordering
+        position = self.decode_cursor(request)
+
+        children = queryset.filter(parent_id=parent_id)
+        if position is not None:
+            children = children.filter(pk__gt=position[1])
+        # Siblings share the path prefix, so id order is path order.
+        children = list(children.order_by('pk')[:self.page_size + 1])
+
+        has_next = len(children) > self.page_size
+        children = children[:self.page_size]
+        self.next_cursor = self.children_cursor(_fields(children[-1], 'id')[0]) if has_next else None
+        return children
+
+    def children_cursor(self, after_id):
+        """Cursor for ``paginate_children`` continuing after the reply ``after_id``."""
+        return self.encode_cursor((after_id, after_id), ordering=self.children_ordering)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, TypeError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            decoded = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8')
+            ordering, value, pk = json.loads(decoded)
+            if ordering != self.ordering:
+                raise ValueError(ordering)
+            if ordering.lstrip('-') == 'created_at':
+                value = datetime.fromisoformat(value)
+            return value, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position, ordering=None):
+        value, pk = position
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        raw = json.dumps([ordering or self.ordering, value, pk], ensure_ascii=False)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+def _reply_preview_sql(base):
+    """Ids of the rows of ``base`` (replies of some threads) in their preview.
+
+    Ranks replies among their siblings, then hides every reply whose rank, or
+    the rank of one of its ancestors, is over the preview count: in path order
+    those form whole subtrees, so a running maximum of ``path || ':'`` over
+    the hidden rows (':' sorts after every digit) marks where each one ends.
+    What is left is numbered per thread and cut at the thread limit.
+    Parameters: preview count, ``base``'s, thread limit.
+    """
+    return f"""
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY path) AS thread_rank
+            FROM (
+                SELECT id, thread_id, path, MAX(CASE WHEN sibling_rank > %s THEN path || ':' END) OVER (
+                    PARTITION BY thread_id ORDER BY path ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                ) AS hidden_until
+                FROM (
+                    SELECT id, thread_id, path,
+                        ROW_NUMBER() OVER (PARTITION BY parent_id ORDER BY path) AS sibling_rank
+                    FROM ({base}) AS replies
+                ) AS ranked
+            ) AS marked
+            WHERE hidden_until IS NULL OR path > hidden_until
+        ) AS numbered
+        WHERE thread_rank <= %s
+    """
+
+
+def _fields(item, *names):
+    """``names`` read from a ``.values()`` row or a model instance."""
+    if isinstance(item, dict):
+        return tuple(item[name] for name in names)
+    return tuple(getattr(item, name) for name in names)
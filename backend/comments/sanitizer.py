@@ -0,0 +1,165 @@
+"""Comment HTML sanitization.
+
+``sanitize`` returns exactly what the bleach ``cleaner`` would, but only runs
+the html5lib parse for input it cannot prove to be unambiguous:
+
+* text without ``<`` or ``&`` only needs newline normalization and ``>``
+  escaping;
+* text whose markup is made of canonical, properly nested allowlisted tags is
+  copied through in a single tokenizer pass.
+
+Anything else (attributes bleach would rewrite, misnesting, entities, stray
+``<``, control characters) falls back to bleach.
+"""
+import html
+import re
+
+from bleach.sanitizer import Cleaner
+from django.utils.html import strip_tags
+
+ALLOWED_TAGS = ['a', 'code', 'i', 'strong']
+ALLOWED_ATTRS = {'a': ['href', 'title']}
+ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
+ALLOWED_TAG_SET = set(ALLOWED_TAGS)
+TAG_PATTERN = re.compile(r'<\s*/?\s*([a-z0-9]+)[^>]*>', re.IGNORECASE)
+
+# Characters html5lib drops or replaces.
+UNSAFE_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff]')
+SIMPLE_TAG = re.compile(r'</?(code|i|strong)>|</(a)>')
+ANCHOR_OPEN = re.compile(r'<a((?: [a-z]+="[^"<>&\'`\t\n\r]*")*)>')
+ANCHOR_ATTRIBUTE = re.compile(r' ([a-z]+)="([^"]*)"')
+SAFE_HREF = re.compile(r'(?:https?://|mailto:)[^\s"\'<>&`]*\Z', re.IGNORECASE)
+# A bare ``&`` is escaped; one that could start a character reference is left to bleach.
+CHARACTER_REFERENCE = re.compile(r'&[A-Za-z0-9#]')
+WHITESPACE = re.compile(r'\s+')
+EXCERPT_LENGTH = 200
+
+cleaner = Cleaner(
+    tags=ALLOWED_TAGS,
+    attributes=ALLOWED_ATTRS,
+    protocols=ALLOWED_PROTOCOLS,
+    strip=True,
+    strip_comments=True,
+)
+
+
+class DisallowedTag(ValueError):
+    def __init__(self, tag: str):
+        super().__init__(tag)
+        self.tag = tag
+
+
+def sanitize(text: str) -> str:
+    """Clean ``text`` to the allowlist, raising ``DisallowedTag`` for the first tag outside it."""
+    text = text or ''
+    if UNSAFE_CHARS.search(text):
+        check_tags(text)
+        return cleaner.clean(text)
+    if '<' not in text and '&' not in text:
+        return _escape_text(text)
+    cleaned = tokenize(text)
+    return cleaned if cleaned is not None else cleaner.clean(text)
+
+
+def render_html(text: str) -> str:
+    """Canonical stored HTML for ``text``; disallowed tags are stripped rather than rejected."""
+    try:
+        return sanitize(text)
+    except DisallowedTag:
+        return cleaner.clean(text or '')
+
+
+def plain_text(value: str) -> str:
+    return html.unescape(strip_tags(value or ''))
+
+
+def excerpt(value: str, length: int = EXCERPT_LENGTH) -> str:
+    """Single-line plain text of ``value`` cut to ``length`` characters."""
+    text = WHITESPACE.sub(' ', plain_text(value)).strip()
+    if len(text) <= length:
+        return text
+    return text[:length - 1].rstrip() + '…'
+
+
+def check_tags(text: str):
+    for match in TAG_PATTERN.finditer(text):
+        tag = (match.group(1) or '').lower()
+        if tag and tag not in ALLOWED_TAG_SET:
+            raise DisallowedTag(tag)
+
+
+def tokenize(text: str):
+    """Validate and copy ``text`` in one pass over its tags.
+
+    Returns the cleaned text, or ``None`` when some of the markup is
+    ambiguous and has to go through bleach. Disallowed tags raise
+    ``DisallowedTag`` either way.
+    """
+    parts = []
+    open_tags = []
+    ambiguous = False
+    position = 0
+
+    for match in TAG_PATTERN.finditer(text):
+        tag = (match.group(1) or '').lower()
+        if tag and tag not in ALLOWED_TAG_SET:
+            raise DisallowedTag(tag)
+        if ambiguous:
+            continue
+
+        segment = _clean_segment(text[position:match.start()])
+        token = match.group()
+        if segment is None or not _apply_tag(token, open_tags):
+            ambiguous = True
+            continue
+        parts.append(segment)
+        parts.append(token)
+        position = match.end()
+
+    if ambiguous or open_tags:
+        return None
+    segment = _clean_segment(text[position:])
+    if segment is None:
+        return None
+    parts.append(segment)
+    return ''.join(parts)
+
+
+def _apply_tag(token: str, open_tags) -> bool:
+    simple = SIMPLE_TAG.fullmatch(token)
+    if simple:
+        tag = simple.group(1) or simple.group(2)
+        if token.startswith('</'):
+            if not open_tags or open_tags[-1] != tag:
+                return False
+            open_tags.pop()
+            return True
+        open_tags.append(tag)
+        return True
+
+    anchor = ANCHOR_OPEN.fullmatch(token)
+    if anchor is None or 'a' in open_tags:
+        return False
+    seen = set()
+    for name, value in ANCHOR_ATTRIBUTE.findall(anchor.group(1)):
+        if name not in ALLOWED_ATTRS['a'] or name in seen:
+            return False
+        if name == 'href' and not SAFE_HREF.match(value):
+            return False
+        seen.add(name)
+    open_tags.append('a')
+    return True
+
+
+def _clean_segment(segment: str):
+    if '<' in segment:
+        return None
+    if '&' in segment:
+        if CHARACTER_REFERENCE.search(segment):
+            return None
+        segment = segment.replace('&', '&amp;')
+    return _escape_text(segment)
+
+
+def _escape_text(text: str) -> str:
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('>', '&gt;')
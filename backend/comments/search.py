@@ -0,0 +1,174 @@
+"""Full-text search over comment text, author names and text attachment previews.
+
+Comment text is indexed as ``text_plain``, without its markup, so tag names
+and attribute values never match. The index is kept up to date by database
+triggers, so rows changed through ``QuerySet.update`` are covered too:
+
+* PostgreSQL: a ``search_vector`` tsvector column with a GIN index, weighted
+  author name > text > attachment preview (migrations 0010, 0018).
+* SQLite: an external-content FTS5 table ``comments_comment_fts``, installed
+  by ``ensure_sqlite_index`` after every migrate since SQLite table rebuilds
+  drop triggers.
+
+Other backends fall back to an unindexed ``icontains`` scan.
+"""
+import re
+
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.utils.html import escape
+
+from .models import Comment
+from .sanitizer import plain_text
+
+FTS_TABLE = 'comments_comment_fts'
+FTS_COLUMNS = 'user_name, text_plain, attachment_text_preview'
+SQLITE_INDEX = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {FTS_COLUMNS},
+        content='comments_comment', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON comments_comment BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.user_name, new.text_plain, new.attachment_text_preview);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON comments_comment BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.user_name, old.text_plain, old.attachment_text_preview);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update
+    AFTER UPDATE OF {FTS_COLUMNS} ON comments_comment BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.user_name, old.text_plain, old.attachment_text_preview);
+        INSERT INTO {FTS_TABLE} (rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.user_name, new.text_plain, new.attachment_text_preview);
+    END
+    """,
+]
+SQLITE_TRIGGERS = {f'{FTS_TABLE}_insert', f'{FTS_TABLE}_delete', f'{FTS_TABLE}_update'}
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+MAX_TERMS = 8
+SNIPPET_LENGTH = 160
+
+
+def ensure_sqlite_index(db):
+    """Install the FTS5 table and triggers on ``db`` if any are missing, then rebuild the index."""
+    if db.vendor != 'sqlite' or 'comments_comment' not in db.introspection.table_names():
+        return
+    with db.cursor() as cursor:
+        columns = {column.name for column in db.introspection.get_table_description(cursor, 'comments_comment')}
+        if 'text_plain' not in columns:
+            # Migrated only part of the way; the next migrate installs it.
+            return
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'comments_comment'")
+        if SQLITE_TRIGGERS <= {name for (name,) in cursor.fetchall()}:
+            return
+        try:
+            for statement in SQLITE_INDEX:
+                cursor.execute(statement)
+        except OperationalError:
+            # SQLite built without FTS5: search_ids() falls back to a scan.
+            return
+        # Rows written while the triggers were missing are not indexed yet.
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def query_terms(query: str):
+    """The distinct lowercase words of ``query``; every one of them must match."""
+    terms = []
+    for term in TERM_PATTERN.findall(query.lower()):
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def search_ids(terms, limit: int, offset: int = 0):
+    """``(comment_id, rank)`` pairs for comments matching all ``terms``, best first."""
+    if not terms:
+        return []
+    if connection.vendor == 'postgresql':
+        return _search_postgresql(terms, limit, offset)
+    if connection.vendor == 'sqlite':
+        try:
+            return _search_sqlite(terms, limit, offset)
+        except OperationalError:
+            # SQLite built without FTS5.
+            pass
+    return _search_fallback(terms, limit, offset)
+
+
+def _search_postgresql(terms, limit, offset):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT id, ts_rank(search_vector, query) AS rank
+            FROM comments_comment, to_tsquery('simple', %s) AS query
+            WHERE search_vector @@ query
+            ORDER BY rank DESC, id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [' & '.join(terms), limit, offset],
+        )
+        return [(pk, float(rank)) for pk, rank in cursor.fetchall()]
+
+
+def _search_sqlite(terms, limit, offset):
+    # Quoted so FTS5 reads every term as a plain token, never as syntax.
+    match = ' '.join(f'"{term}"' for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT rowid, bm25({FTS_TABLE}, 3.0, 1.0, 0.5) AS rank
+            FROM {FTS_TABLE}
+            WHERE {FTS_TABLE} MATCH %s
+            ORDER BY rank, rowid DESC
+            LIMIT %s OFFSET %s
+            """,
+            [match, limit, offset],
+        )
+        # bm25() is lower-is-better; flip it so every backend ranks descending.
+        return [(pk, -float(rank)) for pk, rank in cursor.fetchall()]
+
+
+def _search_fallback(terms, limit, offset):
+    queryset = Comment.objects.all()
+    for term in terms:
+        queryset = queryset.filter(
+            Q(text_plain__icontains=term) | Q(user_name__icontains=term) | Q(attachment_text_preview__icontains=term)
+        )
+    ids = queryset.order_by('-id').values_list('pk', flat=True)[offset:offset + limit]
+    return [(pk, 0.0) for pk in ids]
+
+
+def highlight(value: str, terms, length: int = SNIPPET_LENGTH):
+    """An HTML-escaped excerpt of ``value`` around the first match with every
+    term occurrence wrapped in ``<mark>``, or ``None`` if nothing matches.
+
+    Terms match whole words only, as they do in the index.
+    """
+    text = plain_text(value)
+    pattern = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(term) for term in terms) + r')(?!\w)', re.IGNORECASE)
+    first = pattern.search(text)
+    if first is None:
+        return None
+
+    start = max(0, first.start() - length // 3)
+    end = min(len(text), start + length)
+    excerpt = text[start:end]
+    parts, position = [], 0
+    for match in pattern.finditer(excerpt):
+        parts.append(escape(excerpt[position:match.start()]))
+        parts.append(f'<mark>{escape(match.group())}</mark>')
+        position = match.end()
+    parts.append(escape(excerpt[position:]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    return prefix + ''.join(parts) + suffix
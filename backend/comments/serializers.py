@@ -1,13 +1,17 @@
-import mimetypes
-import re
+import hashlib
 
 from django.conf import settings
-from django.db.models import Sum
-from PIL import Image, UnidentifiedImageError
-from rest_framework import serializers
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 
-from .models import Comment, CommentBookmark
-from bleach.sanitizer import Cleaner
+from .attachments import accepted_content_type, sniff_content_type
+from .models import MAX_DEPTH, AttachmentBlob, Comment, CommentBookmark
+from .sanitizer import DisallowedTag, sanitize
+from .signals import schedule_blob_collection
 
 
 ALLOWED_IMAGE_TYPES = {
@@ -17,25 +21,14 @@ ALLOWED_IMAGE_TYPES = {
 }
 MAX_IMAGE_SIZE = 5 * 1024 * 1024
 MAX_TEXT_SIZE = 100 * 1024
-ALLOWED_TAGS = ['a', 'code', 'i', 'strong']
-ALLOWED_ATTRS = {'a': ['href', 'title']}
-ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
-ALLOWED_TAG_SET = set(ALLOWED_TAGS)
-TAG_PATTERN = re.compile(r'<\s*/?\s*([a-z0-9]+)[^>]*>', re.IGNORECASE)
-
-
-cleaner = Cleaner(
-    tags=ALLOWED_TAGS,
-    attributes=ALLOWED_ATTRS,
-    protocols=ALLOWED_PROTOCOLS,
-    strip=True,
-    strip_comments=True,
-)
+# Bytes sniffed from uploads that did not stream through the upload handler.
+SNIFF_SIZE = 64 * 1024
 
 
 class CommentSerializer(serializers.ModelSerializer):
     attachment_url = serializers.SerializerMethodField(read_only=True)
-    score = serializers.SerializerMethodField(read_only=True)
+    attachment_thumbnail_url = serializers.SerializerMethodField(read_only=True)
+    attachment_preview_url = serializers.SerializerMethodField(read_only=True)
     user_vote = serializers.SerializerMethodField(read_only=True)
     is_bookmarked = serializers.SerializerMethodField(read_only=True)
 
@@ -48,8 +41,12 @@ class CommentSerializer(serializers.ModelSerializer):
             'email',
             'home_page',
             'text',
+            'text_html',
+            'text_excerpt',
             'created_at',
             'parent',
+            'thread',
+            'depth',
             'attachment',
             'attachment_name',
             'attachment_type',
@@ -58,21 +55,49 @@ class CommentSerializer(serializers.ModelSerializer):
             'attachment_height',
             'attachment_text_preview',
             'attachment_url',
+            'attachment_status',
+            'attachment_thumbnail_url',
+            'attachment_thumbnail_width',
+            'attachment_thumbnail_height',
+            'attachment_preview_url',
+            'attachment_preview_width',
+            'attachment_preview_height',
             'score',
+            'upvotes',
+            'downvotes',
+            'hot_rank',
+            'reply_count',
+            'descendant_count',
+            'state',
             'user_vote',
             'is_bookmarked',
         ]
         read_only_fields = [
             'id',
             'user',
+            'text_html',
+            'text_excerpt',
             'created_at',
+            'thread',
+            'depth',
             'attachment_name',
             'attachment_type',
             'attachment_size',
             'attachment_width',
             'attachment_height',
             'attachment_text_preview',
+            'attachment_status',
+            'attachment_thumbnail_width',
+            'attachment_thumbnail_height',
+            'attachment_preview_width',
+            'attachment_preview_height',
             'score',
+            'upvotes',
+            'downvotes',
+            'hot_rank',
+            'reply_count',
+            'descendant_count',
+            'state',
             'user_vote',
             'is_bookmarked',
         ]
@@ -80,11 +105,20 @@ class CommentSerializer(serializers.ModelSerializer):
             'attachment': {'write_only': True, 'required': False, 'allow_null': True},
         }
 
+    def validate(self, attrs):
+        request = self.context.get('request')
+        upload_error = getattr(request, 'attachment_upload_error', None)
+        if upload_error:
+            raise serializers.ValidationError({'attachment': [upload_error]})
+        if self.instance is not None and self.instance.state != Comment.STATE_ACTIVE:
+            raise serializers.ValidationError('Комментарий удалён')
+        return attrs
+
     def validate_attachment(self, file):
         if not file:
             return file
 
-        content_type = (file.content_type or mimetypes.guess_type(file.name)[0] or '').lower()
+        content_type = self._content_type(file)
 
         if content_type in ALLOWED_IMAGE_TYPES:
             if file.size > MAX_IMAGE_SIZE:
@@ -98,23 +132,30 @@ class CommentSerializer(serializers.ModelSerializer):
 
         raise serializers.ValidationError('Допустимы только PNG, JPG, GIF или TXT')
 
-    def validate_text(self, value: str):
-        raw = value or ''
-        for match in TAG_PATTERN.finditer(raw):
-            tag = (match.group(1) or '').lower()
-            if tag and tag not in ALLOWED_TAG_SET:
-                raise serializers.ValidationError(f'Тег <{tag}> не поддерживается')
+    def validate_parent(self, parent):
+        if parent is not None and parent.state != Comment.STATE_ACTIVE:
+            raise serializers.ValidationError('Нельзя ответить на удалённый комментарий')
+        if parent is not None and self.instance is not None and self.instance.path:
+            if parent.path.startswith(self.instance.path):
+                raise serializers.ValidationError('Нельзя перенести комментарий в собственную ветку')
+        if parent is not None:
+            # Levels the comment brings along: its own and, when moved, its replies'.
+            height = 1
+            if self.instance is not None and self.instance.path:
+                height += Comment.objects.subtree_depth(self.instance.path) - self.instance.depth
+            if parent.depth + height > MAX_DEPTH:
+                raise serializers.ValidationError(f'Ветка не может быть глубже {MAX_DEPTH} уровней')
+        return parent
 
-        cleaned = cleaner.clean(raw)
+    def validate_text(self, value: str):
+        try:
+            cleaned = sanitize(value or '')
+        except DisallowedTag as exc:
+            raise serializers.ValidationError(f'Тег <{exc.tag}> не поддерживается')
         if not cleaned.strip():
             raise serializers.ValidationError('Введите сообщение')
         return cleaned
 
-    def get_score(self, obj: Comment):
-        if hasattr(obj, 'score') and obj.score is not None:
-            return int(obj.score)
-        return int(obj.votes.aggregate(total=Sum('value'))['total'] or 0)
-
     def get_user_vote(self, obj: Comment):
         request = self.context.get('request')
         user = getattr(request, 'user', None)
@@ -136,58 +177,220 @@ class CommentSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         attachment = validated_data.get('attachment')
-        if attachment:
-            metadata = self._extract_metadata(attachment)
-            validated_data.update(metadata)
-        return super().create(validated_data)
+        with transaction.atomic():
+            if attachment:
+                validated_data.update(self._attach_blob(attachment))
+            return super().create(validated_data)
 
     def update(self, instance, validated_data):
         attachment = validated_data.get('attachment')
-        if attachment:
-            metadata = self._extract_metadata(attachment)
-            validated_data.update(metadata)
-        return super().update(instance, validated_data)
+        previous_blob = instance.attachment_blob_id
+        with transaction.atomic():
+            if attachment:
+                validated_data.update(self._attach_blob(attachment))
+            comment = super().update(instance, validated_data)
+            if attachment and previous_blob is not None:
+                AttachmentBlob.objects.release(previous_blob)
+                transaction.on_commit(lambda: schedule_blob_collection([previous_blob]))
+        return comment
+
+    def _attach_blob(self, file):
+        """Point the comment at the blob for this upload's content, storing it only if it is new."""
+        blob = AttachmentBlob.objects.acquire(self._content_hash(file), lambda: self._extract_metadata(file))
+        return {
+            **blob.comment_fields(),
+            'attachment_blob': blob,
+            'attachment_name': file.name,
+        }
+
+    def _content_hash(self, file):
+        content_hash = getattr(file, 'content_hash', None)
+        if content_hash:
+            return content_hash
+        hasher = hashlib.sha256()
+        for chunk in file.chunks():
+            hasher.update(chunk)
+        file.seek(0)
+        return hasher.hexdigest()
 
     def get_attachment_url(self, obj: Comment):
-        if not obj.attachment:
+        return self._file_url(obj.attachment)
+
+    def get_attachment_thumbnail_url(self, obj: Comment):
+        return self._file_url(obj.attachment_thumbnail)
+
+    def get_attachment_preview_url(self, obj: Comment):
+        return self._file_url(obj.attachment_preview)
+
+    def _file_url(self, file):
+        if not file:
             return None
         request = self.context.get('request')
-        url = obj.attachment.url
+        url = file.url
         if request:
             return request.build_absolute_uri(url)
         if settings.DEBUG:
-            return f"{settings.MEDIA_URL}{obj.attachment.name}"
+            return f"{settings.MEDIA_URL}{file.name}"
         return url
 
+    def _content_type(self, file):
+        # The type sniffed from the magic bytes, accepted only when the
+        # declared type and the extension agree; '' otherwise.
+        sniffed = getattr(file, 'sniffed_type', None)
+        if sniffed:
+            return sniffed
+        file.seek(0)
+        head = file.read(SNIFF_SIZE)
+        file.seek(0)
+        return accepted_content_type(sniff_content_type(head), file.content_type, file.name) or ''
+
     def _extract_metadata(self, file):
-        content_type = (file.content_type or mimetypes.guess_type(file.name)[0] or '').lower()
+        """Field values for a new ``AttachmentBlob`` holding ``file``."""
+        content_type = self._content_type(file)
         meta = {
-            'attachment_name': file.name,
-            'attachment_size': file.size,
-            'attachment_width': 0,
-            'attachment_height': 0,
-            'attachment_type': '',
-            'attachment_text_preview': '',
+            'file': file,
+            'size': file.size,
+            'status': Comment.ATTACHMENT_READY,
         }
 
         if content_type in ALLOWED_IMAGE_TYPES:
-            meta['attachment_type'] = 'image'
-            try:
-                image = Image.open(file)
-                meta['attachment_width'], meta['attachment_height'] = image.size
-            except (UnidentifiedImageError, OSError):
-                raise serializers.ValidationError('Не удалось обработать изображение')
-            finally:
-                file.seek(0)
+            # Decoding, metadata stripping and variants happen in
+            # process_comment_attachment once the comment is saved.
+            meta['type'] = 'image'
+            meta['status'] = Comment.ATTACHMENT_PROCESSING
         elif content_type == 'text/plain':
-            meta['attachment_type'] = 'text'
+            meta['type'] = 'text'
             file.seek(0)
             snippet = file.read(4096)
             if isinstance(snippet, bytes):
                 snippet = snippet.decode('utf-8', errors='ignore')
-            meta['attachment_text_preview'] = snippet[:400]
+            meta['text_preview'] = snippet[:400]
             file.seek(0)
         else:
             raise serializers.ValidationError('Неподдерживаемый тип вложения')
 
         return meta
+
+
+# Columns read by serialize_comment_rows. Querysets must also carry the
+# ``user_vote`` and ``is_bookmarked`` annotations, as in CommentViewSet.
+COMMENT_ROW_FIELDS = (
+    'id',
+    'user_id',
+    'user_name',
+    'email',
+    'home_page',
+    'text',
+    'text_html',
+    'text_excerpt',
+    'created_at',
+    'parent_id',
+    'thread_id',
+    'depth',
+    'attachment',
+    'attachment_name',
+    'attachment_type',
+    'attachment_size',
+    'attachment_width',
+    'attachment_height',
+    'attachment_text_preview',
+    'attachment_status',
+    'attachment_thumbnail',
+    'attachment_thumbnail_width',
+    'attachment_thumbnail_height',
+    'attachment_preview',
+    'attachment_preview_width',
+    'attachment_preview_height',
+    'score',
+    'upvotes',
+    'downvotes',
+    'hot_rank',
+    'reply_count',
+    'descendant_count',
+    'state',
+    'user_vote',
+    'is_bookmarked',
+)
+
+
+def serialize_comment_rows(rows, request):
+    """Read-only fast path for ``CommentSerializer(many=True).data``.
+
+    Takes ``.values(*COMMENT_ROW_FIELDS)`` rows and builds the same dicts
+    without the DRF field machinery or a ``build_absolute_uri`` per file.
+    """
+    format_datetime = _datetime_formatter()
+    file_url = _file_url_builder(request)
+    user = getattr(request, 'user', None)
+    authenticated = bool(user and user.is_authenticated)
+
+    return [
+        {
+            'id': row['id'],
+            'user': row['user_id'],
+            'user_name': row['user_name'],
+            'email': row['email'],
+            'home_page': row['home_page'],
+            'text': row['text'],
+            'text_html': row['text_html'],
+            'text_excerpt': row['text_excerpt'],
+            'created_at': format_datetime(row['created_at']),
+            'parent': row['parent_id'],
+            'thread': row['thread_id'],
+            'depth': row['depth'],
+            'attachment_name': row['attachment_name'],
+            'attachment_type': row['attachment_type'],
+            'attachment_size': row['attachment_size'],
+            'attachment_width': row['attachment_width'],
+            'attachment_height': row['attachment_height'],
+            'attachment_text_preview': row['attachment_text_preview'],
+            'attachment_url': file_url(row['attachment']),
+            'attachment_status': row['attachment_status'],
+            'attachment_thumbnail_url': file_url(row['attachment_thumbnail']),
+            'attachment_thumbnail_width': row['attachment_thumbnail_width'],
+            'attachment_thumbnail_height': row['attachment_thumbnail_height'],
+            'attachment_preview_url': file_url(row['attachment_preview']),
+            'attachment_preview_width': row['attachment_preview_width'],
+            'attachment_preview_height': row['attachment_preview_height'],
+            'score': row['score'],
+            'upvotes': row['upvotes'],
+            'downvotes': row['downvotes'],
+            'hot_rank': row['hot_rank'],
+            'reply_count': row['reply_count'],
+            'descendant_count': row['descendant_count'],
+            'state': row['state'],
+            'user_vote': int(row['user_vote'] or 0) if authenticated else 0,
+            'is_bookmarked': bool(row['is_bookmarked']) if authenticated else False,
+        }
+        for row in rows
+    ]
+
+
+def _datetime_formatter():
+    """``DateTimeField.to_representation`` with the output timezone resolved once."""
+    field = serializers.DateTimeField()
+    output_timezone = field.default_timezone()
+    if api_settings.DATETIME_FORMAT.lower() != ISO_8601 or output_timezone is None:
+        return field.to_representation
+
+    def format_datetime(value):
+        if not value or timezone.is_naive(value):
+            return field.to_representation(value)
+        formatted = value.astimezone(output_timezone).isoformat()
+        return formatted[:-6] + 'Z' if formatted.endswith('+00:00') else formatted
+    return format_datetime
+
+
+def _file_url_builder(request):
+    """``CommentSerializer._file_url`` for a stored file name, with the URL prefix resolved once."""
+    storage = Comment._meta.get_field('attachment').storage
+
+    if request is None:
+        if settings.DEBUG:
+            return lambda name: f"{settings.MEDIA_URL}{name}" if name else None
+        return lambda name: storage.url(name) if name else None
+
+    if isinstance(storage, FileSystemStorage):
+        prefix = request.build_absolute_uri(storage.base_url)
+        return lambda name: prefix + filepath_to_uri(name).lstrip('/') if name else None
+    return lambda name: request.build_absolute_uri(storage.url(name)) if name else None
@@ -0,0 +1,44 @@
+from django.db import connections, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import AttachmentBlob, Comment
+from .search import ensure_sqlite_index
+
+
+@receiver(post_delete, sender=Comment)
+def update_ancestor_counts(sender, instance, **kwargs):
+    # Sent once per removed comment, so a CASCADE takes every reply off its
+    # surviving ancestors; ancestors removed in the same delete are skipped
+    # by the UPDATE since their rows are already gone. Hidden tombstones
+    # were taken off the counts when they lost their last reply.
+    if instance.state == Comment.STATE_DELETED and instance.reply_count == 0:
+        return
+    Comment.objects.shift_ancestor_counts(instance.path, -1)
+
+
+@receiver(post_delete, sender=Comment)
+def release_attachment_blob(sender, instance, **kwargs):
+    # Also fires for every reply removed by the parent's CASCADE.
+    if instance.attachment_blob_id is None:
+        return
+    release_attachment(instance.attachment_blob_id)
+
+
+def release_attachment(blob_id):
+    """Drop one reference to ``blob_id`` and collect the blob after commit if it was the last."""
+    AttachmentBlob.objects.release(blob_id)
+    transaction.on_commit(lambda: schedule_blob_collection([blob_id]))
+
+
+def schedule_blob_collection(blob_ids):
+    from .tasks import collect_attachment_blobs
+
+    try:
+        collect_attachment_blobs.delay(blob_ids)
+    except Exception:
+        collect_attachment_blobs(blob_ids)
+
+
+def install_search_index(sender, using, **kwargs):
+    ensure_sqlite_index(connections[using])
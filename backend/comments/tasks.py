@@ -1,13 +1,19 @@
+import os
+from datetime import timedelta
+
 from asgiref.sync import async_to_sync
 from celery import shared_task
 from channels.layers import get_channel_layer
-from django.core.cache import cache
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import ProtectedError
+from django.utils import timezone
 
-from .models import Comment
+from . import attachments, broadcast, feed_cache, vote_buffer
+from .models import AttachmentBlob, Comment, CommentChange
 from .serializers import CommentSerializer
 
-CACHE_KEY_ALL_COMMENTS = 'comments:list'
-
 
 def _serialize_comment(comment_id: int):
     comment = Comment.objects.filter(pk=comment_id).first()
@@ -17,16 +23,38 @@ def _serialize_comment(comment_id: int):
     return serializer.data
 
 
-@shared_task
-def broadcast_comment_update(comment_id: int):
-    try:
-        cache.delete(CACHE_KEY_ALL_COMMENTS)
-    except Exception:
-        pass
+def _send(group, message):
     layer = get_channel_layer()
     if layer is None:
         return
+    try:
+        message = broadcast.record(group, message)
+    except Exception:
+        # Still deliver live; reconnecting clients will fall back to a resync.
+        pass
+    async_to_sync(layer.group_send)(
+        group,
+        {
+            'type': 'comment.event',
+            'payload': message,
+        },
+    )
+
+
+def queue_comment_broadcast(comment_id: int, thread_id: int, kind: str = broadcast.KIND_FULL):
+    try:
+        if broadcast.queue(comment_id, thread_id, kind):
+            flush_comment_broadcasts.apply_async(countdown=broadcast.window_ms() / 1000)
+    except Exception:
+        # Without the coalescing queue fall back to one event per write.
+        try:
+            broadcast_comment_update.delay(comment_id, thread_id)
+        except Exception:
+            pass
+
 
+@shared_task
+def broadcast_comment_update(comment_id: int, thread_id: int):
     payload = _serialize_comment(comment_id)
     message = {
         'type': 'comment_delete',
@@ -35,11 +63,259 @@ def broadcast_comment_update(comment_id: int):
         'type': 'comment_update',
         'comment': payload,
     }
+    _send(broadcast.thread_group(thread_id), message)
+    if comment_id == thread_id:
+        _send(broadcast.FEED_GROUP, message)
 
-    async_to_sync(layer.group_send)(
-        'comments',
-        {
-            'type': 'comment.event',
-            'payload': message,
-        },
-    )
\ No newline at end of file
+
+@shared_task
+def flush_comment_broadcasts():
+    pending = broadcast.drain()
+    if not pending:
+        return
+
+    full_ids = [comment_id for comment_id, (kind, _) in pending.items() if kind == broadcast.KIND_FULL]
+    score_ids = [comment_id for comment_id, (kind, _) in pending.items() if kind == broadcast.KIND_SCORE]
+
+    comments = Comment.objects.filter(pk__in=full_ids)
+    updates = CommentSerializer(comments, many=True, context={'request': None}).data
+    scores = vote_buffer.merge(list(Comment.objects.filter(pk__in=score_ids).values('id', 'score')))
+
+    batches = {}
+
+    def batch_for(thread_id):
+        return batches.setdefault(thread_id, {
+            'type': 'comment_batch',
+            'thread': thread_id,
+            'updates': [],
+            'scores': [],
+            'deletes': [],
+        })
+
+    present = set()
+    for item in updates:
+        present.add(item['id'])
+        batch_for(pending[item['id']][1])['updates'].append(item)
+    for item in scores:
+        present.add(item['id'])
+        batch_for(pending[item['id']][1])['scores'].append(item)
+    for comment_id, (_, thread_id) in pending.items():
+        if comment_id not in present:
+            batch_for(thread_id)['deletes'].append(comment_id)
+
+    for thread_id, message in batches.items():
+        _send(broadcast.thread_group(thread_id), message)
+
+    # Root comments that appeared, changed or went away also go to the feed.
+    feed = {
+        'type': 'comment_batch',
+        'thread': None,
+        'updates': [item for item in updates if pending[item['id']][1] == item['id']],
+        'scores': [],
+        'deletes': [comment_id for comment_id, (_, thread_id) in pending.items()
+                    if comment_id == thread_id and comment_id not in present],
+    }
+    if feed['updates'] or feed['deletes']:
+        _send(broadcast.FEED_GROUP, feed)
+
+
+@shared_task
+def process_comment_attachment(comment_id: int):
+    comment = Comment.objects.filter(pk=comment_id).first()
+    if not comment or comment.attachment_blob_id is None:
+        return
+    if comment.attachment_status != Comment.ATTACHMENT_PROCESSING:
+        return
+
+    # The row lock makes concurrent tasks for comments sharing the blob wait
+    # for the first one instead of processing the same image twice.
+    with transaction.atomic():
+        blob = AttachmentBlob.objects.select_for_update().filter(pk=comment.attachment_blob_id).first()
+        if blob is None:
+            return
+        if blob.status == Comment.ATTACHMENT_PROCESSING and blob.file:
+            _process_blob(blob)
+
+    waiting = blob.comments.filter(attachment_status=Comment.ATTACHMENT_PROCESSING)
+    updated = list(waiting.values_list('pk', 'thread_id'))
+    waiting.update(**blob.comment_fields())
+    CommentChange.objects.record(CommentChange.UPDATED, updated)
+    for pk, thread_id in updated:
+        feed_cache.invalidate_thread(thread_id)
+        queue_comment_broadcast(pk, thread_id)
+
+
+def _process_blob(blob):
+    try:
+        with blob.file.open('rb') as file:
+            result = attachments.process_image(file)
+    except attachments.AttachmentProcessingError:
+        blob.file.delete(save=False)
+        blob.status = Comment.ATTACHMENT_FAILED
+        blob.type = ''
+        blob.size = 0
+        blob.save(update_fields=['file', 'status', 'type', 'size'])
+        return
+
+    stem = os.path.splitext(os.path.basename(blob.file.name))[0]
+    if result['original'] is not None:
+        stale_name = blob.file.name
+        blob.file.save(os.path.basename(stale_name), ContentFile(result['original']), save=False)
+        blob.file.storage.delete(stale_name)
+        blob.size = len(result['original'])
+    extension = result['extension']
+    blob.thumbnail.save(f'{stem}_thumb.{extension}', ContentFile(result['thumbnail']), save=False)
+    blob.preview.save(f'{stem}_preview.{extension}', ContentFile(result['preview']), save=False)
+    blob.width, blob.height = result['width'], result['height']
+    blob.thumbnail_width, blob.thumbnail_height = result['thumbnail_size']
+    blob.preview_width, blob.preview_height = result['preview_size']
+    blob.status = Comment.ATTACHMENT_READY
+    blob.save(update_fields=[
+        'file',
+        'size',
+        'width',
+        'height',
+        'thumbnail',
+        'thumbnail_width',
+        'thumbnail_height',
+        'preview',
+        'preview_width',
+        'preview_height',
+        'status',
+    ])
+
+
+@shared_task
+def collect_attachment_blobs(blob_ids=None):
+    """Delete blobs no comment references any more, along with their files."""
+    candidates = AttachmentBlob.objects.orphaned()
+    if blob_ids is not None:
+        candidates = candidates.filter(pk__in=blob_ids)
+
+    collected = 0
+    for blob_id in list(candidates.values_list('pk', flat=True)):
+        # Locked and re-checked before the delete: an upload taking a new
+        # reference in acquire() waits on the row lock, then finds it gone
+        # and stores a fresh blob.
+        try:
+            with transaction.atomic():
+                blob = AttachmentBlob.objects.orphaned().select_for_update().filter(pk=blob_id).first()
+                if blob is None:
+                    continue
+                blob.delete()
+        except ProtectedError:
+            continue
+        blob.delete_files()
+        collected += 1
+    return collected
+
+
+@shared_task
+def flush_vote_buffer():
+    """Write buffered votes to the database; see ``comments.vote_buffer``."""
+    if not vote_buffer.enabled() and not vote_buffer.has_pending():
+        # Still drains what was buffered before the buffer was switched off.
+        return 0
+    # Invalidates the caches of every batch it writes.
+    threads, _ = vote_buffer.flush()
+    return len(threads)
+
+
+@shared_task
+def refresh_hot_ranks():
+    """Rewrite any drifted ``hot_rank`` of the roots recent enough to be on the hot feed.
+
+    Vote counter updates keep the rank current; this repairs rows whose score
+    changed some other way (bulk loads, manual fixes).
+    """
+    since = timezone.now() - timedelta(days=settings.COMMENTS_HOT_RANK_REFRESH_DAYS)
+    changed = Comment.objects.filter(parent__isnull=True, created_at__gte=since).refresh_hot_ranks()
+    if changed:
+        feed_cache.invalidate_feed()
+    return changed
+
+
+@shared_task
+def delete_comment_subtree(comment_id=None):
+    """Remove a ``deleting`` comment and its subtree in bounded batches.
+
+    Rows go leaves first (descending path) so every batch is a self-contained
+    CASCADE, each in its own short transaction. Without ``comment_id`` every
+    comment left in the ``deleting`` state is resumed.
+
+    A job resuming a subtree another one is still deleting is harmless: each
+    batch locks its rows first and deletes only the ones still there, so every
+    row's ``post_delete`` (and its ancestors' count update) runs once, and only
+    the job that removes the subtree root logs and announces it.
+    """
+    roots = Comment.objects.filter(state=Comment.STATE_DELETING)
+    if comment_id is not None:
+        roots = roots.filter(pk=comment_id)
+
+    deleted = 0
+    for root in roots.values('pk', 'path', 'thread_id', 'parent_id'):
+        removed_root = False
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    Comment.objects.subtree(root['path']).order_by('-path').select_for_update()
+                    .values_list('pk', flat=True)[:settings.COMMENTS_DELETE_BATCH_SIZE]
+                )
+                if not batch:
+                    break
+                Comment.objects.filter(pk__in=batch).delete()
+            deleted += len(batch)
+            removed_root = removed_root or root['pk'] in batch
+        if not removed_root:
+            continue
+        CommentChange.objects.record(CommentChange.DELETED, [(root['pk'], root['thread_id'])])
+
+        is_root = root['parent_id'] is None
+        feed_cache.invalidate_thread(root['thread_id'])
+        if is_root:
+            feed_cache.invalidate_feed()
+        # One event for the whole subtree instead of one per removed comment.
+        message = {'type': 'thread_deleted', 'comment_id': root['pk'], 'thread': root['thread_id']}
+        _send(broadcast.thread_group(root['thread_id']), message)
+        if is_root:
+            _send(broadcast.FEED_GROUP, message)
+    return deleted
+
+
+@shared_task
+def compact_deleted_comments():
+    """Remove soft-deleted comments that have no replies left.
+
+    Removing a tombstone takes it off its parent's ``reply_count``, so passes
+    repeat until a whole chain of tombstones has collapsed.
+    """
+    batch_size = settings.COMMENTS_DELETE_BATCH_SIZE
+    threads, roots_removed, deleted = set(), False, 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Comment.objects.filter(state=Comment.STATE_DELETED, reply_count=0)
+                .values_list('pk', 'thread_id', 'parent_id')[:batch_size]
+            )
+            if not batch:
+                break
+            # reply_count is re-checked: a reply may have been posted since.
+            Comment.objects.filter(pk__in=[pk for pk, _, _ in batch], reply_count=0).delete()
+            CommentChange.objects.record(CommentChange.DELETED, [(pk, thread_id) for pk, thread_id, _ in batch])
+        deleted += len(batch)
+        for _, thread_id, parent_id in batch:
+            threads.add(thread_id)
+            roots_removed = roots_removed or parent_id is None
+
+    for thread_id in threads:
+        feed_cache.invalidate_thread(thread_id)
+    if roots_removed:
+        feed_cache.invalidate_feed()
+    return deleted
+
+
+@shared_task
+def trim_comment_changes():
+    """Drop change-log entries older than ``COMMENTS_CHANGE_LOG_DAYS``; clients behind them resync."""
+    before = timezone.now() - timedelta(days=settings.COMMENTS_CHANGE_LOG_DAYS)
+    return CommentChange.objects.trim(before)
@@ -1,3 +1,1378 @@
-from django.test import TestCase
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import SkipFile, StopFutureHandlers
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import BooleanField, Exists, IntegerField, OuterRef, QuerySet, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from PIL import Image
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover - only needed by the vote buffer tests
+    fakeredis = None
+
+from comments import broadcast, change_log, feed_cache, redis_client, search, vote_buffer
+from comments.attachments import AttachmentProcessingError, process_image
+from comments.consumers import CommentConsumer
+from comments.filters import filter_comments
+from comments.models import (
+    MAX_DEPTH, AttachmentBlob, Comment, CommentBookmark, CommentChange, CommentQuerySet, CommentVote, path_segment,
+)
+from comments.pagination import RootThreadCursorPagination
+from comments.renderers import FastJSONRenderer
+from comments.tasks import (
+    _send, collect_attachment_blobs, compact_deleted_comments, delete_comment_subtree, flush_comment_broadcasts,
+    flush_vote_buffer, process_comment_attachment,
+)
+from comments.serializers import MAX_TEXT_SIZE, COMMENT_ROW_FIELDS, CommentSerializer, serialize_comment_rows
+from comments.sanitizer import EXCERPT_LENGTH, DisallowedTag, check_tags, cleaner, excerpt, sanitize, tokenize
+from comments.uploadhandlers import CommentAttachmentUploadHandler
+from comments.views import CommentViewSet
+
+
+class RootOrderingQueryPlanTests(TestCase):
+    """Every listing order must be served by its ``(parent, <key>, id)`` index."""
+
+    expected_indexes = {
+        'created_at': 'comment_root_created_idx',
+        'user_name': 'comment_root_user_name_idx',
+        'email': 'comment_root_email_idx',
+        'score': 'comment_root_score_idx',
+        'hot_rank': 'comment_root_hot_idx',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        roots = Comment.objects.bulk_create(
+            Comment(user_name=f'User{i % 7}', email=f'user{i % 5}@example.com', text='hi', score=i % 3)
+            for i in range(40)
+        )
+        Comment.objects.bulk_create(
+            Comment(user_name='Reply', email='reply@example.com', text='re', parent=root)
+            for root in roots[:10]
+        )
+
+    def root_queryset(self, **params):
+        request = Request(APIRequestFactory().get('/api/comments/', params))
+        paginator = RootThreadCursorPagination()
+        return paginator, paginator.root_queryset(Comment.objects.all(), request)
+
+    def test_each_ordering_uses_its_index(self):
+        for field, index in self.expected_indexes.items():
+            for ordering in (field, f'-{field}'):
+                with self.subTest(ordering=ordering):
+                    _, queryset = self.root_queryset(ordering=ordering)
+                    plan = queryset[:26].explain()
+                    self.assertIn(index, plan)
+
+    def test_rankings_use_their_index(self):
+        for ordering, index in (('hot', 'comment_root_hot_idx'), ('top', 'comment_root_score_idx')):
+            with self.subTest(ordering=ordering):
+                _, queryset = self.root_queryset(ordering=ordering)
+                self.assertIn(index, queryset[:26].explain())
+
+    def test_top_window_limits_roots_by_age(self):
+        old = Comment.objects.filter(parent__isnull=True).order_by('pk')[:5]
+        Comment.objects.filter(pk__in=[comment.pk for comment in old]).update(
+            created_at=timezone.now() - timedelta(days=3)
+        )
+        counts = {window: self.root_queryset(ordering='top', window=window)[1].count() for window in ('day', 'week', 'all')}
+        self.assertEqual(counts, {'day': 35, 'week': 40, 'all': 40})
+        with self.assertRaises(ValidationError):
+            self.root_queryset(ordering='top', window='year')
+
+    def test_cursor_continues_in_order(self):
+        for ordering, extra in (('user_name', {}), ('-score', {}), ('hot', {}), ('top', {'window': 'week'})):
+            with self.subTest(ordering=ordering):
+                paginator, queryset = self.root_queryset(ordering=ordering, **extra)
+                expected = [comment.pk for comment in queryset]
+
+                seen, cursor = [], None
+                while True:
+                    params = {'ordering': ordering, 'page_size': 9, **extra}
+                    if cursor:
+                        params['cursor'] = cursor
+                    request = Request(APIRequestFactory().get('/api/comments/', params))
+                    seen += [root.pk for root in paginator.paginate_roots(Comment.objects.all(), request)]
+                    cursor = paginator.next_cursor
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, expected)
+
+
+def reference_sanitize(text):
+    """The pre-fast-path behaviour: reject on TAG_PATTERN, then run bleach."""
+    check_tags(text)
+    return cleaner.clean(text)
+
+
+class SanitizerDifferentialTests(SimpleTestCase):
+    """``sanitize`` must match bleach byte for byte, including which tag it rejects."""
+
+    cases = [
+        '', 'plain text', 'a > b "q" \'x\'', 'x\r\ny\rz', 'tab\there', 'ü 😀 \ufeff \u2028 \x85 \x7f',
+        'a & b', '&', '&;', '& amp', '&amp;', '&amp', '&lt;', '&nbsp;', '&foo;', '&#39;', '&#x27;',
+        '<strong>hi</strong>', '<STRONG>hi</Strong>', '<strong >x</strong >', '<i></i>', '<i/>', '<code>',
+        '</code>', '<code>a<b</code>', '<i>a<strong>b</i>c</strong>', '<i><i><i><i><i>q</i></i></i></i></i>',
+        '<a href="http://x.com" title=\'t\'>l</a>', '<a href=http://x>l</a>', '<a href="javascript:alert(1)">x</a>',
+        '<a href="/rel">x</a>', '<a onclick="x" href="http://x">y</a>', '<a href="http://x?a=1&b=2">q</a>',
+        '<a title="a>b">x</a>', '<a title=\'x"y\'>z</a>', '<a href="HTTP://x">q</a>', '<a href="mailto:a@b">q</a>',
+        '<a href="http://x/a b">q</a>', '<a href="">q</a>', '<a>q</a>', '<a href="http://x"><i>q</i></a>',
+        '<a href="http://x"><a href="http://y">q</a></a>', '<a href="http://x" href="http://y">q</a>',
+        '<br>', '<script>x</script>', 'x<y', '<3', 'a < b', 'a < b >', '<!-- c -->x', '<!doctype html>',
+        '\x00\x01\x0b\x0c', '<code>\nx</code>', '</strong>', '<strong>unclosed',
+    ]
+    fragments = [
+        'a', 'b c', ' ', '\n', '\r\n', '\r', '>', '<', '&', ';', '#', '"', "'", '=', '/', 'ü', '😀', '\x0b',
+        '<i>', '</i>', '<code>', '</code>', '<strong>', '</strong>', '<a href="http://x.y/z">', '<a title="t">',
+        '<a href="javascript:x">', '</a>', '<br>', '<I>', '<b>', '&amp;', '&lt;', '&#38;', '<!-- c -->',
+    ]
+
+    def assertSameAsBleach(self, text):
+        try:
+            expected = reference_sanitize(text)
+        except DisallowedTag as exc:
+            with self.assertRaises(DisallowedTag) as raised:
+                sanitize(text)
+            self.assertEqual(raised.exception.tag, exc.tag, repr(text))
+            return
+        self.assertEqual(sanitize(text), expected, repr(text))
+
+    def test_known_cases(self):
+        for text in self.cases:
+            with self.subTest(text=text):
+                self.assertSameAsBleach(text)
+
+    def test_random_fragments(self):
+        rng = random.Random(1234)
+        for _ in range(3000):
+            text = ''.join(rng.choice(self.fragments) for _ in range(rng.randint(1, 12)))
+            self.assertSameAsBleach(text)
+
+    def test_common_markup_skips_bleach(self):
+        for text in (
+            '<strong>hi</strong> & x > y',
+            '<i><a href="https://example.com/a?b" title="t">x</a></i>\r\n<code>c</code>',
+        ):
+            self.assertIsNotNone(tokenize(text))
+
+
+class RenderedTextTests(TestCase):
+    def create(self, text):
+        return Comment.objects.create(user_name='a', email='a@example.com', text=text)
+
+    def test_render_text_on_save(self):
+        comment = self.create('<strong>Hi</strong> <em>there</em> &amp; <a href="javascript:x">bye</a>')
+        self.assertEqual(comment.text_html, '<strong>Hi</strong> there &amp; <a>bye</a>')
+        self.assertEqual(comment.text_excerpt, 'Hi there & bye')
+        self.assertEqual(comment.text_plain, 'Hi there & bye')
+
+        comment.text = '<i>edited</i>'
+        comment.save()
+        comment.refresh_from_db()
+        self.assertEqual((comment.text_html, comment.text_excerpt), ('<i>edited</i>', 'edited'))
+
+    def test_excerpt(self):
+        self.assertEqual(excerpt('  one\n\n<i>two</i>\tthree '), 'one two three')
+        self.assertEqual(excerpt('a' * EXCERPT_LENGTH), 'a' * EXCERPT_LENGTH)
+        cut = excerpt('word ' * 100)
+        self.assertEqual(len(cut), EXCERPT_LENGTH)
+        self.assertTrue(cut.endswith('word…'))
+        self.assertEqual(excerpt('abcdef', length=4), 'abc…')
+
+    def test_backfill_command(self):
+        comments = [self.create(f'<strong>{index}</strong>') for index in range(3)]
+        Comment.objects.filter(pk__in=[comments[0].pk, comments[1].pk]).update(text_html='', text_excerpt='')
+        Comment.objects.filter(pk=comments[2].pk).update(text_html='stale', text_excerpt='stale')
+
+        out = StringIO()
+        call_command('backfill_comment_html', batch_size=1, stdout=out)
+        self.assertIn('Rendered 2 comments', out.getvalue())
+        rendered = dict(Comment.objects.values_list('pk', 'text_html'))
+        self.assertEqual(rendered[comments[0].pk], '<strong>0</strong>')
+        self.assertEqual(rendered[comments[2].pk], 'stale')
+
+        call_command('backfill_comment_html', all=True, stdout=StringIO())
+        self.assertEqual(Comment.objects.get(pk=comments[2].pk).text_excerpt, '2')
+
+    def test_migration_backfill(self):
+        comment = self.create('<i>old</i>')
+        Comment.objects.filter(pk=comment.pk).update(text_html='', text_excerpt='')
+        migration = import_module('comments.migrations.0011_comment_rendered_text')
+        migration.render_text(django_apps, None)
+        comment.refresh_from_db()
+        self.assertEqual((comment.text_html, comment.text_excerpt), ('<i>old</i>', 'old'))
+
+
+class CommentRowSerializationTests(TestCase):
+    """``serialize_comment_rows`` must produce exactly what ``CommentSerializer`` does."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='pass')
+        root = Comment.objects.create(
+            user=cls.user, user_name='Автор', email='a@example.com', home_page='https://example.com',
+            text='<strong>Привет</strong> & > \u2028', attachment='attachments/фото 1.png',
+            attachment_name='фото 1.png', attachment_type='image', attachment_size=10, attachment_status='ready',
+            attachment_thumbnail='attachments/variants/t.webp', attachment_preview='attachments/variants/p.webp',
+        )
+        reply = Comment.objects.create(user_name='b', email='b@example.com', text='re', parent=root)
+        Comment.objects.create(
+            user_name='c', email='c@example.com', text='txt', parent=reply,
+            attachment='attachments/log.txt', attachment_type='text', attachment_text_preview='line',
+        )
+        CommentVote.objects.create(user=cls.user, comment=reply, value=CommentVote.DOWNVOTE)
+        CommentBookmark.objects.create(user=cls.user, comment=root)
+
+    def annotated(self, user):
+        if user is None:
+            return Comment.objects.annotate(
+                user_vote=Value(0, output_field=IntegerField()),
+                is_bookmarked=Value(False, output_field=BooleanField()),
+            ).order_by('path')
+        return Comment.objects.annotate(
+            user_vote=Coalesce(
+                Subquery(CommentVote.objects.filter(comment=OuterRef('pk'), user=user).values('value')[:1]),
+                Value(0),
+                output_field=IntegerField(),
+            ),
+            is_bookmarked=Exists(CommentBookmark.objects.filter(comment=OuterRef('pk'), user=user)),
+        ).order_by('path')
+
+    def assertSameOutput(self, request, user):
+        queryset = self.annotated(user)
+        expected = CommentSerializer(list(queryset), many=True, context={'request': request}).data
+        actual = serialize_comment_rows(queryset.values(*COMMENT_ROW_FIELDS), request)
+        self.assertEqual(actual, [dict(item) for item in expected])
+        self.assertEqual([list(item) for item in actual], [list(item) for item in expected])
+
+    def test_matches_serializer_for_anonymous_and_authenticated_requests(self):
+        for user in (None, self.user):
+            with self.subTest(user=user):
+                request = Request(APIRequestFactory().get('/api/comments/'))
+                request.user = user or AnonymousUser()
+                self.assertSameOutput(request, user)
+
+    def test_matches_serializer_without_request(self):
+        for debug in (False, True):
+            with self.subTest(debug=debug), override_settings(DEBUG=debug):
+                self.assertSameOutput(None, None)
+
+    def test_fast_renderer_matches_json_renderer(self):
+        request = Request(APIRequestFactory().get('/api/comments/'))
+        request.user = self.user
+        data = {'next': None, 'results': serialize_comment_rows(self.annotated(self.user).values(*COMMENT_ROW_FIELDS), request)}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class ReplyCountTests(TestCase):
+    """``reply_count``/``descendant_count`` must match the tree after every write."""
+
+    def setUp(self):
+        self.root = self.comment()
+        self.first = self.comment(self.root)
+        self.second = self.comment(self.root)
+        self.nested = [self.comment(self.first) for _ in range(4)]
+        self.comment(self.nested[0])
+
+    def comment(self, parent=None):
+        return Comment.objects.create(user_name='a', email='a@example.com', text='t', parent=parent)
+
+    def assertCountsMatchTree(self):
+        # Hidden tombstones are not counted.
+        for comment in Comment.objects.visible():
+            with self.subTest(comment=comment.pk):
+                self.assertEqual(comment.reply_count, Comment.objects.visible().filter(parent=comment).count())
+                self.assertEqual(
+                    comment.descendant_count,
+                    Comment.objects.visible().subtree(comment.path, include_self=False).count(),
+                )
+
+    def test_create(self):
+        self.assertCountsMatchTree()
+        self.assertEqual(Comment.objects.get(pk=self.root.pk).descendant_count, 7)
+
+    def test_cascade_delete(self):
+        Comment.objects.get(pk=self.first.pk).delete()
+        self.assertCountsMatchTree()
+
+    def test_reparent(self):
+        moved = Comment.objects.get(pk=self.nested[0].pk)
+        moved.parent = self.second
+        moved.save()
+        self.assertCountsMatchTree()
+
+    @override_settings(
+        COMMENTS_DELETE_BATCH_SIZE=2,
+        CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    )
+    def test_background_subtree_delete(self):
+        Comment.objects.filter(pk=self.first.pk).update(state=Comment.STATE_DELETING, **Comment.TOMBSTONE_FIELDS)
+        self.assertEqual(delete_comment_subtree(self.first.pk), 6)
+        self.assertFalse(Comment.objects.filter(pk=self.first.pk).exists())
+        self.assertCountsMatchTree()
+
+    def test_overlapping_subtree_deletes(self):
+        Comment.objects.filter(pk=self.first.pk).update(state=Comment.STATE_DELETING, **Comment.TOMBSTONE_FIELDS)
+        subtree = CommentQuerySet.subtree
+        calls = []
+
+        def finished_elsewhere(queryset, *args, **kwargs):
+            # Another job resumes the same subtree and removes it all first.
+            if not calls:
+                calls.append(None)
+                calls[0] = delete_comment_subtree()
+            return subtree(queryset, *args, **kwargs)
+
+        with mock.patch('comments.tasks._send') as send:
+            with mock.patch.object(CommentQuerySet, 'subtree', finished_elsewhere):
+                self.assertEqual(delete_comment_subtree(self.first.pk), 0)
+        self.assertEqual(calls, [6])
+        self.assertCountsMatchTree()
+        self.assertEqual(Comment.objects.get(pk=self.root.pk).descendant_count, 1)
+        self.assertEqual(CommentChange.objects.filter(comment_id=self.first.pk, kind=CommentChange.DELETED).count(), 1)
+        self.assertEqual(send.call_count, 1)
+
+    def soft_delete(self, comment):
+        Comment.objects.filter(pk=comment.pk).update(state=Comment.STATE_DELETED, **Comment.TOMBSTONE_FIELDS)
+        return Comment.objects.release_tombstone(comment.pk)
+
+    def test_soft_deleted_leaves_leave_the_counts(self):
+        leaf = self.nested[0].replies.get()
+        self.assertEqual(self.soft_delete(self.nested[0]), [])
+        self.assertCountsMatchTree()
+        # The tombstone loses its only reply and is hidden along with it.
+        self.assertEqual(self.soft_delete(leaf), [leaf.pk, self.nested[0].pk])
+        self.assertCountsMatchTree()
+        first = Comment.objects.get(pk=self.first.pk)
+        self.assertEqual((first.reply_count, first.descendant_count), (3, 3))
+
+    def test_compaction_removes_deleted_leaves(self):
+        leaf = self.nested[0].replies.get()
+        for comment in (self.first, self.nested[0], leaf):
+            self.soft_delete(comment)
+        self.assertCountsMatchTree()
+        self.assertEqual(compact_deleted_comments(), 2)
+        self.assertEqual(set(Comment.objects.filter(state=Comment.STATE_DELETED).values_list('pk', flat=True)), {self.first.pk})
+        self.assertCountsMatchTree()
+
+    def test_preview_marks_hidden_replies(self):
+        response = self.client.get('/api/comments/')
+        items = {item['id']: item for item in response.json()['results']}
+        self.assertEqual(len(items), 7)
+        self.assertEqual(items[self.first.pk]['more_replies'], 1)
+        self.assertEqual(items[self.nested[0].pk]['more_replies'], 0)
+
+        cursor = items[self.first.pk]['replies_cursor']
+        page = self.client.get(f'/api/comments/{self.first.pk}/replies/', {'cursor': cursor}).json()
+        self.assertEqual([item['id'] for item in page['results']], [self.nested[3].pk])
+        self.assertIsNone(page['next'])
+
+
+class ReplyPreviewTests(TestCase):
+    """The SQL preview must pick the replies the documented rule picks."""
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.roots = []
+        for _ in range(3):
+            nodes = [Comment.objects.create(user_name='a', email='a@example.com', text='t')]
+            self.roots.append(nodes[0])
+            for _ in range(60):
+                parent = rng.choice(nodes[-8:] if rng.random() < 0.7 else nodes)
+                nodes.append(Comment.objects.create(user_name='a', email='a@example.com', text='t', parent=parent))
+
+    def expected(self, paginator, thread_ids):
+        children = {}
+        for reply in Comment.objects.threads(thread_ids).filter(depth__gt=0).order_by('path'):
+            children.setdefault(reply.parent_id, []).append(reply)
+        shown, per_thread = set(thread_ids), {}
+        for reply in Comment.objects.threads(thread_ids).filter(depth__gt=0).order_by('path'):
+            if reply.parent_id not in shown or reply not in children[reply.parent_id][:paginator.reply_preview_count]:
+                continue
+            if per_thread.get(reply.thread_id, 0) < paginator.max_thread_replies:
+                shown.add(reply.pk)
+                per_thread[reply.thread_id] = per_thread.get(reply.thread_id, 0) + 1
+        return sorted(shown - set(thread_ids), key=lambda pk: Comment.objects.get(pk=pk).path)
+
+    def test_matches_the_rule(self):
+        thread_ids = [root.pk for root in self.roots]
+        for preview, limit in ((3, 100), (2, 10), (1, 5)):
+            paginator = RootThreadCursorPagination()
+            paginator.reply_preview_count, paginator.max_thread_replies = preview, limit
+            with self.subTest(preview=preview, limit=limit):
+                replies = paginator.get_replies(Comment.objects.all(), thread_ids)
+                self.assertEqual([reply.pk for reply in replies], self.expected(paginator, thread_ids))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.comment = Comment.objects.create(user_name='a', email='a@example.com', text='t')
+
+    def test_unchanged_list_is_not_modified_without_queries(self):
+        etag = self.client.get('/api/comments/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/comments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        feed_cache.invalidate_thread(self.comment.thread_id)
+        self.assertEqual(self.client.get('/api/comments/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class FilterTests(TestCase):
+    def setUp(self):
+        self.late = self.create(datetime(2026, 1, 1, 23, 59))
+        self.midnight = self.create(datetime(2026, 1, 2))
+
+    def create(self, created_at):
+        comment = Comment.objects.create(user_name='a', email='a@example.com', text='t')
+        Comment.objects.filter(pk=comment.pk).update(created_at=timezone.make_aware(created_at))
+        return comment.pk
+
+    def ids(self, **params):
+        return set(filter_comments(Comment.objects.all(), params).values_list('pk', flat=True))
+
+    def test_datetime_bounds_are_inclusive(self):
+        boundary = timezone.make_aware(datetime(2026, 1, 2)).isoformat()
+        self.assertEqual(self.ids(created_before=boundary), {self.late, self.midnight})
+        self.assertEqual(self.ids(created_after=boundary), {self.midnight})
+        self.assertEqual(self.ids(created_before=timezone.make_aware(datetime(2026, 1, 1, 23, 58)).isoformat()), set())
+
+    def test_dates_cover_the_whole_day(self):
+        self.assertEqual(self.ids(created_before='2026-01-01'), {self.late})
+        self.assertEqual(self.ids(created_after='2026-01-02'), {self.midnight})
+        self.assertEqual(self.ids(created_after='2026-01-01', created_before='2026-01-02'), {self.late, self.midnight})
+
+    def test_invalid_bound(self):
+        with self.assertRaises(ValidationError) as raised:
+            self.ids(created_before='yesterday')
+        self.assertEqual(raised.exception.detail, {'created_before': ['Некорректная дата']})
+
+
+class CommentApiTestCase(TestCase):
+    """A signed-in API client, with broadcasts stubbed out and uploads kept in a scratch MEDIA_ROOT."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.enterContext(mock.patch('comments.views.CommentViewSet._broadcast'))
+
+    def create(self, text='t', parent=None, attachment=None):
+        data = {'text': text, 'user_name': 'reader', 'email': 'reader@example.com'}
+        if parent is not None:
+            data['parent'] = parent
+        if attachment is not None:
+            data['attachment'] = attachment
+        return self.client.post('/api/comments/', data, format='multipart')
+
+    def post(self, text='t', parent=None):
+        return self.create(text, parent).json()['id']
+
+
+class TreeIndexTests(CommentApiTestCase):
+    """``path``/``depth``/``thread_id`` follow the tree on create and reparent."""
+
+    def assertIndexed(self, comment_id, parent_id):
+        comment = Comment.objects.get(pk=comment_id)
+        if parent_id is None:
+            expected = (path_segment(comment.pk), 0, comment.pk)
+        else:
+            parent = Comment.objects.get(pk=parent_id)
+            expected = (parent.path + path_segment(comment.pk), parent.depth + 1, parent.thread_id)
+        self.assertEqual((comment.path, comment.depth, comment.thread_id), expected)
+
+    def chain(self, length, parent=None):
+        ids = []
+        for _ in range(length):
+            parent = self.post(parent=parent)
+            ids.append(parent)
+        return ids
+
+    def test_create(self):
+        root, reply, nested = self.chain(3)
+        for comment_id, parent_id in ((root, None), (reply, root), (nested, reply)):
+            self.assertIndexed(comment_id, parent_id)
+
+    def test_reparent(self):
+        root, reply, nested = self.chain(3)
+        other = self.post()
+        for parent_id in (other, None, root):
+            with self.subTest(parent=parent_id):
+                moved = Comment.objects.get(pk=reply)
+                moved.parent_id = parent_id
+                moved.save()
+                self.assertIndexed(reply, parent_id)
+                self.assertIndexed(nested, reply)
+
+    def test_depth_limit(self):
+        comments = [Comment.objects.create(user_name='a', email='a@example.com', text='t')]
+        for _ in range(MAX_DEPTH):
+            comments.append(Comment.objects.create(user_name='a', email='a@example.com', text='t', parent=comments[-1]))
+        self.assertEqual(comments[-1].depth, MAX_DEPTH)
+        self.assertLessEqual(len(comments[-1].path), Comment._meta.get_field('path').max_length)
+
+        response = self.create(parent=comments[-1].pk)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent', response.json())
+        with self.assertRaises(ValueError):
+            Comment.objects.create(user_name='a', email='a@example.com', text='t', parent=comments[-1])
+
+        # Moving a two-level subtree under the second-deepest comment is too deep as well.
+        branch = self.chain(2)
+        moved = Comment.objects.get(pk=branch[0])
+        serializer = CommentSerializer(moved, data={'parent': comments[-2].pk}, partial=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('parent', serializer.errors)
+        moved.parent = comments[-2]
+        with self.assertRaises(ValueError):
+            moved.save()
+        self.assertIndexed(branch[1], branch[0])
+
+
+    def test_subtree_is_capped(self):
+        root = self.post()
+        replies = [self.post('reply', root) for _ in range(3)]
+        with mock.patch.object(RootThreadCursorPagination, 'max_thread_replies', 3):
+            items = self.client.get(f'/api/comments/{root}/subtree/').json()
+        self.assertEqual([item['id'] for item in items], [root, *replies[:2]])
+        self.assertEqual((items[0]['more_replies'], items[0]['replies_cursor'] is not None), (1, True))
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FeedCacheTests(CommentApiTestCase):
+    def page_ids(self, **params):
+        return [item['id'] for item in self.client.get('/api/comments/', params).json()['results']]
+
+    def test_root_edit_refreshes_list_pages(self):
+        first, second = self.post(), self.post()
+        self.assertEqual(self.page_ids(ordering='user_name'), [first, second])
+        response = self.client.patch(f'/api/comments/{second}/', {'user_name': 'aaa'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.page_ids(ordering='user_name'), [second, first])
+
+    def test_shared_pages_carry_each_users_state(self):
+        cache.clear()
+        root = self.post()
+        reply = self.post('reply', root)
+        self.client.post(f'/api/comments/{root}/vote/', {'value': 1}, format='json')
+        self.client.post(f'/api/comments/{reply}/bookmark/')
+
+        def states(client):
+            items = client.get('/api/comments/').json()['results']
+            return {item['id']: (item['user_vote'], item['is_bookmarked']) for item in items}
+
+        self.assertEqual(states(self.client), {root: (1, False), reply: (0, True)})
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('other'))
+        # Served from the entries cached for the first user, with none of their state.
+        with mock.patch.object(CommentViewSet, '_build_threads', side_effect=AssertionError):
+            self.assertEqual(states(other), {root: (0, False), reply: (0, False)})
+            self.assertEqual(states(APIClient()), {root: (0, False), reply: (0, False)})
+
+            other.post(f'/api/comments/{root}/bookmark/')
+            self.assertEqual(states(other), {root: (0, True), reply: (0, False)})
+            self.assertEqual(states(self.client), {root: (1, False), reply: (0, True)})
+
+    def test_single_flight_rebuild(self):
+        signature = feed_cache.page_signature({'ordering': 'email'})
+        key = feed_cache.PAGE_KEY.format(
+            generation=feed_cache._get_generation(feed_cache.FEED_GENERATION_KEY), signature=signature
+        )
+        builder = mock.Mock(return_value={'root_ids': [1], 'next': None})
+        self.assertTrue(feed_cache._acquire(key))
+
+        def other_worker_finishes(seconds):
+            cache.set(key, {'root_ids': [2], 'next': None})
+
+        # Another worker holds the lock: wait for its entry instead of building.
+        with mock.patch('comments.feed_cache.time.sleep', side_effect=other_worker_finishes):
+            self.assertEqual(feed_cache.get_page(signature, builder), {'root_ids': [2], 'next': None})
+        builder.assert_not_called()
+
+        # It never delivers: build after the wait rather than fail.
+        cache.delete(key)
+        with mock.patch('comments.feed_cache.time.sleep'), mock.patch('comments.feed_cache.LOCK_WAIT', 0):
+            self.assertEqual(feed_cache.get_page(signature, builder), {'root_ids': [1], 'next': None})
+        builder.assert_called_once()
+
+    def test_stats(self):
+        before = feed_cache.stats()
+        builder = mock.Mock(return_value={'root_ids': [], 'next': None})
+        for _ in range(3):
+            feed_cache.get_page('signature', builder)
+        after = feed_cache.stats()
+        changes = {name: after[name] - before[name] for name in feed_cache.STATS}
+        self.assertEqual(changes, {'hit': 2, 'miss': 1, 'rebuild': 1})
+        self.assertEqual(self.client.get('/api/comments/cache-stats/').status_code, 403)
+
+
+class AttachmentUploadTests(CommentApiTestCase):
+    def test_rejects_type_mismatch(self):
+        uploads = [
+            ('evil.html', b'<script>alert(1)</script>', 'text/html'),
+            ('x.svg', b'<svg onload="alert(1)"/>', 'image/svg+xml'),
+            ('x.svg', b'<svg onload="alert(1)"/>', 'text/plain'),
+            ('fake.png', b'plain text', 'image/png'),
+            ('notes.txt', b'\x89PNG\r\n\x1a\n....', 'text/plain'),
+        ]
+        for name, content, content_type in uploads:
+            with self.subTest(name=name, content_type=content_type):
+                response = self.create(attachment=SimpleUploadedFile(name, content, content_type=content_type))
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()['attachment'], ['Допустимы только PNG, JPG, GIF или TXT'])
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+    def test_oversized_text_is_dropped(self):
+        upload = SimpleUploadedFile('big.txt', b'a' * (MAX_TEXT_SIZE + 1), content_type='text/plain')
+        response = self.create(attachment=upload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['attachment'], ['Текстовый файл не должен превышать 100 КБ'])
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+    def test_skipped_upload_closes_its_spool(self):
+        for name, chunks in (('fake.png', [b'plain text']), ('big.txt', [b'a' * MAX_TEXT_SIZE, b'a'])):
+            with self.subTest(name=name):
+                request = APIRequestFactory().post('/api/comments/')
+                handler = CommentAttachmentUploadHandler(request)
+                handler.handle_raw_input(None, {}, 0, b'boundary')
+                with self.assertRaises(StopFutureHandlers):
+                    handler.new_file('attachment', name, 'text/plain', None)
+                with self.assertRaises(SkipFile):
+                    start = 0
+                    for chunk in chunks:
+                        handler.receive_data_chunk(chunk, start)
+                        start += len(chunk)
+                self.assertTrue(handler.file.closed)
+                self.assertTrue(request.attachment_upload_error)
+
+    def test_accepted_upload_is_hashed_while_streaming(self):
+        content = 'привет\n'.encode() * 7000  # spans two handler chunks
+        response = self.create(attachment=SimpleUploadedFile('notes.txt', content, content_type='text/plain'))
+        self.assertEqual(response.status_code, 201)
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(blob.size, len(content))
+        self.assertEqual(response.json()['attachment_type'], 'text')
+
+
+class AttachmentBlobTests(CommentApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.object(collect_attachment_blobs, 'delay', side_effect=collect_attachment_blobs))
+
+    def upload(self, content, name='notes.txt'):
+        return SimpleUploadedFile(name, content, content_type='text/plain')
+
+    def test_same_content_shares_one_blob(self):
+        first = self.create(attachment=self.upload(b'same')).json()
+        second = self.create(attachment=self.upload(b'same', name='copy.txt')).json()
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(first['attachment_url'], second['attachment_url'])
+        self.assertEqual(second['attachment_name'], 'copy.txt')
+
+    def test_refcount_follows_update_and_delete(self):
+        keep = self.create(attachment=self.upload(b'shared')).json()['id']
+        other = self.create(attachment=self.upload(b'shared')).json()['id']
+        shared = AttachmentBlob.objects.get()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/comments/{other}/', {'attachment': self.upload(b'new')}, format='multipart')
+        shared.refresh_from_db()
+        self.assertEqual(shared.ref_count, 1)
+        replaced = AttachmentBlob.objects.exclude(pk=shared.pk).get()
+        self.assertEqual(replaced.ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/comments/{other}/')
+            self.client.delete(f'/api/comments/{keep}/')
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+    def test_collection_skips_referenced_blobs(self):
+        comment = Comment.objects.get(pk=self.create(attachment=self.upload(b'kept')).json()['id'])
+        blob = comment.attachment_blob
+        path = blob.file.path
+        # A stale count must not free a blob a comment still points at.
+        AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=0)
+        self.assertEqual(collect_attachment_blobs([blob.pk]), 0)
+
+        Comment.objects.filter(pk=comment.pk).update(attachment_blob=None)
+        self.assertEqual(collect_attachment_blobs(), 1)
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+
+
+def image_bytes(size, fmt='JPEG', orientation=None):
+    image = Image.new('RGB', size, 'red')
+    buffer = BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    exif[0x010F] = 'Camera maker'
+    image.save(buffer, format=fmt, exif=exif)
+    return buffer.getvalue()
+
+
+class ProcessImageTests(SimpleTestCase):
+    def test_strips_metadata_and_builds_variants(self):
+        # Orientation 6 is a 90 degree turn, so the stored image is upright.
+        result = process_image(BytesIO(image_bytes((2000, 1000), orientation=6)))
+        self.assertEqual((result['width'], result['height']), (1000, 2000))
+        with Image.open(BytesIO(result['original'])) as original:
+            self.assertEqual(original.size, (1000, 2000))
+            self.assertEqual(dict(original.getexif()), {})
+        self.assertEqual(result['thumbnail_size'], (160, 320))
+        self.assertEqual(result['preview_size'], (640, 1280))
+        for name in ('thumbnail', 'preview'):
+            with Image.open(BytesIO(result[name])) as variant:
+                self.assertEqual(variant.size, result[f'{name}_size'])
+
+    def test_small_images_are_not_upscaled(self):
+        result = process_image(BytesIO(image_bytes((50, 40), fmt='PNG')))
+        self.assertEqual((result['thumbnail_size'], result['preview_size']), ((50, 40), (50, 40)))
+
+    def test_gif_is_kept_as_is(self):
+        buffer = BytesIO()
+        Image.new('P', (10, 10)).save(buffer, format='GIF')
+        buffer.seek(0)
+        self.assertIsNone(process_image(buffer)['original'])
+
+    def test_rejects_undecodable_image(self):
+        with self.assertRaises(AttachmentProcessingError):
+            process_image(BytesIO(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64))
+
+
+class AttachmentProcessingTests(CommentApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch('comments.tasks.queue_comment_broadcast'))
+        self.enterContext(
+            mock.patch.object(process_comment_attachment, 'delay', side_effect=process_comment_attachment)
+        )
+        self.content = image_bytes((800, 600))
+
+    def upload(self):
+        attachment = SimpleUploadedFile('photo.jpg', self.content, content_type='image/jpeg')
+        return self.create(attachment=attachment).json()['id']
+
+    def test_processed_upload(self):
+        comment = Comment.objects.get(pk=self.upload())
+        self.assertEqual(comment.attachment_status, Comment.ATTACHMENT_READY)
+        self.assertEqual((comment.attachment_width, comment.attachment_height), (800, 600))
+        self.assertEqual((comment.attachment_thumbnail_width, comment.attachment_thumbnail_height), (320, 240))
+        with comment.attachment_blob.file.open('rb') as file, Image.open(file) as original:
+            self.assertEqual(dict(original.getexif()), {})
+
+    def test_failed_upload_is_processed_again(self):
+        failure = AttachmentProcessingError('broken')
+        with mock.patch('comments.attachments.process_image', side_effect=failure):
+            failed = Comment.objects.get(pk=self.upload())
+        blob = failed.attachment_blob
+        self.assertEqual(failed.attachment_status, Comment.ATTACHMENT_FAILED)
+        self.assertEqual(blob.status, Comment.ATTACHMENT_FAILED)
+        self.assertFalse(blob.file)
+
+        retried = Comment.objects.get(pk=self.upload())
+        self.assertEqual(retried.attachment_blob_id, blob.pk)
+        self.assertEqual(retried.attachment_status, Comment.ATTACHMENT_READY)
+        blob.refresh_from_db()
+        self.assertEqual((blob.status, blob.ref_count, blob.size > 0), (Comment.ATTACHMENT_READY, 2, True))
+        self.assertTrue(os.path.exists(blob.file.path))
+
+
+@override_settings(COMMENTS_SOFT_DELETE=True)
+class SoftDeleteTests(CommentApiTestCase):
+    def test_deleted_only_reply_leaves_nothing_to_load(self):
+        root = self.post('root')
+        reply = self.post('reply', root)
+        self.assertEqual(self.client.delete(f'/api/comments/{reply}/').status_code, 204)
+
+        items = self.client.get('/api/comments/').json()['results']
+        self.assertEqual([(item['id'], item['reply_count'], item['more_replies']) for item in items], [(root, 0, 0)])
+        self.assertEqual(self.client.get(f'/api/comments/{root}/replies/').json()['results'], [])
+
+    def counts(self, pk):
+        return Comment.objects.values_list('reply_count', 'descendant_count').get(pk=pk)
+
+    def test_repeated_delete(self):
+        for replies in (1, 2):
+            with self.subTest(replies=replies):
+                root = self.post('root')
+                ids = [self.post('reply', root) for _ in range(replies)]
+                self.assertEqual(self.client.delete(f'/api/comments/{ids[0]}/').status_code, 204)
+                self.assertEqual(self.client.delete(f'/api/comments/{ids[0]}/').status_code, 404)
+                self.assertEqual(self.counts(root), (replies - 1, replies - 1))
+
+    def test_tombstones_take_no_votes_or_bookmarks(self):
+        root = self.post('root')
+        self.post('reply', root)
+        self.client.post(f'/api/comments/{root}/bookmark/')
+        self.assertEqual(self.client.delete(f'/api/comments/{root}/').status_code, 204)
+
+        self.assertEqual(self.client.post(f'/api/comments/{root}/vote/', {'value': 1}, format='json').status_code, 400)
+        self.assertEqual(self.client.delete(f'/api/comments/{root}/vote/').status_code, 400)
+        self.assertEqual(self.client.post(f'/api/comments/{root}/bookmark/').status_code, 400)
+        response = self.client.post('/api/comments/bulk/', {
+            'votes': [{'comment_id': root, 'value': 1}],
+            'bookmarks': [{'comment_id': root, 'active': True}],
+        }, format='json').json()
+        self.assertIn('error', response['votes'][0])
+        self.assertIn('error', response['bookmarks'][0])
+        self.assertFalse(CommentVote.objects.exists())
+        self.assertEqual(Comment.objects.get(pk=root).score, 0)
+
+        # The bookmark can still be dropped.
+        self.assertEqual(self.client.delete(f'/api/comments/{root}/bookmark/').status_code, 200)
+        self.assertFalse(CommentBookmark.objects.exists())
+
+class ChangeLogTests(CommentApiTestCase):
+    def test_changes_since_position(self):
+        root = self.post('root')
+        since = self.client.get('/api/comments/changes/').json()['position']
+        reply, removed = self.post('reply', root), self.post('removed', root)
+        self.client.post(f'/api/comments/{root}/vote/', {'value': 1}, format='json')
+        self.client.delete(f'/api/comments/{removed}/')
+
+        changes = self.client.get('/api/comments/changes/', {'since': since}).json()
+        self.assertEqual([item['id'] for item in changes['created']], [reply])
+        self.assertEqual([(item['id'], item['user_vote']) for item in changes['updated']], [(root, 1)])
+        self.assertEqual(changes['deleted'], [removed])
+        self.assertFalse(changes['more'])
+
+        CommentChange.objects.filter(pk__lte=since + 1).delete()
+        self.assertEqual(self.client.get('/api/comments/changes/', {'since': since}).status_code, 410)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class VoteCounterTests(CommentApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.comment_id = self.post()
+        self.other = User.objects.create_user('other', 'other@example.com', 'pass')
+
+    def counters(self):
+        return Comment.objects.values_list('score', 'upvotes', 'downvotes').get(pk=self.comment_id)
+
+    def vote(self, value):
+        if value == 0:
+            return self.client.delete(f'/api/comments/{self.comment_id}/vote/')
+        return self.client.post(f'/api/comments/{self.comment_id}/vote/', {'value': value}, format='json')
+
+    def test_vote_and_unvote_deltas(self):
+        CommentVote.objects.create(user=self.other, comment_id=self.comment_id, value=CommentVote.UPVOTE)
+        Comment.objects.apply_vote_change(self.comment_id, 0, CommentVote.UPVOTE)
+        for value, expected in ((1, (2, 2, 0)), (1, (2, 2, 0)), (-1, (0, 1, 1)), (0, (1, 1, 0)), (0, (1, 1, 0))):
+            with self.subTest(value=value):
+                self.assertEqual(self.vote(value).status_code, 200)
+                self.assertEqual(self.counters(), expected)
+
+    def test_concurrent_first_vote(self):
+        # The row is inserted by another request between the locking read
+        # (which found nothing) and the insert.
+        CommentVote.objects.create(user=self.user, comment_id=self.comment_id, value=CommentVote.UPVOTE)
+        Comment.objects.apply_vote_change(self.comment_id, 0, CommentVote.UPVOTE)
+        first = QuerySet.first
+        calls = []
+
+        def missing_once(queryset):
+            if queryset.model is CommentVote and not calls:
+                calls.append(queryset)
+                return None
+            return first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', missing_once):
+            response = self.vote(-1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.counters(), (-1, 0, 1))
+        self.assertEqual(CommentVote.objects.get(user=self.user).value, CommentVote.DOWNVOTE)
+
+    def test_votes_reorder_cached_ranked_pages(self):
+        first, second = self.comment_id, self.post()
+
+        def roots(ordering):
+            results = self.client.get('/api/comments/', {'ordering': ordering}).json()['results']
+            return [item['id'] for item in results if item.get('parent') is None]
+
+        self.assertEqual(roots('-created_at'), [second, first])
+        for ordering in ('top', 'hot', '-score'):
+            roots(ordering)
+        self.client.post(f'/api/comments/{second}/vote/', {'value': 1}, format='json')
+        for ordering in ('top', 'hot', '-score'):
+            with self.subTest(ordering=ordering):
+                self.assertEqual(roots(ordering), [second, first])
+        self.client.post(f'/api/comments/{first}/vote/', {'value': 1}, format='json')
+        self.client.post(f'/api/comments/{second}/vote/', {'value': -1}, format='json')
+        # Scores of one point either way do not move ``hot``.
+        for ordering in ('top', '-score'):
+            with self.subTest(ordering=ordering):
+                self.assertEqual(roots(ordering), [first, second])
+
+        # Orderings that votes do not move keep their cached page.
+        with mock.patch('comments.views.CommentViewSet._build_page') as build_page:
+            self.assertEqual(roots('-created_at'), [second, first])
+        build_page.assert_not_called()
+
+    def test_rebuild_comment_scores(self):
+        for user, value in ((self.user, 1), (self.other, -1)):
+            CommentVote.objects.create(user=user, comment_id=self.comment_id, value=value)
+        Comment.objects.filter(pk=self.comment_id).update(score=7, upvotes=7, downvotes=0)
+        before = feed_cache.version()
+
+        call_command('rebuild_comment_scores', '--check', stdout=StringIO())
+        self.assertEqual(self.counters(), (7, 7, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_comment_scores', stdout=StringIO())
+        self.assertEqual(self.counters(), (0, 1, 1))
+        self.assertNotEqual(feed_cache.version(), before)
+        self.assertTrue(CommentChange.objects.filter(comment_id=self.comment_id, kind=CommentChange.UPDATED).exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CompactActionTests(CommentApiTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.comment_id = self.post()
+        self.url = f'/api/comments/{self.comment_id}'
+
+    def compact(self, score, user_vote, is_bookmarked):
+        return {'id': self.comment_id, 'score': score, 'user_vote': user_vote, 'is_bookmarked': is_bookmarked}
+
+    def test_compact_payload(self):
+        full = self.client.post(f'{self.url}/vote/', {'value': 1}, format='json').json()
+        self.assertEqual((full['text'], full['score'], full['user_vote']), ('t', 1, 1))
+
+        response = self.client.post(f'{self.url}/bookmark/?compact=1')
+        self.assertEqual(response.json(), self.compact(1, 1, True))
+        response = self.client.post(f'{self.url}/vote/?compact=true', {'value': -1}, format='json')
+        self.assertEqual(response.json(), self.compact(-1, -1, True))
+        response = self.client.delete(f'{self.url}/bookmark/?compact=1')
+        self.assertEqual(response.json(), self.compact(-1, -1, False))
+        response = self.client.delete(f'{self.url}/vote/?compact=1')
+        self.assertEqual(response.json(), self.compact(0, 0, False))
+
+    def test_compact_write_changes_etag(self):
+        etag = self.client.get('/api/comments/')['ETag']
+        self.assertEqual(self.client.get('/api/comments/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.post(f'{self.url}/vote/?compact=1', {'value': 1}, format='json')
+        response = self.client.get('/api/comments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['user_vote'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # A bookmark is private, but still changes what this user is served.
+        etag = response['ETag']
+        self.client.post(f'{self.url}/bookmark/?compact=1')
+        response = self.client.get('/api/comments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['results'][0]['is_bookmarked'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BulkActionTests(CommentApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.post() for _ in range(3)]
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        CommentVote.objects.create(user=other, comment_id=self.ids[0], value=CommentVote.UPVOTE)
+        Comment.objects.apply_vote_change(self.ids[0], 0, CommentVote.UPVOTE)
+
+    def bulk(self, votes=(), bookmarks=()):
+        data = {'votes': list(votes), 'bookmarks': list(bookmarks)}
+        return self.client.post('/api/comments/bulk/', data, format='json')
+
+    def counters(self):
+        rows = Comment.objects.filter(pk__in=self.ids).values_list('pk', 'score', 'upvotes', 'downvotes')
+        return {pk: counters for pk, *counters in rows}
+
+    def bookmarked(self):
+        return set(CommentBookmark.objects.filter(user=self.user).values_list('comment_id', flat=True))
+
+    def test_upsert_and_clear(self):
+        first, second, third = self.ids
+        response = self.bulk(
+            [{'comment_id': first, 'value': 1}, {'comment_id': second, 'value': -1}, {'comment_id': third, 'value': 1}],
+            [{'comment_id': first, 'active': True}, {'comment_id': second, 'active': True}],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted((item['comment_id'], item['user_vote'], item['score']) for item in response.json()['votes']),
+            [(first, 1, 2), (second, -1, -1), (third, 1, 1)],
+        )
+        self.assertEqual(self.counters(), {first: [2, 2, 0], second: [-1, 0, 1], third: [1, 1, 0]})
+        self.assertEqual(self.bookmarked(), {first, second})
+
+        response = self.bulk(
+            [{'comment_id': first, 'value': -1}, {'comment_id': second, 'value': 0}, {'comment_id': third, 'value': 1}],
+            [{'comment_id': first, 'active': False}],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.counters(), {first: [0, 1, 1], second: [0, 0, 0], third: [1, 1, 0]})
+        self.assertEqual(
+            dict(CommentVote.objects.filter(user=self.user).values_list('comment_id', 'value')),
+            {first: -1, third: 1},
+        )
+        self.assertEqual(self.bookmarked(), {second})
+
+    def test_per_item_errors(self):
+        first, second, _ = self.ids
+        response = self.bulk(
+            [
+                {'comment_id': first, 'value': 5},
+                {'comment_id': second, 'value': 2},
+                {'comment_id': second, 'value': 1},
+                {'comment_id': 'junk', 'value': 1},
+                {'value': 1},
+                {'comment_id': 999999, 'value': 1},
+            ],
+            [{'comment_id': first, 'active': 'yes'}, 'junk'],
+        )
+        self.assertEqual(response.status_code, 200)
+        votes = response.json()['votes']
+        by_id = {item['comment_id']: item for item in votes if 'comment_id' in item}
+        self.assertIn('error', by_id[first])
+        # A later item for the same comment replaces the earlier error.
+        self.assertEqual(by_id[second]['user_vote'], 1)
+        self.assertIn('error', by_id[999999])
+        self.assertEqual(sorted(item['index'] for item in votes if 'index' in item), [3, 4])
+        bookmarks = response.json()['bookmarks']
+        self.assertEqual([item['index'] for item in bookmarks if 'index' in item], [1])
+        self.assertIn('error', next(item for item in bookmarks if item.get('comment_id') == first))
+        self.assertEqual(self.counters()[first], [1, 1, 0])
+        self.assertEqual(self.counters()[second], [1, 1, 0])
+
+    def test_item_limit(self):
+        votes = [{'comment_id': self.ids[0], 'value': 1}] * 300
+        bookmarks = [{'comment_id': self.ids[1], 'active': True}] * 201
+        response = self.bulk(votes, bookmarks)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CommentVote.objects.filter(user=self.user).exists())
+        self.assertEqual(self.bulk(votes, bookmarks[:200]).status_code, 200)
+
+
+@skipIf(connection.vendor != 'sqlite', 'checks the SQLite FTS5 index')
+class SearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def comment(self, text, user_name='anna', parent=None):
+        return Comment.objects.create(user_name=user_name, email='a@example.com', text=text, parent=parent)
+
+    def search(self, query, **params):
+        response = self.client.get('/api/comments/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def hit_ids(self, query, **params):
+        return [result['comment']['id'] for result in self.search(query, **params)['results']]
+
+    def test_index_installed_after_migrate(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'comments_comment'")
+            self.assertLessEqual(search.SQLITE_TRIGGERS, {name for (name,) in cursor.fetchall()})
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = %s", [search.FTS_TABLE])
+            self.assertIsNotNone(cursor.fetchone())
+
+    def test_updates_reindex(self):
+        comment = self.comment('Первая версия про яблоки')
+        self.assertEqual(self.hit_ids('яблоки'), [comment.pk])
+        comment.text = 'Теперь про <i>груши</i>'
+        comment.save(update_fields=['text'])
+        self.assertEqual(self.hit_ids('яблоки'), [])
+        self.assertEqual(self.hit_ids('груши'), [comment.pk])
+        # Triggers cover QuerySet.update too, which skips save().
+        Comment.objects.filter(pk=comment.pk).update(user_name='сливы')
+        self.assertEqual(self.hit_ids('сливы'), [comment.pk])
+        Comment.objects.filter(pk=comment.pk).delete()
+        self.assertEqual(self.hit_ids('груши'), [])
+
+    def test_ranking_and_highlights(self):
+        in_text = self.comment('a note about kiwi fruit', user_name='bob')
+        in_name = self.comment('a note about fruit', user_name='kiwi')
+        self.comment('nothing to see here')
+        reply = self.comment('more <b>kiwi</b> and kiwis', parent=in_text)
+
+        results = self.search('KIWI')['results']
+        self.assertEqual([result['comment']['id'] for result in results][0], in_name.pk)
+        self.assertEqual({result['comment']['id'] for result in results}, {in_text.pk, in_name.pk, reply.pk})
+        by_id = {result['comment']['id']: result for result in results}
+        self.assertEqual(by_id[in_name.pk]['highlights'], {'user_name': '<mark>kiwi</mark>'})
+        # Whole words, as the index matches them.
+        self.assertEqual(by_id[reply.pk]['highlights']['text'], 'more <mark>kiwi</mark> and kiwis')
+        self.assertEqual([item['id'] for item in by_id[reply.pk]['context']], [in_text.pk])
+        # Every term has to match.
+        self.assertEqual(set(self.hit_ids('kiwi fruit')), {in_text.pk, in_name.pk})
+        self.assertEqual(self.hit_ids('kiwi banana'), [])
+
+    def test_pagination(self):
+        ids = {self.comment(f'page item {number}').pk for number in range(5)}
+        pages, params = [], {'page_size': 2}
+        while True:
+            data = self.search('item', **params)
+            pages.append([result['comment']['id'] for result in data['results']])
+            if data['next'] is None:
+                break
+            params['page'] = len(pages) + 1
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual({pk for page in pages for pk in page}, ids)
+
+    def test_markup_does_not_match(self):
+        for number in range(4):
+            self.comment(f'<strong>x{number}</strong> <a href="https://example.com/kiwi" title="kiwi">link</a>')
+        self.assertEqual(self.search('strong', page_size=2), {'next': None, 'results': []})
+        self.assertEqual(self.hit_ids('kiwi'), [])
+        self.assertEqual(len(self.hit_ids('x1')), 1)
+
+    def test_requires_terms(self):
+        self.assertEqual(self.client.get('/api/comments/search/', {'q': ' !? '}).status_code, 400)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(
+    COMMENTS_VOTE_BUFFER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class VoteBufferTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(redis_client, '_client', fakeredis.FakeRedis()))
+        self.voters = [User.objects.create_user(f'voter{index}') for index in range(3)]
+        self.comment = Comment.objects.create(user_name='a', email='a@example.com', text='t')
+
+    def cast(self, voter, value):
+        return vote_buffer.cast(self.comment.pk, self.voters[voter].pk, value)
+
+    def read(self):
+        item = Comment.objects.values('id', 'score', 'upvotes', 'downvotes').get(pk=self.comment.pk)
+        merged = vote_buffer.merge([item])[0]
+        return merged['score'], merged['upvotes'], merged['downvotes']
+
+    def assertStored(self, score, upvotes, downvotes):
+        stored = Comment.objects.values_list('score', 'upvotes', 'downvotes').get(pk=self.comment.pk)
+        self.assertEqual(stored, (score, upvotes, downvotes))
+
+    def test_cast_is_idempotent(self):
+        self.assertEqual(self.cast(0, 1), 0)
+        self.assertEqual(self.cast(0, 1), 1)
+        self.cast(1, 1)
+        self.assertEqual(self.read(), (2, 2, 0))
+        self.assertEqual(self.cast(0, -1), 1)
+        self.assertEqual(self.read(), (0, 1, 1))
+        self.assertEqual(vote_buffer.pending_votes(self.voters[0].pk, [self.comment.pk]), {self.comment.pk: -1})
+
+        vote_buffer.flush()
+        self.assertStored(0, 1, 1)
+        self.assertEqual(self.read(), (0, 1, 1))
+        self.assertEqual(self.cast(1, 1), 1)
+        self.assertEqual(self.read(), (0, 1, 1))
+
+    def test_unavailable_buffer_refuses_votes(self):
+        client = APIClient()
+        client.force_authenticate(self.voters[0])
+        with mock.patch.object(vote_buffer, 'cast', side_effect=ConnectionError):
+            single = client.post(f'/api/comments/{self.comment.pk}/vote/', {'value': 1}, format='json')
+            bulk = client.post(
+                '/api/comments/bulk/', {'votes': [{'comment_id': self.comment.pk, 'value': 1}]}, format='json'
+            )
+        self.assertEqual((single.status_code, bulk.status_code), (503, 503))
+        self.assertFalse(CommentVote.objects.exists())
+        self.assertStored(0, 0, 0)
+
+    def test_flush_task_idles_while_off(self):
+        with override_settings(COMMENTS_VOTE_BUFFER=False):
+            with mock.patch.object(vote_buffer, 'flush', return_value=(set(), set())) as flush:
+                flush_vote_buffer()
+                flush.assert_not_called()
+                # Votes buffered before the switch still get written.
+                self.cast(0, 1)
+                flush_vote_buffer()
+                flush.assert_called_once()
+
+    def test_crash_between_claim_and_ack(self):
+        self.cast(0, 1)
+        with mock.patch.object(vote_buffer, '_write_batch', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                vote_buffer.flush()
+        self.assertStored(0, 0, 0)
+        self.assertEqual(self.read(), (1, 1, 0))
+
+        # Votes cast meanwhile wait for the next batch.
+        self.cast(1, -1)
+        self.cast(0, 0)
+        self.assertEqual(self.read(), (-1, 0, 1))
+        vote_buffer.flush()
+        vote_buffer.flush()
+        self.assertStored(-1, 0, 1)
+        self.assertEqual(self.read(), (-1, 0, 1))
+        self.assertEqual(list(CommentVote.objects.values_list('user_id', 'value')), [(self.voters[1].pk, -1)])
+
+    def test_crash_between_commit_and_ack(self):
+        self.cast(0, 1)
+        self.cast(1, 1)
+        with mock.patch.object(vote_buffer.feed_cache, 'invalidate_thread', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                vote_buffer.flush()
+        self.assertStored(2, 2, 0)
+        self.assertEqual(self.read(), (2, 2, 0))
+
+        self.cast(2, -1)
+        self.assertEqual(self.read(), (1, 2, 1))
+        vote_buffer.flush()
+        vote_buffer.flush()
+        self.assertStored(1, 2, 1)
+        self.assertEqual(self.read(), (1, 2, 1))
+        self.assertEqual(CommentVote.objects.count(), 3)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(
+    COMMENTS_REPLAY_LOG_SIZE=3,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(redis_client, '_client', fakeredis.FakeRedis()))
+        self.root = Comment.objects.create(user_name='a', email='a@example.com', text='root')
+        self.reply = Comment.objects.create(user_name='a', email='a@example.com', text='reply', parent=self.root)
+        self.other = Comment.objects.create(user_name='a', email='a@example.com', text='other')
+
+    def flushed(self):
+        with mock.patch('comments.tasks._send') as send:
+            flush_comment_broadcasts()
+        return {group: message for (group, message), _ in send.call_args_list}
+
+    def test_coalescing(self):
+        self.assertTrue(broadcast.queue(self.reply.pk, self.root.pk, broadcast.KIND_SCORE))
+        self.assertFalse(broadcast.queue(self.reply.pk, self.root.pk, broadcast.KIND_SCORE))
+        broadcast.queue(self.root.pk, self.root.pk, broadcast.KIND_FULL)
+        # A full update supersedes score-only ones, never the other way round.
+        broadcast.queue(self.root.pk, self.root.pk, broadcast.KIND_SCORE)
+        self.assertEqual(broadcast.drain(), {
+            self.reply.pk: (broadcast.KIND_SCORE, self.root.pk),
+            self.root.pk: (broadcast.KIND_FULL, self.root.pk),
+        })
+        self.assertEqual(broadcast.drain(), {})
+
+    def test_batches_by_thread(self):
+        broadcast.queue(self.root.pk, self.root.pk, broadcast.KIND_FULL)
+        broadcast.queue(self.reply.pk, self.root.pk, broadcast.KIND_SCORE)
+        broadcast.queue(self.other.pk, self.other.pk, broadcast.KIND_FULL)
+        Comment.objects.filter(pk=self.reply.pk).update(score=5)
+        Comment.objects.filter(pk=self.other.pk).delete()
+
+        sent = self.flushed()
+        self.assertEqual(set(sent), {
+            broadcast.thread_group(self.root.pk), broadcast.thread_group(self.other.pk), broadcast.FEED_GROUP,
+        })
+        thread = sent[broadcast.thread_group(self.root.pk)]
+        self.assertEqual([item['id'] for item in thread['updates']], [self.root.pk])
+        # Score-only deltas carry nothing but the score.
+        self.assertEqual(thread['scores'], [{'id': self.reply.pk, 'score': 5}])
+        self.assertEqual(sent[broadcast.thread_group(self.other.pk)]['deletes'], [self.other.pk])
+        feed = sent[broadcast.FEED_GROUP]
+        self.assertEqual(([item['id'] for item in feed['updates']], feed['deletes']), ([self.root.pk], [self.other.pk]))
+
+    def test_bookmarks_stay_private(self):
+        user = User.objects.create_user('reader')
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch('comments.tasks.flush_comment_broadcasts.apply_async'):
+            client.post(f'/api/comments/{self.root.pk}/bookmark/')
+            self.assertEqual(broadcast.drain(), {})
+            client.post(f'/api/comments/{self.root.pk}/vote/', {'value': 1}, format='json')
+            Comment.objects.filter(pk=self.root.pk).update(text='edited')
+            broadcast.queue(self.root.pk, self.root.pk, broadcast.KIND_FULL)
+        # Shared events never carry one user's state.
+        update = self.flushed()[broadcast.thread_group(self.root.pk)]['updates'][0]
+        self.assertEqual((update['user_vote'], update['is_bookmarked'], update['score']), (0, False, 1))
+
+    def test_sequence_and_replay(self):
+        first = broadcast.record('a', {'type': 'x'})
+        second = broadcast.record('b', {'type': 'y'})
+        third = broadcast.record('a', {'type': 'z'})
+        self.assertEqual([first['seq'], second['seq'], third['seq']], [1, 2, 3])
+        self.assertEqual(broadcast.replay(1, {'a'}), [third])
+        self.assertEqual(broadcast.replay(0, {'a', 'b'}), [first, second, third])
+        self.assertEqual(broadcast.replay(3, {'a'}), [])
+        self.assertIsNone(broadcast.replay(7, {'a'}))
+        # The log keeps the last three events, so seq 1 is no longer covered.
+        broadcast.record('a', {'type': 'w'})
+        self.assertIsNone(broadcast.replay(0, {'a'}))
+        self.assertEqual([event['seq'] for event in broadcast.replay(1, {'a', 'b'})], [2, 3, 4])
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(CommentConsumer.as_asgi(), '/ws/comments/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_thread_routing_and_resume(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'subscribe', 'threads': [self.root.pk]})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {'type': 'subscriptions', 'feed': True, 'threads': [self.root.pk]},
+        )
+        send = sync_to_async(_send)
+        await send(broadcast.thread_group(self.other.pk), {'type': 'elsewhere'})
+        await send(broadcast.thread_group(self.root.pk), {'type': 'here'})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'here', 'seq': 2})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+        # Reconnected: what was missed in subscribed groups comes back in order.
+        await send(broadcast.FEED_GROUP, {'type': 'feed'})
+        await send(broadcast.thread_group(self.root.pk), {'type': 'later'})
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'resume', 'last_seq': 2, 'threads': [self.root.pk]})
+        await communicator.receive_json_from()
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'feed', 'seq': 3})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'later', 'seq': 4})
+        await communicator.disconnect()
+
+    async def test_resume_falls_back_to_change_log(self):
+        since = await sync_to_async(change_log.current_position)()
+        for _ in range(4):
+            await sync_to_async(broadcast.record)(broadcast.FEED_GROUP, {'type': 'filler'})
+        await sync_to_async(CommentChange.objects.record)(CommentChange.UPDATED, [(self.root.pk, self.root.pk)])
+
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'resume', 'last_seq': 0, 'since': since, 'threads': [self.root.pk]})
+        await communicator.receive_json_from()
+        changes = await communicator.receive_json_from()
+        self.assertEqual(changes['type'], 'changes')
+        self.assertEqual([item['id'] for item in changes['updated']], [self.root.pk])
+
+        await communicator.send_json_to({'action': 'resume', 'last_seq': 0})
+        await communicator.receive_json_from()
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'resync_required'})
+        await communicator.disconnect()
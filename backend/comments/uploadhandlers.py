@@ -0,0 +1,99 @@
+import hashlib
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers, StopUpload
+
+from .attachments import accepted_content_type, sniff_content_type
+from .serializers import ALLOWED_IMAGE_TYPES, MAX_IMAGE_SIZE, MAX_TEXT_SIZE
+
+# Room for the text fields and multipart framing around the attachment.
+MAX_FORM_OVERHEAD = 64 * 1024
+SPOOL_MAX_MEMORY = 256 * 1024
+
+
+class StreamedUploadedFile(UploadedFile):
+    """An upload spooled by ``CommentAttachmentUploadHandler`` along with what it learned while streaming."""
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra, content_hash, sniffed_type):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.content_hash = content_hash
+        self.sniffed_type = sniffed_type
+
+
+class CommentAttachmentUploadHandler(FileUploadHandler):
+    """Validates the ``attachment`` field while it streams in.
+
+    The type is sniffed from the first chunk's magic bytes and must agree
+    with the declared type and the file extension; the matching size limit
+    is enforced chunk by chunk, so a bad or oversized upload is dropped
+    without being buffered. Accepted data is hashed incrementally and
+    spooled to memory up to ``SPOOL_MAX_MEMORY``, then to a temporary file.
+    Rejections are reported to the serializer via
+    ``request.attachment_upload_error``.
+    """
+
+    field_name = 'attachment'
+    chunk_size = 64 * 1024
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.oversized_request = bool(content_length) and content_length > MAX_IMAGE_SIZE + MAX_FORM_OVERHEAD
+        return None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        if field_name != self.field_name:
+            raise SkipFile()
+        if self.oversized_request:
+            self._reject('Изображение не должно превышать 5 МБ')
+            raise StopUpload(connection_reset=True)
+        self.sniffed_type = None
+        self.limit = 0
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.file = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, dir=settings.FILE_UPLOAD_TEMP_DIR)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0:
+            self.sniffed_type = accepted_content_type(
+                sniff_content_type(raw_data), self.content_type, self.file_name
+            )
+            if self.sniffed_type is None:
+                self._skip('Допустимы только PNG, JPG, GIF или TXT')
+            self.limit = MAX_IMAGE_SIZE if self.sniffed_type in ALLOWED_IMAGE_TYPES else MAX_TEXT_SIZE
+
+        self.size += len(raw_data)
+        if self.size > self.limit:
+            if self.sniffed_type in ALLOWED_IMAGE_TYPES:
+                self._skip('Изображение не должно превышать 5 МБ')
+            else:
+                self._skip('Текстовый файл не должен превышать 100 КБ')
+
+        self.hasher.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        return StreamedUploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            content_hash=self.hasher.hexdigest(),
+            sniffed_type=self.sniffed_type,
+        )
+
+    def _reject(self, message):
+        self.request.attachment_upload_error = message
+
+    def _skip(self, message):
+        # Nothing reads the spool once the file is skipped; a rolled over one
+        # would keep its temporary file until collected.
+        self._reject(message)
+        self.file.close()
+        raise SkipFile()
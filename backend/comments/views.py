@@ -1,52 +1,78 @@
-from django.core.cache import cache
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.db.models import BooleanField, Exists, IntegerField, OuterRef, Subquery, Value
 from django.db.models.functions import Coalesce
-from django.db.models import Sum
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
-from .models import Comment, CommentBookmark, CommentVote
-from .serializers import CommentSerializer
-from .tasks import CACHE_KEY_ALL_COMMENTS, broadcast_comment_update
+from . import broadcast, change_log, feed_cache, search, vote_buffer
+from .filters import filter_comments
+from .models import Comment, CommentBookmark, CommentChange, CommentVote, path_ancestor_ids
+from .pagination import RootThreadCursorPagination
+from .renderers import FastJSONRenderer
+from .serializers import COMMENT_ROW_FIELDS, CommentSerializer, serialize_comment_rows
+from .signals import release_attachment
+from .tasks import delete_comment_subtree, process_comment_attachment, queue_comment_broadcast
+from .uploadhandlers import CommentAttachmentUploadHandler
+
+
+MAX_BULK_ITEMS = 500
+DELETED_TARGET_MESSAGE = 'Комментарий удалён'
+
+
+class VoteBufferUnavailable(APIException):
+    # Writing through to the database instead would leave any older buffered
+    # vote of the user to overwrite it at the next flush.
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Голосование временно недоступно, попробуйте позже'
+    default_code = 'vote_buffer_unavailable'
 
 
 class CommentViewSet(viewsets.ModelViewSet):
     serializer_class = CommentSerializer
     parser_classes = (MultiPartParser, FormParser, JSONParser)
-    cache_key = CACHE_KEY_ALL_COMMENTS
-    cache_timeout = 60
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    pagination_class = RootThreadCursorPagination
 
-    def _cache_get(self):
-        try:
-            return cache.get(self.cache_key)
-        except Exception:
-            return None
+    def initialize_request(self, request, *args, **kwargs):
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            request.upload_handlers = [CommentAttachmentUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
 
-    def _cache_set(self, payload):
-        try:
-            cache.set(self.cache_key, payload, timeout=self.cache_timeout)
-        except Exception:
-            pass
+    def _invalidate(self, *thread_ids, feed=False):
+        for thread_id in set(thread_ids):
+            feed_cache.invalidate_thread(thread_id)
+        if feed:
+            feed_cache.invalidate_feed()
+
+    def _broadcast(self, comment_id: int, thread_id: int, kind: str = broadcast.KIND_FULL):
+        queue_comment_broadcast(comment_id, thread_id, kind)
 
-    def _cache_delete(self):
+    def _delete_subtree(self, comment_id: int):
         try:
-            cache.delete(self.cache_key)
+            delete_comment_subtree.delay(comment_id)
         except Exception:
-            pass
+            delete_comment_subtree(comment_id)
 
-    def _broadcast(self, comment_id: int):
+    def _process_attachment(self, comment):
+        if comment.attachment_status != Comment.ATTACHMENT_PROCESSING:
+            return
         try:
-            broadcast_comment_update.delay(comment_id)
+            process_comment_attachment.delay(comment.pk)
         except Exception:
-            pass
+            # No worker to hand it to: process inline rather than leave it pending.
+            process_comment_attachment(comment.pk)
 
     def get_queryset(self):
-        base_qs = Comment.objects.all().order_by('-created_at')
-        qs = base_qs.annotate(
-            score=Coalesce(Sum('votes__value'), Value(0), output_field=IntegerField())
-        )
+        qs = Comment.objects.all().order_by('-created_at')
 
         user = getattr(self.request, 'user', None)
         if user and user.is_authenticated:
@@ -68,52 +94,363 @@ class CommentViewSet(viewsets.ModelViewSet):
         return qs
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'subtree', 'replies', 'search', 'changes']:
             return [permissions.AllowAny()]
+        if self.action == 'cache_stats':
+            return [permissions.IsAdminUser()]
         return [permissions.IsAuthenticated()]
 
     def list(self, request, *args, **kwargs):
-        if not request.user.is_authenticated:
-            cached = self._cache_get()
-            if cached is not None:
-                return Response(cached)
+        version = self._content_version(request)
+        not_modified = self._not_modified(request, version)
+        if not_modified is not None:
+            return not_modified
+        paginator = self.paginator
+        page = feed_cache.get_page(
+            feed_cache.page_signature(request.query_params),
+            lambda: self._build_page(request),
+            ranked=paginator.is_vote_ordered(request),
+        )
+        paginator.request = request
+        paginator.next_cursor = page['next']
+        threads = feed_cache.get_threads(page['root_ids'], self._build_threads)
+        data = [item for root_id in page['root_ids'] for item in threads.get(root_id, [])]
+        if request.user.is_authenticated:
+            data = self._apply_overlay(data, request.user)
+        response = paginator.get_paginated_response(vote_buffer.merge(data, request.user))
+        return self._versioned(response, version)
 
-        response = super().list(request, *args, **kwargs)
+    def retrieve(self, request, *args, **kwargs):
+        version = self._content_version(request)
+        not_modified = self._not_modified(request, version)
+        if not_modified is not None:
+            return not_modified
+        serializer = self.get_serializer(self.get_object())
+        return self._versioned(Response(vote_buffer.merge([serializer.data], request.user)[0]), version)
 
-        if not request.user.is_authenticated and response.status_code == status.HTTP_200_OK:
-            self._cache_set(response.data)
+    def _content_version(self, request):
+        """``(etag, last_modified)`` of what list/retrieve return, read from the cache only."""
+        version = feed_cache.version(request.user.pk if request.user.is_authenticated else None)
+        if version is None:
+            return None
+        tag, changed_at = version
+        return f'"{tag}-{request.accepted_renderer.format}"', int(changed_at)
+
+    def _not_modified(self, request, version):
+        if version is None:
+            return None
+        etag, last_modified = version
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        return self._versioned(response, version) if response is not None else None
 
+    def _versioned(self, response, version):
+        if version is not None:
+            etag, last_modified = version
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        # Per user and always revalidated, so browsers send If-None-Match.
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Authorization',))
         return response
 
+    def _apply_overlay(self, data, user):
+        overlay = feed_cache.get_overlay(user.pk, lambda: self._build_overlay(user))
+        votes, bookmarks = overlay['votes'], overlay['bookmarks']
+        return [
+            {**item, 'user_vote': votes.get(item['id'], 0), 'is_bookmarked': item['id'] in bookmarks}
+            for item in data
+        ]
+
+    def _build_overlay(self, user):
+        return {
+            'votes': dict(CommentVote.objects.filter(user=user).values_list('comment_id', 'value')),
+            'bookmarks': set(CommentBookmark.objects.filter(user=user).values_list('comment_id', flat=True)),
+        }
+
+    def _build_page(self, request):
+        queryset = filter_comments(Comment.objects.visible().only('pk'), request.query_params)
+        roots = self.paginator.paginate_roots(queryset, request)
+        return {'root_ids': [root.pk for root in roots], 'next': self.paginator.next_cursor}
+
+    def _build_threads(self, thread_ids):
+        # Shared entries must not carry the current user's state; it is
+        # merged back in by _apply_overlay.
+        queryset = Comment.objects.visible().annotate(
+            user_vote=Value(0, output_field=IntegerField()),
+            is_bookmarked=Value(False, output_field=BooleanField()),
+        ).values(*COMMENT_ROW_FIELDS)
+        rows = list(queryset.filter(pk__in=thread_ids)) + self.paginator.get_replies(queryset, thread_ids)
+        threads = {thread_id: [] for thread_id in thread_ids}
+        for item in self._mark_more_replies(self._hide_deleting(serialize_comment_rows(rows, self.request))):
+            threads[item['thread']].append(item)
+        return threads
+
+    def _hide_deleting(self, items):
+        """Drop the replies under ``deleting`` tombstones; ``items`` must have parents before children."""
+        hidden, visible = set(), []
+        for item in items:
+            if item['parent'] in hidden:
+                hidden.add(item['id'])
+                continue
+            if item['state'] == Comment.STATE_DELETING:
+                hidden.add(item['id'])
+            visible.append(item)
+        return visible
+
+    def _mark_more_replies(self, items):
+        """Add ``more_replies`` (direct replies not in ``items``) and the
+        ``replies_cursor`` that fetches them from the replies endpoint.
+        """
+        shown, last_shown = {}, {}
+        for item in items:
+            if item['parent'] is not None:
+                shown[item['parent']] = shown.get(item['parent'], 0) + 1
+                last_shown[item['parent']] = max(item['id'], last_shown.get(item['parent'], 0))
+        for item in items:
+            if item['state'] == Comment.STATE_DELETING:
+                item['more_replies'], item['replies_cursor'] = 0, None
+                continue
+            item['more_replies'] = max(0, item['reply_count'] - shown.get(item['id'], 0))
+            after = last_shown.get(item['id'])
+            item['replies_cursor'] = (
+                self.paginator.children_cursor(after) if item['more_replies'] and after else None
+            )
+        return items
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """Comments created, updated and deleted after the change-log position ``?since=``.
+
+        Without ``since`` only the current position is returned; a client reads
+        it before loading the list and syncs from there.
+        """
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise ValidationError({'since': ['Некорректная позиция']})
+        result = change_log.collect(since, self.get_queryset(), request=request, user=request.user)
+        if result is None:
+            return Response(
+                {'detail': 'Журнал изменений уже очищен, загрузите комментарии заново'},
+                status=status.HTTP_410_GONE,
+            )
+        return Response(result)
+
+    @action(detail=False, methods=['get'], url_path='cache-stats')
+    def cache_stats(self, request):
+        return Response(feed_cache.stats())
+
+    @action(detail=True, methods=['get'])
+    def subtree(self, request, pk=None):
+        comment = self.get_object()
+        limit = self.pagination_class.max_thread_replies
+        rows = self.get_queryset().visible().subtree(comment.path).values(*COMMENT_ROW_FIELDS)[:limit]
+        # Replies past the limit show up as ``more_replies`` on their parents.
+        data = self._mark_more_replies(self._hide_deleting(serialize_comment_rows(rows, request)))
+        return Response(vote_buffer.merge(data, request.user))
+
+    @action(detail=True, methods=['get'])
+    def replies(self, request, pk=None):
+        """Direct replies of a comment, a cursor page at a time."""
+        parent = get_object_or_404(Comment.objects.only('pk', 'path'), pk=pk)
+        lineage = [*path_ancestor_ids(parent.path), parent.pk]
+        if Comment.objects.filter(pk__in=lineage, state=Comment.STATE_DELETING).exists():
+            return Response({'detail': 'Комментарий не найден'}, status=status.HTTP_404_NOT_FOUND)
+        paginator = self.paginator
+        rows = paginator.paginate_children(self.get_queryset().visible().values(*COMMENT_ROW_FIELDS), parent.pk, request)
+        data = self._mark_more_replies(serialize_comment_rows(rows, request))
+        return paginator.get_paginated_response(vote_buffer.merge(data, request.user))
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        terms = search.query_terms(request.query_params.get('q', ''))
+        if not terms:
+            return Response({'detail': 'Введите поисковый запрос'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page = max(1, int(request.query_params.get('page', 1)))
+        except ValueError:
+            page = 1
+        page_size = self.paginator.get_page_size(request)
+
+        ranked = search.search_ids(terms, page_size + 1, (page - 1) * page_size)
+        has_next = len(ranked) > page_size
+        ranked = ranked[:page_size]
+        comments = self.get_queryset().in_bulk([pk for pk, _ in ranked])
+        hits = [(comments[pk], rank) for pk, rank in ranked if pk in comments]
+
+        ancestor_ids = {pk for comment, _ in hits for pk in path_ancestor_ids(comment.path)}
+        ancestors = Comment.objects.only('pk', 'user_name', 'text_excerpt', 'depth', 'state').in_bulk(ancestor_ids)
+        hits = [
+            (comment, rank) for comment, rank in hits
+            if comment.state == Comment.STATE_ACTIVE and not any(
+                ancestors[pk].state == Comment.STATE_DELETING
+                for pk in path_ancestor_ids(comment.path) if pk in ancestors
+            )
+        ]
+
+        data = vote_buffer.merge(self.get_serializer([comment for comment, _ in hits], many=True).data, request.user)
+        results = []
+        for item, (comment, rank) in zip(data, hits):
+            results.append({
+                'comment': item,
+                'rank': rank,
+                'highlights': self._search_highlights(comment, terms),
+                'context': self._search_context(comment, ancestors),
+            })
+        next_link = None
+        if has_next:
+            next_link = replace_query_param(request.build_absolute_uri(), 'page', page + 1)
+        return Response({'next': next_link, 'results': results})
+
+    def _search_highlights(self, comment, terms):
+        highlights = {}
+        for field in ('text', 'user_name', 'attachment_text_preview'):
+            fragment = search.highlight(getattr(comment, field), terms)
+            if fragment is not None:
+                highlights[field] = fragment
+        return highlights
+
+    def _search_context(self, comment, ancestors):
+        """The hit's ancestors from the thread root down to its parent."""
+        context = []
+        for pk in path_ancestor_ids(comment.path):
+            ancestor = ancestors.get(pk)
+            if ancestor is not None:
+                context.append({
+                    'id': ancestor.pk,
+                    'user_name': ancestor.user_name,
+                    'depth': ancestor.depth,
+                    'excerpt': ancestor.text_excerpt,
+                })
+        return context
+
     def perform_create(self, serializer):
         if self.request.user.is_authenticated:
             comment = serializer.save(user=self.request.user, user_name=self.request.user.username)
         else:
             comment = serializer.save()
-        self._cache_delete()
-        self._broadcast(comment.pk)
+        CommentChange.objects.record(CommentChange.CREATED, [(comment.pk, comment.thread_id)])
+        if comment.parent_id is None:
+            self._invalidate(feed=True)
+        else:
+            self._invalidate(comment.thread_id)
+        self._broadcast(comment.pk, comment.thread_id)
+        self._process_attachment(comment)
 
     def _response_with_comment(self, comment):
         refreshed = self.get_queryset().filter(pk=comment.pk).first()
         if not refreshed:
             return Response({'detail': 'Комментарий не найден'}, status=status.HTTP_404_NOT_FOUND)
         serializer = self.get_serializer(refreshed)
-        return Response(serializer.data)
+        return Response(vote_buffer.merge([serializer.data], self.request.user)[0])
+
+    def _action_target(self, active=True):
+        """The comment a vote/bookmark action writes to, without the read-path annotations.
+
+        Deleted comments only accept ``active=False`` actions (dropping a bookmark).
+        """
+        comment = get_object_or_404(Comment.objects.only('pk', 'thread_id', 'state'), pk=self.kwargs['pk'])
+        self.check_object_permissions(self.request, comment)
+        if active and comment.state != Comment.STATE_ACTIVE:
+            raise ValidationError({'detail': DELETED_TARGET_MESSAGE})
+        return comment
+
+    def _action_response(self, comment, user_vote=None, is_bookmarked=None):
+        """The full comment, or with ``?compact=1`` just ``{id, score, user_vote, is_bookmarked}``.
+
+        The compact form reads the maintained score by primary key, plus
+        whichever part of the user's state the write did not already settle.
+        """
+        if self.request.query_params.get('compact', '').lower() not in ('1', 'true', 'yes'):
+            return self._response_with_comment(comment)
+
+        state = Comment.objects.filter(pk=comment.pk)
+        fields = ['score']
+        if user_vote is None:
+            fields.append('user_vote')
+            state = state.annotate(user_vote=Coalesce(
+                Subquery(CommentVote.objects.filter(comment=OuterRef('pk'), user=self.request.user).values('value')[:1]),
+                Value(0),
+                output_field=IntegerField(),
+            ))
+        if is_bookmarked is None:
+            fields.append('is_bookmarked')
+            state = state.annotate(is_bookmarked=Exists(
+                CommentBookmark.objects.filter(comment=OuterRef('pk'), user=self.request.user)
+            ))
+        row = state.values(*fields).first()
+        if row is None:
+            return Response({'detail': 'Комментарий не найден'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(vote_buffer.merge([{
+            'id': comment.pk,
+            'score': row['score'],
+            'user_vote': row['user_vote'] if user_vote is None else user_vote,
+            'is_bookmarked': bool(row['is_bookmarked']) if is_bookmarked is None else is_bookmarked,
+        }], self.request.user)[0])
 
     def perform_update(self, serializer):
+        previous_thread = serializer.instance.thread_id
+        was_root = serializer.instance.parent_id is None
         comment = serializer.save()
-        self._cache_delete()
-        self._broadcast(comment.pk)
+        CommentChange.objects.record(CommentChange.UPDATED, [(comment.pk, comment.thread_id)])
+        # Root edits can move list pages too: orderings by name or email and
+        # the ``has_attachment`` filter read the root rows themselves.
+        self._invalidate(previous_thread, comment.thread_id, feed=was_root or comment.parent_id is None)
+        self._broadcast(comment.pk, comment.thread_id)
+        if serializer.validated_data.get('attachment'):
+            self._process_attachment(comment)
 
     def perform_destroy(self, instance):
+        if instance.state != Comment.STATE_ACTIVE:
+            # Already a tombstone or on its way out: deleting again must not
+            # release it (and its ancestors' counts) a second time.
+            raise NotFound('Комментарий не найден')
         comment_id = instance.pk
-        super().perform_destroy(instance)
-        self._cache_delete()
-        self._broadcast(comment_id)
+        thread_id = instance.thread_id
+        is_root = instance.parent_id is None
+        if settings.COMMENTS_SOFT_DELETE:
+            # One UPDATE; compact_deleted_comments removes the row once it has no replies.
+            with transaction.atomic():
+                deleted = Comment.objects.filter(pk=comment_id, state=Comment.STATE_ACTIVE).update(
+                    state=Comment.STATE_DELETED, attachment_blob=None, **Comment.TOMBSTONE_FIELDS
+                )
+                if not deleted:
+                    # A concurrent DELETE got there first.
+                    raise NotFound('Комментарий не найден')
+                if instance.attachment_blob_id is not None:
+                    release_attachment(instance.attachment_blob_id)
+                # Hidden now if it had no replies, and so may be a tombstone parent.
+                released = Comment.objects.release_tombstone(comment_id)
+                changed = {comment_id, *released}
+                CommentChange.objects.record(CommentChange.UPDATED, [(pk, thread_id) for pk in changed])
+            self._invalidate(thread_id, feed=thread_id in released)
+            for pk in changed:
+                self._broadcast(pk, thread_id)
+            return
+        if instance.descendant_count < settings.COMMENTS_INLINE_DELETE_LIMIT:
+            super().perform_destroy(instance)
+            # Clients drop the replies along with the comment.
+            CommentChange.objects.record(CommentChange.DELETED, [(comment_id, thread_id)])
+            self._invalidate(thread_id, feed=is_root)
+            self._broadcast(comment_id, thread_id)
+            return
+
+        # Too big for one CASCADE: readers get a tombstone right away and the
+        # rows go in bounded batches, ending with one thread_deleted event.
+        if not Comment.objects.filter(pk=comment_id, state=Comment.STATE_ACTIVE).update(
+            state=Comment.STATE_DELETING, **Comment.TOMBSTONE_FIELDS
+        ):
+            raise NotFound('Комментарий не найден')
+        CommentChange.objects.record(CommentChange.UPDATED, [(comment_id, thread_id)])
+        self._invalidate(thread_id, feed=is_root)
+        self._broadcast(comment_id, thread_id)
+        self._delete_subtree(comment_id)
 
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def vote(self, request, pk=None):
-        comment = self.get_object()
+        comment = self._action_target()
         try:
             value = int(request.data.get('value'))
         except (TypeError, ValueError):
@@ -122,43 +459,223 @@ class CommentViewSet(viewsets.ModelViewSet):
         if value not in (CommentVote.UPVOTE, CommentVote.DOWNVOTE):
             return Response({'detail': 'Голос должен быть 1 или -1'}, status=status.HTTP_400_BAD_REQUEST)
 
-        CommentVote.objects.update_or_create(
-            user=request.user,
-            comment=comment,
-            defaults={'value': value}
-        )
-        response = self._response_with_comment(comment)
-        if response.status_code == status.HTTP_200_OK:
-            self._cache_delete()
-            self._broadcast(comment.pk)
-        return response
+        return self._vote_response(comment, value)
 
     @vote.mapping.delete
     def remove_vote(self, request, pk=None):
-        comment = self.get_object()
-        CommentVote.objects.filter(user=request.user, comment=comment).delete()
-        response = self._response_with_comment(comment)
+        return self._vote_response(self._action_target(), 0)
+
+    def _vote_response(self, comment, value):
+        buffered = self._write_vote(comment, value)
+        response = self._action_response(comment, user_vote=value)
         if response.status_code == status.HTTP_200_OK:
-            self._cache_delete()
-            self._broadcast(comment.pk)
+            if not buffered:
+                # Buffered votes are merged into cached entries on read instead
+                # and logged when flushed.
+                CommentChange.objects.record(CommentChange.UPDATED, [(comment.pk, comment.thread_id)])
+                self._invalidate(comment.thread_id)
+                feed_cache.invalidate_user(self.request.user.pk)
+                if comment.pk == comment.thread_id:
+                    feed_cache.invalidate_ranking()
+            else:
+                feed_cache.mark_changed()
+            self._broadcast(comment.pk, comment.thread_id, broadcast.KIND_SCORE)
         return response
 
+    def _write_vote(self, comment, value):
+        """Set the user's vote (0 clears it); returns whether it went to the vote buffer."""
+        user = self.request.user
+        if vote_buffer.enabled():
+            try:
+                vote_buffer.cast(comment.pk, user.pk, value)
+            except Exception:
+                raise VoteBufferUnavailable()
+            return True
+        with transaction.atomic():
+            vote = CommentVote.objects.select_for_update().filter(user=user, comment=comment).first()
+            previous = vote.value if vote else 0
+            if value == 0:
+                if vote is not None:
+                    vote.delete()
+            elif vote is None:
+                try:
+                    with transaction.atomic():
+                        CommentVote.objects.create(user=user, comment=comment, value=value)
+                except IntegrityError:
+                    # A concurrent first vote inserted the row after our read
+                    # (there was nothing to lock): take it over instead.
+                    vote = CommentVote.objects.select_for_update().get(user=user, comment=comment)
+                    previous = vote.value
+            if vote is not None and value and previous != value:
+                vote.value = value
+                vote.save(update_fields=['value', 'updated_at'])
+            Comment.objects.apply_vote_change(comment.pk, previous, value)
+        return False
+
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAuthenticated])
+    def bulk(self, request):
+        """Apply many votes (``value`` 1, -1 or 0 to clear) and bookmark toggles in one transaction."""
+        votes = request.data.get('votes') or []
+        bookmarks = request.data.get('bookmarks') or []
+        if not isinstance(votes, list) or not isinstance(bookmarks, list):
+            return Response({'detail': 'Ожидаются списки votes и bookmarks'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(votes) + len(bookmarks) > MAX_BULK_ITEMS:
+            return Response(
+                {'detail': f'Не больше {MAX_BULK_ITEMS} действий за запрос'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        results = {'votes': {}, 'bookmarks': {}}
+        # Later items for the same comment win, as if they had been sent one by one.
+        wanted_votes = self._parse_bulk(votes, 'value', self._parse_vote_value, results['votes'])
+        wanted_bookmarks = self._parse_bulk(bookmarks, 'active', self._parse_bookmark_flag, results['bookmarks'])
+
+        targets = list(
+            Comment.objects.filter(pk__in={*wanted_votes, *wanted_bookmarks}).values_list('pk', 'thread_id', 'state')
+        )
+        threads = {pk: thread_id for pk, thread_id, _ in targets}
+        deleted = {pk for pk, _, state in targets if state != Comment.STATE_ACTIVE}
+        for wanted, kind in ((wanted_votes, 'votes'), (wanted_bookmarks, 'bookmarks')):
+            for comment_id in list(wanted):
+                if comment_id not in threads:
+                    error = 'Комментарий не найден'
+                elif comment_id in deleted and (kind == 'votes' or wanted[comment_id]):
+                    # As for single actions, only a bookmark can still be dropped.
+                    error = DELETED_TARGET_MESSAGE
+                else:
+                    continue
+                del wanted[comment_id]
+                results[kind][comment_id] = {'comment_id': comment_id, 'error': error}
+
+        with transaction.atomic():
+            changed, buffered = self._apply_bulk_votes(request.user, wanted_votes)
+            self._apply_bulk_bookmarks(request.user, wanted_bookmarks)
+
+        scores = {
+            item['id']: item['score']
+            for item in vote_buffer.merge(list(Comment.objects.filter(pk__in=wanted_votes).values('id', 'score')))
+        }
+        for comment_id, value in wanted_votes.items():
+            results['votes'][comment_id] = {'comment_id': comment_id, 'user_vote': value, 'score': scores.get(comment_id)}
+        for comment_id, active in wanted_bookmarks.items():
+            results['bookmarks'][comment_id] = {'comment_id': comment_id, 'is_bookmarked': active}
+
+        if changed and not buffered:
+            CommentChange.objects.record(CommentChange.UPDATED, [(comment_id, threads[comment_id]) for comment_id in changed])
+            self._invalidate(*(threads[comment_id] for comment_id in changed))
+            if any(threads[comment_id] == comment_id for comment_id in changed):
+                feed_cache.invalidate_ranking()
+        elif changed:
+            feed_cache.mark_changed()
+        if wanted_votes or wanted_bookmarks:
+            feed_cache.invalidate_user(request.user.pk)
+        for comment_id in changed:
+            self._broadcast(comment_id, threads[comment_id], broadcast.KIND_SCORE)
+
+        return Response({kind: list(items.values()) for kind, items in results.items()})
+
+    def _parse_bulk(self, items, key, parse, errors):
+        wanted = {}
+        for index, item in enumerate(items):
+            try:
+                comment_id = int(item['comment_id'])
+            except (KeyError, TypeError, ValueError):
+                # No id to report it under: keyed by its position instead.
+                errors[('index', index)] = {'index': index, 'error': 'Некорректный comment_id'}
+                continue
+            try:
+                wanted[comment_id] = parse(item.get(key))
+            except ValueError as exc:
+                wanted.pop(comment_id, None)
+                errors[comment_id] = {'comment_id': comment_id, 'error': str(exc)}
+            else:
+                errors.pop(comment_id, None)
+        return wanted
+
+    def _parse_vote_value(self, value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('Некорректное значение голоса')
+        if value not in (CommentVote.UPVOTE, CommentVote.DOWNVOTE, 0):
+            raise ValueError('Голос должен быть 1, -1 или 0')
+        return value
+
+    def _parse_bookmark_flag(self, value):
+        if not isinstance(value, bool):
+            raise ValueError('Ожидается true или false')
+        return value
+
+    def _apply_bulk_votes(self, user, wanted):
+        """Write ``{comment_id: value}``; returns the ids whose vote actually changed
+        and whether the votes went to the vote buffer.
+        """
+        if not wanted:
+            return [], False
+        if vote_buffer.enabled():
+            try:
+                return [
+                    comment_id for comment_id, value in wanted.items()
+                    if vote_buffer.cast(comment_id, user.pk, value) != value
+                ], True
+            except Exception:
+                # Votes already buffered stay: casts are absolute, so a retry
+                # of the whole request converges.
+                raise VoteBufferUnavailable()
+        previous = dict(
+            CommentVote.objects.select_for_update()
+            .filter(user=user, comment_id__in=wanted)
+            .values_list('comment_id', 'value')
+        )
+        changes = {
+            comment_id: (previous.get(comment_id, 0), value)
+            for comment_id, value in wanted.items()
+            if previous.get(comment_id, 0) != value
+        }
+        upserts = [
+            CommentVote(user=user, comment_id=comment_id, value=value)
+            for comment_id, (_, value) in changes.items()
+            if value != 0
+        ]
+        if upserts:
+            CommentVote.objects.bulk_create(
+                upserts,
+                update_conflicts=True,
+                unique_fields=['user', 'comment'],
+                update_fields=['value', 'updated_at'],
+            )
+        cleared = [comment_id for comment_id, (_, value) in changes.items() if value == 0]
+        if cleared:
+            CommentVote.objects.filter(user=user, comment_id__in=cleared).delete()
+        Comment.objects.apply_vote_changes(changes)
+        return list(changes), False
+
+    def _apply_bulk_bookmarks(self, user, wanted):
+        added = [comment_id for comment_id, active in wanted.items() if active]
+        removed = [comment_id for comment_id, active in wanted.items() if not active]
+        if added:
+            CommentBookmark.objects.bulk_create(
+                [CommentBookmark(user=user, comment_id=comment_id) for comment_id in added],
+                ignore_conflicts=True,
+            )
+        if removed:
+            CommentBookmark.objects.filter(user=user, comment_id__in=removed).delete()
+
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def bookmark(self, request, pk=None):
-        comment = self.get_object()
+        comment = self._action_target()
         CommentBookmark.objects.get_or_create(user=request.user, comment=comment)
-        response = self._response_with_comment(comment)
+        response = self._action_response(comment, is_bookmarked=True)
         if response.status_code == status.HTTP_200_OK:
-            self._cache_delete()
-            self._broadcast(comment.pk)
+            # Bookmarks are private: nothing to tell other clients.
+            feed_cache.invalidate_user(request.user.pk)
         return response
 
     @bookmark.mapping.delete
     def remove_bookmark(self, request, pk=None):
-        comment = self.get_object()
+        comment = self._action_target(active=False)
         CommentBookmark.objects.filter(user=request.user, comment=comment).delete()
-        response = self._response_with_comment(comment)
+        response = self._action_response(comment, is_bookmarked=False)
         if response.status_code == status.HTTP_200_OK:
-            self._cache_delete()
-            self._broadcast(comment.pk)
+            feed_cache.invalidate_user(request.user.pk)
         return response
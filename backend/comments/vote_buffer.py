@@ -0,0 +1,331 @@
+"""Write-behind buffer for comment votes (``COMMENTS_VOTE_BUFFER``).
+
+Instead of locking and upserting a ``CommentVote`` row per request, a vote is
+recorded in Redis:
+
+* ``comments:votes:live:<comment id>`` maps user id to the user's latest vote
+  (0 = cleared), so repeating a vote is a no-op;
+* ``comments:votes:delta`` holds the not yet flushed counter deltas per
+  comment (``<id>:score``, ``<id>:up``, ``<id>:down``);
+* ``comments:votes:dirty`` lists the comments with pending votes.
+
+``flush`` (run by the ``flush_vote_buffer`` beat task) claims a batch of dirty
+comments by moving their votes and deltas to ``held`` keys under a new batch
+id, writes the votes as absolute values, recounts the comments' counters from
+``CommentVote`` and records the batch id in ``VoteFlush`` in the same
+transaction, then acknowledges the batch. Every step is idempotent: a worker
+that dies after claiming or even after committing leaves the batch held, and
+the next flush writes it again, alone and under the same id, instead of
+adding the deltas twice.
+
+Reads merge the pending deltas (``merge``) so scores stay current between
+flushes: the live ones always, the held ones only until their batch is
+committed, since the stored counters include them from then on.
+"""
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import feed_cache
+from .models import Comment, CommentChange, CommentVote, VoteFlush
+from .redis_client import get_redis
+
+LIVE_KEY = 'comments:votes:live:{comment_id}'
+HELD_KEY = 'comments:votes:held:{comment_id}'
+DELTA_KEY = 'comments:votes:delta'
+HELD_DELTA_KEY = 'comments:votes:held:delta'
+DIRTY_KEY = 'comments:votes:dirty'
+HELD_SET_KEY = 'comments:votes:claimed'
+BATCH_KEY = 'comments:votes:batch'
+EPOCH_KEY = 'comments:votes:epoch'
+LOCK_KEY = 'comments:votes:flush:lock'
+
+LOCK_TIMEOUT_MS = 60000
+CAST_ATTEMPTS = 3
+COUNTERS = ('score', 'up', 'down')
+
+# The user's previous vote comes from the live or held hash; only when neither
+# has it is the database value passed by the caller used, and only if no flush
+# was acknowledged since the caller read it (the epoch). Returns {previous},
+# or false when the caller has to read the database again.
+_CAST_SCRIPT = """
+local previous = redis.call('HGET', KEYS[1], ARGV[1]) or redis.call('HGET', KEYS[2], ARGV[1])
+if not previous then
+    if (redis.call('GET', KEYS[5]) or '0') ~= ARGV[4] then
+        return false
+    end
+    previous = ARGV[3]
+end
+previous = tonumber(previous)
+local value = tonumber(ARGV[2])
+if previous == value then
+    return {previous}
+end
+local up = (value == 1 and 1 or 0) - (previous == 1 and 1 or 0)
+local down = (value == -1 and 1 or 0) - (previous == -1 and 1 or 0)
+redis.call('HSET', KEYS[1], ARGV[1], value)
+redis.call('HINCRBY', KEYS[3], ARGV[5] .. ':score', value - previous)
+redis.call('HINCRBY', KEYS[3], ARGV[5] .. ':up', up)
+redis.call('HINCRBY', KEYS[3], ARGV[5] .. ':down', down)
+redis.call('SADD', KEYS[4], ARGV[5])
+return {previous}
+"""
+
+# A batch that was claimed but never acknowledged is returned again as is,
+# under its id; otherwise fresh comments are moved from live to held under a
+# new batch id, above the last committed one (ARGV[4]) even if Redis lost the
+# counter. Returns {batch id, ids}.
+_CLAIM_SCRIPT = """
+local claimed = redis.call('SMEMBERS', KEYS[2])
+if #claimed == 0 then
+    for _, id in ipairs(redis.call('SPOP', KEYS[1], tonumber(ARGV[1]))) do
+        local live = ARGV[2] .. id
+        local votes = redis.call('HGETALL', live)
+        for i = 1, #votes, 2 do
+            redis.call('HSET', ARGV[3] .. id, votes[i], votes[i + 1])
+        end
+        redis.call('DEL', live)
+        for _, counter in ipairs({'score', 'up', 'down'}) do
+            local field = id .. ':' .. counter
+            local delta = redis.call('HGET', KEYS[3], field)
+            if delta then
+                redis.call('HINCRBY', KEYS[4], field, delta)
+                redis.call('HDEL', KEYS[3], field)
+            end
+        end
+        redis.call('SADD', KEYS[2], id)
+        table.insert(claimed, id)
+    end
+    if #claimed > 0 then
+        local last = math.max(tonumber(redis.call('GET', KEYS[5]) or '0'), tonumber(ARGV[4]))
+        redis.call('SET', KEYS[5], last + 1)
+    end
+end
+return {redis.call('GET', KEYS[5]) or '0', claimed}
+"""
+
+_ACK_SCRIPT = """
+for i = 2, #ARGV do
+    local id = ARGV[i]
+    redis.call('DEL', ARGV[1] .. id)
+    redis.call('HDEL', KEYS[2], id .. ':score', id .. ':up', id .. ':down')
+    redis.call('SREM', KEYS[1], id)
+end
+return redis.call('INCR', KEYS[3])
+"""
+
+_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def enabled():
+    return getattr(settings, 'COMMENTS_VOTE_BUFFER', False)
+
+
+def batch_size():
+    return getattr(settings, 'COMMENTS_VOTE_FLUSH_BATCH', 500)
+
+
+def _prefix(template):
+    return template.format(comment_id='')
+
+
+def cast(comment_id: int, user_id: int, value: int) -> int:
+    """Buffer ``user_id``'s vote on ``comment_id`` (0 clears it) and return the previous one."""
+    client = get_redis()
+    keys = [
+        LIVE_KEY.format(comment_id=comment_id),
+        HELD_KEY.format(comment_id=comment_id),
+        DELTA_KEY,
+        DIRTY_KEY,
+        EPOCH_KEY,
+    ]
+    for _ in range(CAST_ATTEMPTS):
+        epoch = int(client.get(EPOCH_KEY) or 0)
+        baseline = (
+            CommentVote.objects.filter(user_id=user_id, comment_id=comment_id).values_list('value', flat=True).first()
+            or 0
+        )
+        result = client.eval(_CAST_SCRIPT, len(keys), *keys, user_id, value, baseline, epoch, comment_id)
+        if result:
+            return int(result[0])
+    raise RuntimeError('vote buffer kept moving under the caller')
+
+
+def has_pending() -> bool:
+    """Whether any votes wait for a flush; False when Redis is unavailable."""
+    try:
+        return bool(get_redis().exists(DIRTY_KEY, HELD_SET_KEY))
+    except Exception:
+        return False
+
+
+def pending_counters(comment_ids):
+    """``{comment_id: {'score': ..., 'up': ..., 'down': ...}}`` not yet written to the database."""
+    comment_ids = list(comment_ids)
+    if not comment_ids:
+        return {}
+    fields = [f'{comment_id}:{counter}' for comment_id in comment_ids for counter in COUNTERS]
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hmget(DELTA_KEY, fields)
+    pipe.hmget(HELD_DELTA_KEY, fields)
+    pipe.get(BATCH_KEY)
+    live, held, held_batch = pipe.execute()
+    if any(held) and int(held_batch or 0) <= VoteFlush.committed_batch():
+        # Committed but not acknowledged yet: the counters include them.
+        held = [None] * len(fields)
+    deltas = {}
+    for index, field in enumerate(fields):
+        amount = int(live[index] or 0) + int(held[index] or 0)
+        if amount:
+            comment_id, counter = field.split(':')
+            deltas.setdefault(int(comment_id), dict.fromkeys(COUNTERS, 0))[counter] = amount
+    return deltas
+
+
+def pending_votes(user_id: int, comment_ids):
+    """``{comment_id: value}`` for the votes ``user_id`` cast that are not flushed yet."""
+    comment_ids = list(comment_ids)
+    if not comment_ids:
+        return {}
+    pipe = get_redis().pipeline(transaction=False)
+    for comment_id in comment_ids:
+        pipe.hget(LIVE_KEY.format(comment_id=comment_id), user_id)
+        pipe.hget(HELD_KEY.format(comment_id=comment_id), user_id)
+    values = pipe.execute()
+    votes = {}
+    for index, comment_id in enumerate(comment_ids):
+        value = values[2 * index] if values[2 * index] is not None else values[2 * index + 1]
+        if value is not None:
+            votes[comment_id] = int(value)
+    return votes
+
+
+def merge(items, user=None):
+    """Apply buffered votes to serialized comments (dicts with ``id`` and counter fields).
+
+    Items are returned unchanged when the buffer is off or Redis is unavailable.
+    """
+    if not enabled() or not items:
+        return items
+    ids = [item['id'] for item in items]
+    try:
+        deltas = pending_counters(ids)
+        votes = pending_votes(user.pk, ids) if user is not None and user.is_authenticated else {}
+    except Exception:
+        return items
+    if not deltas and not votes:
+        return items
+
+    merged = []
+    for item in items:
+        delta = deltas.get(item['id'])
+        if delta is None and item['id'] not in votes:
+            merged.append(item)
+            continue
+        item = dict(item)
+        if delta is not None:
+            for field, counter in (('score', 'score'), ('upvotes', 'up'), ('downvotes', 'down')):
+                if field in item:
+                    item[field] += delta[counter]
+        if item['id'] in votes and 'user_vote' in item:
+            item['user_vote'] = votes[item['id']]
+        merged.append(item)
+    return merged
+
+
+@contextmanager
+def _flush_lock():
+    client = get_redis()
+    token = uuid.uuid4().hex
+    acquired = client.set(LOCK_KEY, token, nx=True, px=LOCK_TIMEOUT_MS)
+    try:
+        yield bool(acquired)
+    finally:
+        if acquired:
+            client.eval(_UNLOCK_SCRIPT, 1, LOCK_KEY, token)
+
+
+def flush(limit=None):
+    """Write buffered votes to the database.
+
+    Returns ``(threads, users)``: the thread ids whose comments were recounted
+    and the ids of the users whose votes were written, for cache invalidation.
+    """
+    limit = limit or batch_size()
+    client = get_redis()
+    threads, users = set(), set()
+    with _flush_lock() as acquired:
+        if not acquired:
+            return threads, users
+        while True:
+            batch, claimed = client.eval(
+                _CLAIM_SCRIPT, 5, DIRTY_KEY, HELD_SET_KEY, DELTA_KEY, HELD_DELTA_KEY, BATCH_KEY,
+                limit, _prefix(LIVE_KEY), _prefix(HELD_KEY), VoteFlush.committed_batch(),
+            )
+            comment_ids = sorted({int(comment_id) for comment_id in claimed})
+            if not comment_ids:
+                break
+            batch_threads, batch_users = _write_batch(client, int(batch), comment_ids)
+            # Before the ack: cached entries built from the old counters would
+            # otherwise miss the held deltas that reads now skip.
+            for thread_id in batch_threads:
+                feed_cache.invalidate_thread(thread_id)
+            for user_id in batch_users:
+                feed_cache.invalidate_user(user_id)
+            if batch_threads.intersection(comment_ids):
+                feed_cache.invalidate_ranking()
+            client.eval(_ACK_SCRIPT, 3, HELD_SET_KEY, HELD_DELTA_KEY, EPOCH_KEY, _prefix(HELD_KEY), *comment_ids)
+            threads |= batch_threads
+            users |= batch_users
+            if len(comment_ids) < limit:
+                break
+    return threads, users
+
+
+def _write_batch(client, batch, comment_ids):
+    pipe = client.pipeline(transaction=False)
+    for comment_id in comment_ids:
+        pipe.hgetall(HELD_KEY.format(comment_id=comment_id))
+    held = {
+        comment_id: {int(user_id): int(value) for user_id, value in votes.items()}
+        for comment_id, votes in zip(comment_ids, pipe.execute())
+    }
+
+    with transaction.atomic():
+        # Comments or users deleted since the vote was cast take their votes with them.
+        threads = dict(Comment.objects.filter(pk__in=comment_ids).values_list('pk', 'thread_id'))
+        user_ids = {user_id for votes in held.values() for user_id in votes}
+        users = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+
+        upserts, cleared = [], {}
+        for comment_id, votes in held.items():
+            if comment_id not in threads:
+                continue
+            for user_id, value in votes.items():
+                if user_id not in users:
+                    continue
+                if value:
+                    upserts.append(CommentVote(user_id=user_id, comment_id=comment_id, value=value))
+                else:
+                    cleared.setdefault(comment_id, []).append(user_id)
+        if upserts:
+            CommentVote.objects.bulk_create(
+                upserts,
+                update_conflicts=True,
+                unique_fields=['user', 'comment'],
+                update_fields=['value', 'updated_at'],
+            )
+        for comment_id, user_ids in cleared.items():
+            CommentVote.objects.filter(comment_id=comment_id, user_id__in=user_ids).delete()
+        Comment.objects.recount_votes(list(threads))
+        CommentChange.objects.record(CommentChange.UPDATED, threads.items())
+        VoteFlush.commit(batch)
+    return set(threads.values()), users
@@ -146,6 +146,56 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Window during which comment_update events are coalesced into one comment_batch.
+COMMENTS_BROADCAST_WINDOW_MS = int(os.getenv('COMMENTS_BROADCAST_WINDOW_MS', '200'))
+# Number of sequenced WebSocket events kept for replay after a reconnect.
+COMMENTS_REPLAY_LOG_SIZE = int(os.getenv('COMMENTS_REPLAY_LOG_SIZE', '1000'))
+
+
+# Buffer votes in Redis and write them to the database in batches (see comments.vote_buffer).
+COMMENTS_VOTE_BUFFER = os.getenv('COMMENTS_VOTE_BUFFER', '').lower() == 'true'
+COMMENTS_VOTE_FLUSH_INTERVAL = float(os.getenv('COMMENTS_VOTE_FLUSH_INTERVAL', '2'))
+COMMENTS_VOTE_FLUSH_BATCH = int(os.getenv('COMMENTS_VOTE_FLUSH_BATCH', '500'))
+
+# Roots created within this many days get their hot_rank re-checked periodically.
+COMMENTS_HOT_RANK_REFRESH_DAYS = int(os.getenv('COMMENTS_HOT_RANK_REFRESH_DAYS', '7'))
+
+# Comments with at least this many descendants are deleted by a background
+# job, COMMENTS_DELETE_BATCH_SIZE rows per transaction.
+COMMENTS_INLINE_DELETE_LIMIT = int(os.getenv('COMMENTS_INLINE_DELETE_LIMIT', '100'))
+COMMENTS_DELETE_BATCH_SIZE = int(os.getenv('COMMENTS_DELETE_BATCH_SIZE', '500'))
+
+# Deleting marks the comment as a tombstone that keeps its replies in place;
+# tombstones without replies are removed by compact_deleted_comments.
+COMMENTS_SOFT_DELETE = os.getenv('COMMENTS_SOFT_DELETE', '').lower() == 'true'
+
+# Entries of the comment change log (GET /api/comments/changes/) are kept this long.
+COMMENTS_CHANGE_LOG_DAYS = int(os.getenv('COMMENTS_CHANGE_LOG_DAYS', '7'))
+
+CELERY_BEAT_SCHEDULE = {
+    'flush-vote-buffer': {
+        'task': 'comments.tasks.flush_vote_buffer',
+        'schedule': COMMENTS_VOTE_FLUSH_INTERVAL,
+    },
+    'refresh-hot-ranks': {
+        'task': 'comments.tasks.refresh_hot_ranks',
+        'schedule': 600,
+    },
+    # Picks up subtree deletions whose worker died part way.
+    'resume-subtree-deletions': {
+        'task': 'comments.tasks.delete_comment_subtree',
+        'schedule': 300,
+    },
+    'compact-deleted-comments': {
+        'task': 'comments.tasks.compact_deleted_comments',
+        'schedule': 600,
+    },
+    'trim-comment-changes': {
+        'task': 'comments.tasks.trim_comment_changes',
+        'schedule': 3600,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
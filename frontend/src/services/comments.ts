@@ -1,5 +1,5 @@
 import { http } from './http'
-import type { CommentRecord } from '../types/comment'
+import type { CommentChanges, CommentPage, CommentRecord, CommentSearchPage, CommentState, TopWindow } from '../types/comment'
 
 export interface CommentCreatePayload {
   user_name: string
@@ -9,8 +9,41 @@ export interface CommentCreatePayload {
   parent?: number | null
 }
 
-export const fetchComments = async () =>
-  http<CommentRecord[]>('comments/')
+export const fetchComments = async (cursor?: string | null, ordering?: string, window?: TopWindow) => {
+  const params = new URLSearchParams()
+  if (ordering) params.set('ordering', ordering)
+  if (window) params.set('window', window)
+  if (cursor) params.set('cursor', cursor)
+  const query = params.toString()
+  return http<CommentPage>(query ? `comments/?${query}` : 'comments/')
+}
+
+export const fetchReplies = async (id: number, cursor?: string | null) => {
+  const params = new URLSearchParams()
+  if (cursor) params.set('cursor', cursor)
+  const query = params.toString()
+  return http<CommentPage>(query ? `comments/${id}/replies/?${query}` : `comments/${id}/replies/`)
+}
+
+// Without `since` only the current change-log position comes back.
+export const fetchChanges = async (since?: number | null) => {
+  const query = since == null ? '' : `?since=${since}`
+  return http<CommentChanges>(`comments/changes/${query}`)
+}
+
+export const searchComments = async (query: string, page = 1) => {
+  const params = new URLSearchParams({ q: query, page: String(page) })
+  return http<CommentSearchPage>(`comments/search/?${params.toString()}`)
+}
+
+export const nextCursor = (page: CommentPage) => {
+  if (!page.next) return null
+  try {
+    return new URL(page.next).searchParams.get('cursor')
+  } catch (_) {
+    return null
+  }
+}
 
 export const createComment = async (
   payload: CommentCreatePayload,
@@ -37,9 +70,9 @@ export const createComment = async (
 
 export const voteComment = (id: number, value: -1 | 0 | 1) => {
   if (value === 0) {
-    return http<CommentRecord>(`comments/${id}/vote/`, { method: 'DELETE' })
+    return http<CommentState>(`comments/${id}/vote/?compact=1`, { method: 'DELETE' })
   }
-  return http<CommentRecord>(`comments/${id}/vote/`, {
+  return http<CommentState>(`comments/${id}/vote/?compact=1`, {
     method: 'POST',
     json: { value }
   })
@@ -47,7 +80,23 @@ export const voteComment = (id: number, value: -1 | 0 | 1) => {
 
 export const toggleBookmark = (id: number, active: boolean) => {
   if (active) {
-    return http<CommentRecord>(`comments/${id}/bookmark/`, { method: 'DELETE' })
+    return http<CommentState>(`comments/${id}/bookmark/?compact=1`, { method: 'DELETE' })
   }
-  return http<CommentRecord>(`comments/${id}/bookmark/`, { method: 'POST' })
+  return http<CommentState>(`comments/${id}/bookmark/?compact=1`, { method: 'POST' })
+}
+
+export interface BulkActions {
+  votes?: { comment_id: number; value: -1 | 0 | 1 }[]
+  bookmarks?: { comment_id: number; active: boolean }[]
 }
+
+// Items without a usable comment_id are reported by their position in the request.
+type BulkError = { comment_id: number; error: string } | { index: number; error: string }
+
+export interface BulkResults {
+  votes: ({ comment_id: number; user_vote: number; score: number } | BulkError)[]
+  bookmarks: ({ comment_id: number; is_bookmarked: boolean } | BulkError)[]
+}
+
+export const applyBulkActions = (actions: BulkActions) =>
+  http<BulkResults>('comments/bulk/', { method: 'POST', json: actions })
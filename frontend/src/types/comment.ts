@@ -5,6 +5,9 @@ export interface CommentRecord {
   email: string
   home_page: string | null
   text: string
+  // Sanitized on the server when the comment is saved.
+  text_html: string
+  text_excerpt: string
   created_at: string
   parent: number | null
   attachment_url: string | null
@@ -14,14 +17,58 @@ export interface CommentRecord {
   attachment_width: number
   attachment_height: number
   attachment_text_preview: string
+  attachment_status: 'processing' | 'ready' | 'failed' | ''
+  attachment_thumbnail_url: string | null
+  attachment_preview_url: string | null
   score: number
+  hot_rank: number
+  reply_count: number
+  descendant_count: number
+  // Anything but 'active' is a tombstone: no author, text or attachment.
+  state: CommentLifecycle
+  // Set on list, subtree and replies responses: direct replies not included yet.
+  more_replies?: number
+  replies_cursor?: string | null
   user_vote: number
   is_bookmarked: boolean
 }
 
+// Compact response of the vote and bookmark actions (?compact=1).
+export type CommentState = Pick<CommentRecord, 'id' | 'score' | 'user_vote' | 'is_bookmarked'>
+
+export interface CommentPage {
+  next: string | null
+  results: CommentRecord[]
+}
+
+// Delta from GET comments/changes/ and the socket's `changes` event.
+export interface CommentChanges {
+  position: number
+  more: boolean
+  created: CommentRecord[]
+  updated: CommentRecord[]
+  deleted: number[]
+}
+
+export interface CommentSearchHit {
+  comment: CommentRecord
+  rank: number
+  // Escaped excerpts with matches wrapped in <mark>.
+  highlights: Partial<Record<'text' | 'user_name' | 'attachment_text_preview', string>>
+  context: { id: number; user_name: string; depth: number; excerpt: string }[]
+}
+
+export interface CommentSearchPage {
+  next: string | null
+  results: CommentSearchHit[]
+}
+
 export interface CommentNode extends CommentRecord {
   replies: CommentNode[]
 }
 
-export type SortField = 'created_at' | 'user_name' | 'email'
+export type CommentLifecycle = 'active' | 'deleting' | 'deleted'
+
+export type SortField = 'created_at' | 'user_name' | 'email' | 'score' | 'hot' | 'top'
+export type TopWindow = 'day' | 'week' | 'all'
 export type SortDirection = 'asc' | 'desc'
@@ -27,6 +27,16 @@ const compare = (field: SortField, direction: SortDirection) => {
       const t2 = new Date(b.created_at).getTime()
       return (t1 - t2) * multiplier
     }
+    if (field === 'score') {
+      return (a.score - b.score) * multiplier
+    }
+    // Rankings are always best first.
+    if (field === 'hot') {
+      return b.hot_rank - a.hot_rank
+    }
+    if (field === 'top') {
+      return b.score - a.score
+    }
 
     const v1 = a[field].toLowerCase()
     const v2 = b[field].toLowerCase()